@@ -0,0 +1,273 @@
+"""Compares stored tagging runs with each other without running a model.
+
+The entities of two runs (see results_store.py) are matched on their sorted
+offset arrays: the spans of both runs are grouped by sentence id and label,
+every span is paired with the spans of the same group in the other run, and
+the pairs are checked for identical bounds (exact match) or any overlap
+(partial match). Precision, recall, and F1-score are computed per label with
+the first run as reference. For any number of runs, the F1-scores of all
+pairs form an agreement matrix.
+
+Only sentences contained in both runs are compared. Runs are matched by
+sentence id, e.g. Tatoeba ids from read_corpus(lang, with_ids=True), or by
+sentence text. The .csv files in results/ only contain sentences with at
+least one entity and have no ids, so runs imported from them are matched by
+text, and sentences without entities in either system are not compared.
+
+The English spaCy and Stanza pipelines and the Dutch spaCy pipelines (md and
+lg) use the 18 OntoNotes labels. The German pipelines, the Dutch Stanza
+pipeline and the multi-language pipeline use the CoNLL labels LOC, MISC, ORG,
+and PER. Runs of the Dutch md and lg pipelines therefore also need
+--map ontonotes to be compared with CoNLL runs. A label mapping renames
+labels before matching; labels mapped to None are dropped and labels missing
+from the mapping are kept.
+
+Requires "argparse", "json", "os", and "numpy".
+
+Example:
+    Run from the code directory::
+
+        python agreement.py runs/ger_sp_results_nlp_de2 ../results/results_all_stanza_de.csv --mode partial
+        python agreement.py runs/eng_st_results runs/eng_sp_results_nlp_multi --map ontonotes
+
+    scores = compare(RunStore("./runs/eng_st_results"), RunStore("./runs/eng_multi"), ONTONOTES_TO_CONLL)
+
+Attributes:
+    ONTONOTES_TO_CONLL (dict): Maps the OntoNotes labels to the CoNLL labels.
+        Numeric and temporal labels are dropped.
+    LABEL_MAPS (dict): The built-in label mappings by name.
+
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+from results_store import RunStore, import_csv
+
+ONTONOTES_TO_CONLL = {
+    "PERSON": "PER",
+    "NORP": "MISC",
+    "FAC": "LOC",
+    "ORG": "ORG",
+    "GPE": "LOC",
+    "LOC": "LOC",
+    "PRODUCT": "MISC",
+    "EVENT": "MISC",
+    "WORK_OF_ART": "MISC",
+    "LAW": "MISC",
+    "LANGUAGE": "MISC",
+    "DATE": None,
+    "TIME": None,
+    "PERCENT": None,
+    "MONEY": None,
+    "QUANTITY": None,
+    "ORDINAL": None,
+    "CARDINAL": None,
+}
+
+LABEL_MAPS = {"ontonotes": ONTONOTES_TO_CONLL}
+
+def text_ids(runs):
+    """Numbers the sentences of several runs by their text.
+
+    Args:
+        runs (list[RunStore]): The runs.
+
+    Returns:
+        list[ndarray]: For every run, the number of the text of every
+            sentence in run order. Equal texts get equal numbers.
+
+    """
+
+    numbers = {}
+    return [np.array([numbers.setdefault(run.sentence(n), len(numbers)) for n in range(len(run))], dtype=np.int64) for run in runs]
+
+def load_spans(run, label_map=None, sentences=None, ids=None):
+    """Reads the entities of a run as arrays.
+
+    Args:
+        run (RunStore): The run.
+        label_map (dict): Renames labels. Labels mapped to None are dropped.
+        sentences (ndarray): Sentence ids to keep. None keeps all.
+        ids (ndarray): New sentence ids in run order, e.g. from text_ids.
+            None keeps the ids of the run.
+
+    Returns:
+        dict: Arrays "sentence", "start", "end" and "label" (str) of the
+            unique entities, sorted by sentence and start.
+
+    """
+
+    labels = np.array([(label_map or {}).get(label, label) or "" for label in run.labels] or [""])
+    sentence = np.asarray(run.ent_sentence)
+    if ids is not None:  # Rows of a sentence id in the run, then its new id.
+        order = np.argsort(run.sentence_id, kind="stable")
+        sentence = ids[order[np.searchsorted(np.asarray(run.sentence_id)[order], sentence)]]
+    spans = {
+        "sentence": sentence,
+        "start": np.asarray(run.ent_start),
+        "end": np.asarray(run.ent_end),
+        "label": labels[np.asarray(run.ent_label)],
+    }
+    keep = spans["label"] != ""
+    if sentences is not None:
+        keep &= np.isin(spans["sentence"], sentences)
+    spans = {name: column[keep] for name, column in spans.items()}
+    records = np.rec.fromarrays([spans["sentence"], spans["start"], spans["end"], spans["label"]], names="sentence,start,end,label")
+    records = np.unique(records)  # Sorts and removes duplicate rows.
+    return {name: records[name] for name in ("sentence", "start", "end", "label")}
+
+def _pairs(reference, candidate, vocabulary):
+    # Gives every (sentence, label) group one integer key and pairs every
+    # candidate span with the reference spans of its group.
+    ref_group = reference["sentence"] * len(vocabulary) + np.searchsorted(vocabulary, reference["label"])
+    cand_group = candidate["sentence"] * len(vocabulary) + np.searchsorted(vocabulary, candidate["label"])
+    order = np.argsort(ref_group, kind="stable")
+    sorted_group = ref_group[order]
+    low = np.searchsorted(sorted_group, cand_group, side="left")
+    high = np.searchsorted(sorted_group, cand_group, side="right")
+    counts = high - low
+    cand_index = np.repeat(np.arange(len(cand_group)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    ref_index = order[np.repeat(low, counts) + offsets]
+    return ref_index, cand_index
+
+def _prf(tp_p, n_p, tp_r, n_r):
+    precision = tp_p / n_p if n_p else 0.0
+    recall = tp_r / n_r if n_r else 0.0
+    fscore = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {"p": precision, "r": recall, "f": fscore}
+
+def _scores(reference, candidate, vocabulary, ref_matched, cand_matched):
+    ref_labels = np.searchsorted(vocabulary, reference["label"])
+    cand_labels = np.searchsorted(vocabulary, candidate["label"])
+    n_ref = np.bincount(ref_labels, minlength=len(vocabulary))
+    n_cand = np.bincount(cand_labels, minlength=len(vocabulary))
+    tp_ref = np.bincount(ref_labels[ref_matched], minlength=len(vocabulary))
+    tp_cand = np.bincount(cand_labels[cand_matched], minlength=len(vocabulary))
+    scores = _prf(tp_cand.sum(), n_cand.sum(), tp_ref.sum(), n_ref.sum())
+    scores["per_type"] = {str(label): _prf(tp_cand[i], n_cand[i], tp_ref[i], n_ref[i]) for i, label in enumerate(vocabulary)}
+    return scores
+
+def compare(reference, candidate, label_map=None, by_text=False):
+    """Scores one run against another.
+
+    With exact matching, a candidate span is correct if the reference has a
+    span with the same bounds and label. With partial matching, it is correct
+    if it overlaps a reference span with the same label, and a reference span
+    is found if it overlaps a candidate span with the same label.
+
+    Args:
+        reference (RunStore): The run used as reference.
+        candidate (RunStore): The run that is scored.
+        label_map (dict): Renames the labels of both runs.
+        by_text (bool): Whether to match the sentences by text instead of
+            by id.
+
+    Returns:
+        dict: "exact" and "partial" scores with the precision "p", recall
+            "r", and F1-score "f" in total and "per_type", and the number of
+            compared sentences.
+
+    """
+
+    ref_ids, cand_ids = text_ids([reference, candidate]) if by_text else (np.asarray(reference.sentence_id), np.asarray(candidate.sentence_id))
+    sentences = np.intersect1d(ref_ids, cand_ids)
+    ref_spans = load_spans(reference, label_map, sentences, ref_ids if by_text else None)
+    cand_spans = load_spans(candidate, label_map, sentences, cand_ids if by_text else None)
+    vocabulary = np.union1d(ref_spans["label"], cand_spans["label"])
+    ref_index, cand_index = _pairs(ref_spans, cand_spans, vocabulary)
+
+    same = (ref_spans["start"][ref_index] == cand_spans["start"][cand_index]) & (ref_spans["end"][ref_index] == cand_spans["end"][cand_index])
+    overlap = (ref_spans["start"][ref_index] < cand_spans["end"][cand_index]) & (cand_spans["start"][cand_index] < ref_spans["end"][ref_index])
+    results = {"sentences": len(sentences)}
+    for mode, matched in (("exact", same), ("partial", overlap)):
+        ref_matched = np.unique(ref_index[matched])
+        cand_matched = np.unique(cand_index[matched])
+        results[mode] = _scores(ref_spans, cand_spans, vocabulary, ref_matched, cand_matched)
+    return results
+
+def agreement_matrix(runs, label_map=None, mode="exact", by_text=False):
+    """Compares every pair of runs.
+
+    The F1-score does not change when reference and candidate are swapped,
+    so every pair is compared once.
+
+    Args:
+        runs (dict): The runs (RunStore) by name.
+        label_map (dict): Renames the labels of all runs.
+        mode (str): "exact" or "partial".
+        by_text (bool): Whether to match the sentences by text instead of
+            by id.
+
+    Returns:
+        tuple: The names and a matrix (list[list[float]]) of F1-scores.
+
+    """
+
+    names = list(runs)
+    matrix = [[1.0] * len(names) for _ in names]
+    for i, first in enumerate(names):
+        for j in range(i + 1, len(names)):
+            fscore = compare(runs[first], runs[names[j]], label_map, by_text)[mode]["f"]
+            matrix[i][j] = matrix[j][i] = fscore
+    return names, matrix
+
+def open_run(path, directory=r"./runs"):
+    """Opens a run directory, or imports a .csv file from results/ once.
+
+    Args:
+        path (str): A run directory or a .csv file written by export_to_csv.
+        directory (str): Where imported .csv files are stored as runs.
+
+    Returns:
+        RunStore: The run.
+
+    """
+
+    if not path.endswith(".csv"):
+        return RunStore(path)
+    run_path = os.path.join(directory, os.path.splitext(os.path.basename(path))[0])
+    if os.path.exists(os.path.join(run_path, "meta.json")):
+        return RunStore(run_path)
+    return import_csv(path, run_path)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compares stored tagging runs without running a model.")
+    parser.add_argument("runs", nargs="+", help="run directories or .csv files from results/")
+    parser.add_argument("--map", help="label mapping: " + ", ".join(LABEL_MAPS) + " or a JSON file")
+    parser.add_argument("--mode", default="exact", choices=["exact", "partial"])
+    parser.add_argument("--by-text", action="store_true", help="match sentences by text (default for .csv files)")
+    parser.add_argument("--output", help="write the scores of all pairs as JSON")
+    args = parser.parse_args(argv)
+
+    label_map = LABEL_MAPS.get(args.map)
+    if args.map and label_map is None:
+        with open(args.map, encoding="utf-8") as map_file:
+            label_map = json.load(map_file)
+    runs = {os.path.basename(os.path.normpath(path)): open_run(path) for path in args.runs}
+    by_text = args.by_text or any(run.meta.get("source", "").endswith(".csv") for run in runs.values())
+    if len(runs) == 2:
+        (first, reference), (second, candidate) = runs.items()
+        scores = compare(reference, candidate, label_map, by_text)
+        print("{} (reference) vs. {} on {} sentences:".format(first, second, scores["sentences"]))
+        for label, score in sorted(scores[args.mode]["per_type"].items()):
+            print("  {:12} P {p:.3f} R {r:.3f} F {f:.3f}".format(label, **score))
+        print("  {:12} P {p:.3f} R {r:.3f} F {f:.3f}".format("total", **scores[args.mode]))
+        pairs = {"{} {}".format(first, second): scores}
+    else:
+        names, matrix = agreement_matrix(runs, label_map, args.mode, by_text)
+        width = max(len(name) for name in names)
+        print(" " * width, *("{:>8}".format(str(n)[:8]) for n in range(len(names))))
+        for n, (name, row) in enumerate(zip(names, matrix)):
+            print(name.ljust(width), *("{:8.3f}".format(value) for value in row), " ({})".format(n))
+        pairs = {"names": names, "f": matrix}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(pairs, output, indent=1)
+
+if __name__ == "__main__":
+    main()
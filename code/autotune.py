@@ -0,0 +1,506 @@
+"""Finds and keeps the fastest batch size and parallelism per pipeline.
+
+The best settings differ between xx_ent_wiki_sm, the md and lg spaCy
+pipelines and the Stanza models, and between machines. calibrate() tags (or
+evaluates) a corpus sample with every combination of batch size and number
+of processes (Stanza: with the CPU threads divided among the processes) and
+keeps the one with the most sentences per second whose peak resident set
+size, including worker processes, stays below a ceiling. Larger batches are
+not tried once a batch size exceeds the ceiling or is clearly slower, and
+more processes are not tried once they stop helping.
+
+Profiles are stored per task, pipeline (name, version and configuration) and
+machine in PROFILES_PATH, so later runs start with the tuned settings.
+During a run, tag_adaptive() and evaluate_adaptive() process the input in
+segments and let a Controller adjust the batch size: it is halved when the
+memory nears the ceiling, and another batch size is probed when the
+throughput drops. The number of processes is kept, because changing it
+restarts the workers. Stanza workers are started once per run, and only the
+size of the chunks sent to them changes. spaCy's nlp.pipe cannot change the
+batch size of running workers, so spaCy runs with more than one process keep
+the tuned batch size for the whole run.
+
+Requires "argparse", "hashlib", "itertools", "json", "os", "platform",
+"threading", "time", "spacy", and "stanza".
+
+Example:
+    profile = tuned(load("nlp_de3"), sample=list(read_corpus("de", stop=5000)))
+    results = list(tag_adaptive(read_corpus("de"), load("nlp_de2")))
+
+    Or calibrate from the code directory::
+
+        python autotune.py --lang de --pipeline stanza --sample 3000 --rss-ceiling-mb 6000
+
+Attributes:
+    PROFILES_PATH (str): The file of the tuned profiles. Can be set with the
+        environment variable NER_AUTOTUNE_PROFILES.
+    BATCH_SIZES (list[int]): The batch sizes that calibration tries.
+    PROCESSES (list[int]): The numbers of processes that calibration tries,
+        up to the number of CPUs.
+
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import platform
+import threading
+import time
+
+from batching import chunks
+from cache import DEFAULT_CACHE_DIR, pipeline_key
+from models import STANZA_PIPELINES, current_rss, load, pipeline_name
+
+PROFILES_PATH = os.environ.get("NER_AUTOTUNE_PROFILES", os.path.join(DEFAULT_CACHE_DIR, "autotune.json"))
+
+BATCH_SIZES = [32, 128, 512, 2000]
+
+PROCESSES = [1, 2, 4, 8, 16]
+
+def machine_key():
+    """Identifies the machine by host name, processor, CPUs and memory."""
+
+    try:
+        memory = os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        memory = 0
+    description = "{}|{}|{}|{}".format(platform.node(), platform.processor() or platform.machine(), os.cpu_count(), memory)
+    return hashlib.sha1(description.encode("utf-8")).hexdigest()[:12]
+
+def default_ceiling_mb():
+    """Returns 80% of the physical memory in MB (4000 if it is unknown)."""
+
+    try:
+        return int(0.8 * os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2)
+    except (OSError, ValueError):
+        return 4000
+
+def tree_rss():
+    """Returns the resident set size of this process and its descendants.
+
+    Worker processes of spaCy and Stanza count toward the memory of a run.
+    Pages that forked workers share are counted once per process, so the
+    estimate errs on the safe side. Falls back to the current process on
+    systems without /proc.
+
+    Returns:
+        int: The resident set size in bytes.
+
+    """
+
+    try:
+        children, rss = {}, {}
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open("/proc/{}/stat".format(entry)) as stat:
+                    fields = stat.read().rsplit(")", 1)[1].split()
+            except OSError:  # The process has ended.
+                continue
+            children.setdefault(int(fields[1]), []).append(int(entry))
+            rss[int(entry)] = int(fields[21])
+        total, pending = 0, [os.getpid()]
+        while pending:
+            pid = pending.pop()
+            total += rss.get(pid, 0)
+            pending.extend(children.get(pid, []))
+        return total * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return current_rss()
+
+class _RssSampler(threading.Thread):
+    # Samples tree_rss() in the background and keeps the peak.
+
+    def __init__(self, interval=0.2):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = tree_rss()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak = max(self.peak, tree_rss())
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak = max(self.peak, tree_rss())
+        return self.peak
+
+def _runner(nlp_model, task, settings):
+    # Returns a function that processes a list of sentences (task "tag") or
+    # tagging results (task "evaluate") and returns the results or counts.
+    batch_size = settings["batch_size"]
+    if task == "evaluate":
+        from scoring import ScoreCounts, make_examples
+
+        def evaluate(items):
+            counts = ScoreCounts()
+            for example in make_examples(items, nlp_model, cache=False, batch_size=batch_size):
+                counts.add(example)
+            return counts
+        return evaluate
+    if not hasattr(nlp_model, "pipe_names"):
+        from stanza_test import tag_sentences_st
+        return lambda items: list(tag_sentences_st(items, nlp_model, batch_size, settings["n_process"], settings.get("torch_threads")))
+    from spacy_test import tag_sentences_sp
+    return lambda items: list(tag_sentences_sp(items, nlp_model, batch_size, settings["n_process"]))
+
+def _trial(nlp_model, task, settings, items):
+    sampler = _RssSampler()
+    sampler.start()
+    start_time = time.perf_counter()
+    try:
+        _runner(nlp_model, task, settings)(items)
+    finally:
+        peak = sampler.stop()
+    seconds = time.perf_counter() - start_time
+    return dict(settings, sentences_per_s=len(items) / max(seconds, 1e-9), peak_rss_mb=peak / 1024 ** 2)
+
+def calibrate(nlp_model, sample, task="tag", rss_ceiling_mb=None, batch_sizes=BATCH_SIZES, processes=None, verbose=True):
+    """Searches the fastest settings that stay below the memory ceiling.
+
+    Args:
+        nlp_model (Language or Pipeline): The pipeline to tune.
+        sample (list): Sentences (task "tag") or tagging results (task
+            "evaluate"). A few thousand, so that starting worker processes
+            does not dominate the trials.
+        task (str): "tag" or "evaluate". Evaluation only tunes the batch
+            size.
+        rss_ceiling_mb (float): The memory ceiling. Defaults to 80% of the
+            physical memory.
+        batch_sizes (list[int]): Batch sizes to try, ascending.
+        processes (list[int]): Numbers of processes to try, ascending.
+            Defaults to PROCESSES up to the number of CPUs.
+        verbose (bool): Whether to print every trial.
+
+    Returns:
+        dict: The profile: the best settings, their throughput and peak RSS,
+            the ceiling and all trials.
+
+    Raises:
+        RuntimeError: Even the smallest settings exceed the ceiling.
+
+    """
+
+    rss_ceiling_mb = rss_ceiling_mb or default_ceiling_mb()
+    cpus = os.cpu_count() or 1
+    if task == "evaluate":
+        processes = [1]
+    elif processes is None:
+        processes = [n for n in PROCESSES if n <= cpus]
+    stanza_model = not hasattr(nlp_model, "pipe_names")
+    _runner(nlp_model, task, {"batch_size": 8, "n_process": 1})(sample[:16])  # Warm-up outside of the trials.
+    trials = []
+    best = None
+    for n_process in processes:
+        settings = {"n_process": n_process}
+        if stanza_model:
+            settings["torch_threads"] = max(1, cpus // n_process)
+        row_best = None
+        for batch_size in batch_sizes:
+            trial = _trial(nlp_model, task, dict(settings, batch_size=batch_size), sample)
+            trial["within_ceiling"] = trial["peak_rss_mb"] <= rss_ceiling_mb
+            trials.append(trial)
+            if verbose:
+                print("n_process {n_process} batch_size {batch_size}: {sentences_per_s:.1f} sentences/s, peak RSS {peak_rss_mb:.0f} MB".format(**trial))
+            if not trial["within_ceiling"]:
+                break  # Larger batches need more memory.
+            if row_best is not None and trial["sentences_per_s"] < 0.8 * row_best["sentences_per_s"]:
+                break  # Past the optimum of this number of processes.
+            if row_best is None or trial["sentences_per_s"] > row_best["sentences_per_s"]:
+                row_best = trial
+        if row_best is None:
+            break  # Even the smallest batch exceeds the ceiling; more processes need more memory.
+        if best is not None and row_best["sentences_per_s"] < 1.05 * best["sentences_per_s"]:
+            if row_best["sentences_per_s"] > best["sentences_per_s"]:
+                best = row_best
+            break  # More processes no longer help.
+        best = row_best
+    if best is None:
+        raise RuntimeError("No settings stay below the RSS ceiling of {} MB.".format(rss_ceiling_mb))
+    profile = {key: best[key] for key in ("batch_size", "n_process", "torch_threads", "sentences_per_s", "peak_rss_mb") if key in best}
+    profile.update(task=task, pipeline=pipeline_key(nlp_model), machine=machine_key(), rss_ceiling_mb=rss_ceiling_mb,
+                   sample_size=len(sample), trials=trials, created=time.strftime("%Y-%m-%d %H:%M:%S"))
+    return profile
+
+class ProfileStore:
+    """Keeps tuned profiles per task, pipeline and machine in a JSON file.
+
+    Args:
+        path (str): The JSON file.
+
+    """
+
+    def __init__(self, path=PROFILES_PATH):
+        self.path = path
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, encoding="utf-8") as profiles_file:
+            return json.load(profiles_file)
+
+    @staticmethod
+    def key(nlp_model, task="tag"):
+        return "{}|{}|{}".format(task, pipeline_key(nlp_model), machine_key())
+
+    def get(self, nlp_model, task="tag"):
+        """Returns the stored profile of a pipeline on this machine, or None."""
+
+        return self._read().get(self.key(nlp_model, task))
+
+    def put(self, nlp_model, profile, task="tag"):
+        """Stores the profile of a pipeline on this machine."""
+
+        profiles = self._read()
+        profiles[self.key(nlp_model, task)] = profile
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path + ".part", "w", encoding="utf-8") as profiles_file:
+            json.dump(profiles, profiles_file, indent=1)
+        os.replace(self.path + ".part", self.path)
+
+def tuned(nlp_model, task="tag", sample=None, rss_ceiling_mb=None, store=None, recalibrate=False):
+    """Returns the stored profile of a pipeline, calibrating it if needed.
+
+    Args:
+        nlp_model (Language or Pipeline): The pipeline.
+        task (str): "tag" or "evaluate".
+        sample (list): Sentences or tagging results for calibration. Without
+            a sample, a pipeline without a profile gets None.
+        rss_ceiling_mb (float): The memory ceiling of the calibration.
+        store (ProfileStore): Where profiles are kept. Defaults to
+            PROFILES_PATH.
+        recalibrate (bool): Whether to calibrate even if a profile exists.
+
+    Returns:
+        dict: The profile, or None.
+
+    """
+
+    store = store or ProfileStore()
+    profile = None if recalibrate else store.get(nlp_model, task)
+    if profile is None and sample:
+        profile = calibrate(nlp_model, sample, task, rss_ceiling_mb)
+        store.put(nlp_model, profile, task)
+    return profile
+
+class Controller:
+    """Adjusts the batch size between the segments of a run.
+
+    Args:
+        batch_size (int): The starting batch size.
+        rss_ceiling_mb (float): The memory ceiling.
+        high_water (float): Fraction of the ceiling at which the batch size
+            is halved.
+        tolerance (float): Relative drop of the throughput below the best
+            observed throughput at which another batch size is probed.
+        min_batch_size (int): The smallest batch size.
+        max_batch_size (int): The largest batch size.
+
+    Attributes:
+        rates (dict): Smoothed sentences per second per batch size.
+        limit (int): Batch sizes above this exceeded the memory ceiling.
+
+    """
+
+    def __init__(self, batch_size, rss_ceiling_mb, high_water=0.9, tolerance=0.2, min_batch_size=8, max_batch_size=8192):
+        self.batch_size = batch_size
+        self.rss_ceiling_mb = rss_ceiling_mb
+        self.high_water = high_water
+        self.tolerance = tolerance
+        self.min_batch_size = min_batch_size
+        self.limit = max_batch_size
+        self.rates = {}
+        self.changes = []
+
+    def observe(self, sentences, seconds, rss_mb):
+        """Records a segment and returns the batch size for the next one.
+
+        Args:
+            sentences (int): Number of sentences of the segment.
+            seconds (float): Wall time of the segment.
+            rss_mb (float): Peak RSS during the segment in MB.
+
+        Returns:
+            int: The batch size for the next segment.
+
+        """
+
+        rate = sentences / max(seconds, 1e-9)
+        previous = self.rates.get(self.batch_size)
+        self.rates[self.batch_size] = rate if previous is None else 0.5 * previous + 0.5 * rate
+        if rss_mb > self.high_water * self.rss_ceiling_mb and self.batch_size > self.min_batch_size:
+            self.limit = self.batch_size - 1
+            self._change(max(self.min_batch_size, self.batch_size // 2), "memory {:.0f} MB".format(rss_mb))
+        elif rate < (1 - self.tolerance) * max(self.rates.values()):
+            candidates = [size for size in (self.batch_size // 2, self.batch_size * 2) if self.min_batch_size <= size <= self.limit]
+            untried = [size for size in candidates if size not in self.rates]
+            if untried:
+                self._change(untried[0], "throughput {:.1f}/s".format(rate))
+            else:
+                best = max((size for size in self.rates if size <= self.limit), key=self.rates.get)
+                if best != self.batch_size:
+                    self._change(best, "throughput {:.1f}/s".format(rate))
+        return self.batch_size
+
+    def _change(self, batch_size, reason):
+        self.changes.append((self.batch_size, batch_size, reason))
+        self.batch_size = batch_size
+
+def _adaptive(items, nlp_model, task, profile, rss_ceiling_mb, segment_batches, store):
+    # Processes items in segments and yields the output of every segment.
+    rss_ceiling_mb = rss_ceiling_mb or (profile or {}).get("rss_ceiling_mb") or default_ceiling_mb()
+    settings = {key: profile[key] for key in ("batch_size", "n_process", "torch_threads") if key in profile} if profile else {"batch_size": 512}
+    settings.setdefault("n_process", 1)
+    controller = Controller(settings["batch_size"], rss_ceiling_mb)
+    iterator = iter(items)
+    if task == "tag" and not hasattr(nlp_model, "pipe_names"):
+        yield from _stanza_segments(iterator, nlp_model, settings, controller, segment_batches)
+    elif task == "tag" and settings["n_process"] > 1:
+        from spacy_test import tag_sentences_sp
+        # nlp.pipe starts its workers per call, so the batch size is not adjusted.
+        results = tag_sentences_sp(iterator, nlp_model, settings["batch_size"], settings["n_process"])
+        yield from chunks(results, settings["batch_size"] * settings["n_process"] * segment_batches)
+    else:
+        while True:
+            settings["batch_size"] = controller.batch_size
+            segment = list(itertools.islice(iterator, controller.batch_size * settings["n_process"] * segment_batches))
+            if not segment:
+                break
+            sampler = _RssSampler()
+            sampler.start()
+            start_time = time.perf_counter()
+            try:
+                output = _runner(nlp_model, task, settings)(segment)
+            finally:
+                peak = sampler.stop()
+            controller.observe(len(segment), time.perf_counter() - start_time, peak / 1024 ** 2)
+            yield output
+    for old, new, reason in controller.changes:
+        print("Batch size {} -> {} ({})".format(old, new, reason))
+    if profile and store is not None and controller.rates:
+        best = max(controller.rates, key=controller.rates.get)
+        if best != profile["batch_size"] and controller.rates[best] > profile["sentences_per_s"]:
+            store.put(nlp_model, dict(profile, batch_size=best, sentences_per_s=controller.rates[best]), task)
+
+def _stanza_segments(iterator, nlp_model, settings, controller, segment_batches):
+    # Tags with the same worker processes for the whole run. The size of the
+    # next chunk is read from the controller when the chunk is built. The
+    # first segment includes starting the workers, so it is not observed.
+    from stanza_test import tag_chunks_st
+
+    def sized_chunks():
+        while True:
+            chunk = list(itertools.islice(iterator, controller.batch_size))
+            if not chunk:
+                return
+            yield chunk
+
+    segment = []
+    first = True
+    sampler = _RssSampler()
+    sampler.start()
+    start_time = time.perf_counter()
+    try:
+        for results in tag_chunks_st(sized_chunks(), nlp_model, settings["n_process"], settings.get("torch_threads")):
+            segment.extend(results)
+            if len(segment) >= controller.batch_size * settings["n_process"] * segment_batches:
+                peak = sampler.stop()
+                if not first:
+                    controller.observe(len(segment), time.perf_counter() - start_time, peak / 1024 ** 2)
+                first = False
+                yield segment
+                segment = []
+                sampler = _RssSampler()
+                sampler.start()
+                start_time = time.perf_counter()
+        if segment:
+            peak = sampler.stop()
+            if not first:
+                controller.observe(len(segment), time.perf_counter() - start_time, peak / 1024 ** 2)
+            yield segment
+    finally:
+        sampler.stop()
+
+def tag_adaptive(lang_sent, nlp_model, profile=None, rss_ceiling_mb=None, segment_batches=10, store=None):
+    """Tags sentences with tuned settings that are adjusted during the run.
+
+    Args:
+        lang_sent (Iterable[str]): The sentences.
+        nlp_model (Language or Pipeline): The tagging pipeline.
+        profile (dict): Settings from calibrate(). Defaults to the stored
+            profile of the pipeline, or a batch size of 512 in one process.
+        rss_ceiling_mb (float): The memory ceiling. Defaults to the one of
+            the profile.
+        segment_batches (int): Number of batches per process in a segment.
+            The batch size is adjusted between segments, except for spaCy
+            pipelines with more than one process.
+        store (ProfileStore): Where profiles are kept. If the run finds a
+            faster batch size, the profile is updated.
+
+    Yields:
+        tuple: ('Sentence.', [[start_char, end_char, 'LABEL']]) per sentence
+            in input order.
+
+    """
+
+    store = store or ProfileStore()
+    profile = profile or store.get(nlp_model, "tag")
+    for results in _adaptive(lang_sent, nlp_model, "tag", profile, rss_ceiling_mb, segment_batches, store):
+        yield from results
+
+def evaluate_adaptive(results, nlp_model, profile=None, rss_ceiling_mb=None, segment_batches=10, store=None):
+    """Evaluates tagging results with a batch size adjusted during the run.
+
+    Args:
+        results (Iterable[tuple]): Tagging results.
+        nlp_model (Language): The spaCy pipeline used for evaluation.
+        profile (dict): Settings from calibrate(task="evaluate"). Defaults
+            to the stored profile of the pipeline.
+        rss_ceiling_mb (float): The memory ceiling.
+        segment_batches (int): Number of batches per segment.
+        store (ProfileStore): Where profiles are kept.
+
+    Returns:
+        ScoreCounts: The counts of all results.
+
+    """
+
+    from scoring import ScoreCounts
+
+    store = store or ProfileStore()
+    profile = profile or store.get(nlp_model, "evaluate")
+    counts = ScoreCounts()
+    for segment_counts in _adaptive(results, nlp_model, "evaluate", profile, rss_ceiling_mb, segment_batches, store):
+        counts.merge(segment_counts)
+    return counts
+
+def main(argv=None):
+    from corpora import read_corpus
+
+    parser = argparse.ArgumentParser(description="Calibrates batch size and parallelism of a pipeline on this machine.")
+    parser.add_argument("--lang", default="de")
+    parser.add_argument("--pipeline", default="md", help="a key of TAGGERS or EVALUATORS, e.g. md, lg, multi or stanza")
+    parser.add_argument("--task", default="tag", choices=["tag", "evaluate"])
+    parser.add_argument("--tagger", default="md", help="tagger whose results are evaluated with --task evaluate")
+    parser.add_argument("--sample", type=int, default=3000)
+    parser.add_argument("--rss-ceiling-mb", type=float)
+    parser.add_argument("--store", default=PROFILES_PATH)
+    args = parser.parse_args(argv)
+
+    name = pipeline_name(args.pipeline, args.lang)
+    nlp_model = load(name, use_gpu=False) if name in STANZA_PIPELINES else load(name)
+    sample = list(read_corpus(args.lang, stop=args.sample))
+    if args.task == "evaluate":
+        tagger = pipeline_name(args.tagger, args.lang)
+        sample = _runner(load(tagger, use_gpu=False) if tagger in STANZA_PIPELINES else load(tagger), "tag", {"batch_size": 512, "n_process": 1})(sample)
+    profile = tuned(nlp_model, args.task, sample, args.rss_ceiling_mb, ProfileStore(args.store), recalibrate=True)
+    print("Best: batch_size {batch_size}, n_process {n_process}: {sentences_per_s:.1f} sentences/s, peak RSS {peak_rss_mb:.0f} MB".format(**profile))
+    print("Stored in", args.store)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""Groups sentences of similar length into batches.
+
+Neural NER pipelines pad every batch to its longest sentence. Tatoeba
+sentences range from two to several dozen tokens, so batches of randomly
+mixed lengths waste most of their compute on padding. The functions in this
+module read a window of sentences, sort it into length buckets, cut the
+buckets into batches with a token budget instead of a fixed number of
+sentences, and restore the input order after tagging.
+
+Requires "collections", "itertools", "math", and "re".
+
+Example:
+    results = run_bucketed(sentences, lambda batches: (tag(batch) for batch in batches), max_tokens=2048)
+
+Attributes:
+    TOKEN_PATTERN (Pattern): Approximates tokenization by words and single
+        punctuation marks. Only used to estimate sentence lengths.
+
+"""
+
+import collections
+import itertools
+import math
+import re
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+def chunks(items, chunk_size):
+    """Splits an iterable into lists of chunk_size items.
+
+    Args:
+        items (Iterable): The items. Can be a generator.
+        chunk_size (int): The number of items per chunk. The last chunk can
+            be shorter.
+
+    Yields:
+        list: The chunks.
+
+    """
+
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+def percentile(values, q):
+    """Returns the q-th percentile of a list of numbers (nearest rank).
+
+    Args:
+        values (list[float]): The numbers.
+        q (float): The percentile between 0 and 100.
+
+    Returns:
+        float: The percentile, or None for an empty list.
+
+    """
+
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+def token_length(sentence):
+    """Estimates the number of tokens of a sentence.
+
+    Args:
+        sentence (str): The sentence.
+
+    Returns:
+        int: The number of words and punctuation marks, at least 1.
+
+    """
+
+    return max(len(TOKEN_PATTERN.findall(sentence)), 1)
+
+def plan_batches(lengths, max_tokens, bucket_width=4):
+    """Groups sentence indices into batches of similar length.
+
+    Sentences are sorted by length and put into buckets of bucket_width
+    tokens. A batch never mixes buckets, and its padded size (number of
+    sentences times the longest sentence) stays within max_tokens. Sentences
+    longer than max_tokens get a batch of their own.
+
+    Args:
+        lengths (list[int]): The token length of every sentence.
+        max_tokens (int): Token budget of a batch, including padding.
+        bucket_width (int): Width of a length bucket in tokens.
+
+    Returns:
+        list[list[int]]: The batches as indices into lengths.
+
+    """
+
+    batches = []
+    batch = []
+    bucket = None
+    for i in sorted(range(len(lengths)), key=lengths.__getitem__):
+        length = lengths[i]
+        if batch and (length // bucket_width != bucket or (len(batch) + 1) * length > max_tokens):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+        bucket = length // bucket_width
+    if batch:
+        batches.append(batch)
+    return batches
+
+def run_bucketed(items, run_batches, max_tokens=4096, window=10000, bucket_width=4, key=None):
+    """Tags items in length-bucketed batches and yields them in input order.
+
+    run_batches is called only once with a lazy stream of batches, so a
+    process pool inside it is reused for all windows. Only the windows whose
+    batches are being tagged are held in memory.
+
+    Args:
+        items (Iterable): The sentences, or records that contain them.
+        run_batches (Callable): Takes an iterable of batches (lists of items)
+            and returns an iterable with one list of results per batch, in
+            the same order.
+        max_tokens (int): Token budget of a batch, including padding.
+        window (int): Number of items that are sorted into buckets together.
+        bucket_width (int): Width of a length bucket in tokens.
+        key (Callable): Returns the sentence of an item. Defaults to the item
+            itself.
+
+    Yields:
+        Any: One result per item in input order.
+
+    """
+
+    windows = collections.deque()  # [window items, plan, results, number of finished batches]
+
+    def batches():
+        for window_items in chunks(items, window):
+            lengths = [token_length(key(item) if key else item) for item in window_items]
+            plan = plan_batches(lengths, max_tokens, bucket_width)
+            windows.append([window_items, plan, [None] * len(window_items), 0])
+            for batch in plan:
+                yield [window_items[i] for i in batch]
+
+    for batch_result in run_batches(batches()):  # run_batches is called once, so worker pools persist across windows.
+        current = windows[0]
+        for i, result in zip(current[1][current[3]], batch_result):
+            current[2][i] = result
+        current[3] += 1
+        if current[3] == len(current[1]):
+            yield from windows.popleft()[2]
@@ -0,0 +1,212 @@
+"""Benchmarks tagging and evaluation for every tagger/evaluator combination.
+
+Unlike the time.process_time() deltas in results.py, the benchmark measures
+wall-clock time and separates loading, tagging and evaluation. Every
+combination of language, tagger and evaluator runs in a fresh process, so the
+peak resident set size and the load times are not influenced by pipelines of
+earlier combinations. The results are written as JSON and can be compared
+with a stored baseline to find regressions.
+
+Requires "argparse", "concurrent.futures", "json",
+"multiprocessing", "os", "platform", "resource", "sys", "time", "spacy", and
+"stanza".
+
+Example:
+    Run from the code directory::
+
+        python benchmark.py --sizes 1000 10000 --output bench.json
+        python benchmark.py --sizes 1000 --languages de --combinations md/lg stanza/lg --baseline bench.json
+
+Attributes:
+    RATE_KEYS (list[str]): Measurements that regress when they decrease.
+    COST_KEYS (list[str]): Measurements that regress when they increase.
+
+"""
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+
+from batching import chunks, percentile
+from corpora import read_corpus
+from models import COMBINATIONS, LANGUAGES, STANZA_PIPELINES, load, pipeline_name
+
+RATE_KEYS = ["tag_sentences_per_s", "eval_sentences_per_s"]
+COST_KEYS = ["tagger_load_s", "evaluator_load_s", "tag_batch_p99_s", "eval_batch_p99_s", "peak_rss_bytes"]
+
+def _timed_batches(batches, run):
+    latencies = []
+    outputs = []
+    for batch in batches:
+        start_time = time.perf_counter()
+        outputs.extend(run(batch))
+        latencies.append(time.perf_counter() - start_time)
+    return outputs, latencies
+
+def benchmark_combination(lang, tagger, evaluator, size, batch_size=1000):
+    """Benchmarks one combination in the current process.
+
+    Evaluation does not use the prediction cache, so it measures inference
+    of the evaluation pipeline.
+
+    Args:
+        lang (str): The language code, e.g. "de".
+        tagger (str): A key of TAGGERS, e.g. "md".
+        evaluator (str): A key of EVALUATORS, e.g. "lg".
+        size (int): Number of corpus sentences.
+        batch_size (int): Number of sentences per batch.
+
+    Returns:
+        dict: The configuration and the measurements of the combination.
+
+    """
+
+    from scoring import ScoreCounts, make_examples
+    from spacy_test import tag_sentences_sp
+    from stanza_test import tag_sentences_st
+
+    sentences = list(read_corpus(lang, stop=size))
+    tagger_name, evaluator_name = pipeline_name(tagger, lang), pipeline_name(evaluator, lang)
+
+    start_time = time.perf_counter()
+    tagger_model = load(tagger_name)
+    tagger_load = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    evaluator_model = load(evaluator_name)
+    evaluator_load = time.perf_counter() - start_time
+
+    if tagger_name in STANZA_PIPELINES:
+        tag = lambda batch: tag_sentences_st(batch, tagger_model, chunk_size=batch_size)
+    else:
+        tag = lambda batch: tag_sentences_sp(batch, tagger_model, batch_size=batch_size)
+    start_time = time.perf_counter()
+    results, tag_latencies = _timed_batches(chunks(sentences, batch_size), tag)
+    tag_time = time.perf_counter() - start_time
+
+    counts = ScoreCounts()
+
+    def evaluate(batch):
+        for example in make_examples(batch, evaluator_model, cache=False, batch_size=batch_size):
+            counts.add(example)
+        return batch
+
+    start_time = time.perf_counter()
+    _, eval_latencies = _timed_batches(chunks(results, batch_size), evaluate)
+    eval_time = time.perf_counter() - start_time
+    scores = counts.scores()
+
+    return {
+        "lang": lang,
+        "tagger": tagger,
+        "evaluator": evaluator,
+        "size": len(sentences),
+        "batch_size": batch_size,
+        "tagger_load_s": tagger_load,
+        "evaluator_load_s": evaluator_load,
+        "tag_s": tag_time,
+        "tag_sentences_per_s": len(sentences) / max(tag_time, 1e-9),
+        "tag_batch_p50_s": percentile(tag_latencies, 50),
+        "tag_batch_p99_s": percentile(tag_latencies, 99),
+        "eval_s": eval_time,
+        "eval_sentences_per_s": len(sentences) / max(eval_time, 1e-9),
+        "eval_batch_p50_s": percentile(eval_latencies, 50),
+        "eval_batch_p99_s": percentile(eval_latencies, 99),
+        "cpu_s": time.process_time(),
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+        "ents_p": scores["ents_p"],
+        "ents_r": scores["ents_r"],
+        "ents_f": scores["ents_f"],
+    }
+
+def run_benchmarks(languages, combinations, sizes, batch_size=1000):
+    """Benchmarks every combination in its own fresh process.
+
+    Args:
+        languages (list[str]): Language codes.
+        combinations (list[tuple]): (tagger, evaluator) pairs.
+        sizes (list[int]): Corpus sizes in sentences.
+        batch_size (int): Number of sentences per batch.
+
+    Returns:
+        dict: Information about the machine and a list of runs.
+
+    """
+
+    runs = []
+    context = multiprocessing.get_context("spawn")  # A fresh interpreter per combination.
+    for lang in languages:
+        for tagger, evaluator in combinations:
+            for size in sizes:
+                print("Benchmarking {} {}/{} on {} sentences...".format(lang, tagger, evaluator, size))
+                with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+                    run = executor.submit(benchmark_combination, lang, tagger, evaluator, size, batch_size).result()
+                print("  tagging {:.1f} sentences/s, evaluation {:.1f} sentences/s, peak RSS {:.0f} MB".format(
+                    run["tag_sentences_per_s"], run["eval_sentences_per_s"], run["peak_rss_bytes"] / 1024 ** 2))
+                runs.append(run)
+    machine = {"node": platform.node(), "processor": platform.processor(), "cpus": os.cpu_count(), "python": platform.python_version()}
+    return {"created": time.strftime("%Y-%m-%d %H:%M:%S"), "machine": machine, "runs": runs}
+
+def compare(current, baseline, tolerance=0.1):
+    """Finds regressions against a baseline.
+
+    Args:
+        current (dict): Output of run_benchmarks.
+        baseline (dict): An earlier output of run_benchmarks.
+        tolerance (float): Relative change that is still accepted.
+
+    Returns:
+        list[str]: One message per regression. Empty if there are none.
+
+    """
+
+    key = lambda run: (run["lang"], run["tagger"], run["evaluator"], run["size"])
+    previous = {key(run): run for run in baseline["runs"]}
+    regressions = []
+    for run in current["runs"]:
+        old = previous.get(key(run))
+        if old is None:
+            continue
+        for name in RATE_KEYS + COST_KEYS:
+            if old.get(name) is None or run.get(name) is None or old[name] == 0:
+                continue
+            change = (run[name] - old[name]) / old[name]
+            if (name in RATE_KEYS and change < -tolerance) or (name in COST_KEYS and change > tolerance):
+                regressions.append("{} {}/{} size {}: {} {:.4g} -> {:.4g} ({:+.1%})".format(
+                    *key(run), name, old[name], run[name], change))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks tagging and evaluation per language and pipeline.")
+    parser.add_argument("--languages", nargs="+", default=list(LANGUAGES), choices=list(LANGUAGES))
+    parser.add_argument("--combinations", nargs="+", default=["/".join(c) for c in COMBINATIONS],
+                        help="tagger/evaluator pairs, e.g. md/lg stanza/multi")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1000])
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--baseline", help="earlier output to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    combinations = [tuple(c.split("/")) for c in args.combinations]
+    results = run_benchmarks(args.languages, combinations, args.sizes, args.batch_size)
+    with open(args.output, "w", encoding="utf-8") as output:
+        json.dump(results, output, indent=1)
+    print("Benchmark written to", args.output)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline:
+            regressions = compare(results, json.load(baseline), args.tolerance)
+        for regression in regressions:
+            print("Regression:", regression)
+        if regressions:
+            return 1
+        print("No regressions.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,445 @@
+"""Caches predictions of the tagging and evaluation pipelines on disk.
+
+evaluate_ner_sp and evaluate_ner_st compare the tagging results against the
+predictions of a (usually large) spaCy pipeline. Those predictions only depend
+on the pipeline and the sentence, so they are computed once in batches and
+stored in an SQLite file. Later evaluations against the same pipeline rebuild
+the predicted Doc objects from the cache and only compare the spans.
+
+Entries are keyed by model name, model version and sentence hash. When the
+cache grows beyond its size limit, the least recently used entries are
+evicted. The most recently used entries are also kept in memory, and the
+cache counts its hits and misses.
+
+The entities found by the tagging functions are cached as well, keyed by
+pipeline name, version, a hash of the component configuration and the hash
+of the NFC-normalized sentence. Tatoeba contains many repeated sentences, and
+retagging a corpus after a configuration change only tags sentences that were
+not tagged with the same pipeline before. Sentences that NFC normalization
+changes are never cached, because their character offsets could differ.
+
+Requires "collections", "hashlib", "json", "os", "sqlite3", "time",
+"unicodedata", and "spacy".
+
+Example:
+    cache = DiskCache(max_bytes=256 * 1024 ** 2)
+    docs = predict_reference(["I like London."], nlp_en3, cache=cache)
+    results = list(tag_sentences_sp(read_corpus("de"), nlp_de2, cache=cache))
+    print(cache.stats())
+
+Attributes:
+    DEFAULT_CACHE_DIR (str): Directory of the default cache file. Can be set
+        with the environment variable NER_CACHE_DIR.
+    DEFAULT_MAX_BYTES (int): Default size limit of a cache in bytes.
+    DEFAULT_MEMORY_ITEMS (int): Default number of entries kept in memory.
+
+"""
+
+import collections
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import unicodedata
+
+from spacy.tokens import Doc, Span
+
+from batching import chunks
+
+DEFAULT_CACHE_DIR = os.environ.get("NER_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "ner_tatoeba"))
+DEFAULT_MAX_BYTES = 1024 ** 3
+DEFAULT_MEMORY_ITEMS = 100000
+
+_default_cache = None
+
+def sentence_hash(sentence):
+    """Hashes a sentence.
+
+    Args:
+        sentence (str): The sentence.
+
+    Returns:
+        str: The SHA-1 hex digest of the UTF-8 encoded sentence.
+
+    """
+
+    return hashlib.sha1(str(sentence).encode("utf-8")).hexdigest()
+
+def model_fingerprint(nlp_model):
+    """Identifies a spaCy or Stanza pipeline by name and version.
+
+    Args:
+        nlp_model (Language or Pipeline): A spaCy or Stanza pipeline, or the
+            language code of a Stanza pipeline.
+
+    Returns:
+        str: The fingerprint in the format "de_core_news_lg@3.4.0" or
+            "stanza_de@1.4.1:tokenize,ner" ("+int8" for quantized
+            pipelines).
+
+    """
+
+    if isinstance(nlp_model, str):  # Language code of a Stanza pipeline.
+        return "stanza_{}".format(nlp_model)
+    if not hasattr(nlp_model, "meta"):  # Stanza pipeline.
+        import stanza
+        return "stanza_{}@{}:{}{}".format(nlp_model.lang, stanza.__version__, ",".join(nlp_model.processors),
+                                          "+int8" if getattr(nlp_model, "quantized", False) else "")
+    meta = nlp_model.meta
+    return "{}_{}@{}".format(meta.get("lang"), meta.get("name"), meta.get("version"))
+
+def pipeline_key(nlp_model):
+    """Identifies a pipeline by name, version and component configuration.
+
+    Args:
+        nlp_model (Language or Pipeline): A spaCy or Stanza pipeline, or the
+            language code of a Stanza pipeline.
+
+    Returns:
+        str: The fingerprint followed by a hash of the configuration of the
+            enabled components, e.g. "de_core_news_md@3.4.0#1f2e3d4c5b6a".
+
+    """
+
+    if isinstance(nlp_model, str):
+        config = {}
+    elif hasattr(nlp_model, "meta"):  # spaCy pipeline.
+        config = {name: nlp_model.config["components"].get(name) for name in nlp_model.pipe_names}
+    else:
+        config = getattr(nlp_model, "config", {})
+    digest = hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:12]
+    return "{}#{}".format(model_fingerprint(nlp_model), digest)
+
+def normalized_hash(sentence):
+    """Hashes a sentence for the tagging cache.
+
+    Args:
+        sentence (str): The sentence.
+
+    Returns:
+        str: The hash of the NFC-normalized sentence, or None if
+            normalization changes the sentence, which is then not cached.
+
+    """
+
+    sentence = str(sentence)
+    if not unicodedata.is_normalized("NFC", sentence):
+        return None
+    return sentence_hash(sentence)
+
+class DiskCache:
+    """Size-bounded key-value store in an SQLite file.
+
+    Values are stored as JSON. Every entry belongs to a namespace, e.g. the
+    fingerprint of the pipeline that produced it. The memory_items most
+    recently used entries are also kept in memory in front of the file.
+
+    Args:
+        path (str): Path of the SQLite file. Defaults to
+            DEFAULT_CACHE_DIR/predictions.sqlite.
+        max_bytes (int): Size limit of all stored values in bytes.
+        memory_items (int): Number of entries kept in memory. 0 disables the
+            memory cache.
+
+    Attributes:
+        hits (int): Number of keys found, in memory or in the file.
+        memory_hits (int): Number of keys found in memory.
+        misses (int): Number of keys not found.
+
+    """
+
+    def __init__(self, path=None, max_bytes=DEFAULT_MAX_BYTES, memory_items=DEFAULT_MEMORY_ITEMS):
+        if path is None:
+            path = os.path.join(DEFAULT_CACHE_DIR, "predictions.sqlite")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.memory_items = memory_items
+        self.hits = self.memory_hits = self.misses = 0
+        self._memory = collections.OrderedDict()
+        self._db = sqlite3.connect(path, timeout=60)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries (namespace TEXT, key TEXT, value TEXT, "
+            "size INTEGER, accessed REAL, PRIMARY KEY (namespace, key))")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        self._db.commit()
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def get_many(self, namespace, keys):
+        """Looks up several keys at once.
+
+        Args:
+            namespace (str): The namespace of the keys.
+            keys (list[str]): The keys.
+
+        Returns:
+            dict: The decoded values of all keys that were found.
+
+        """
+
+        found = {}
+        keys = list(keys)
+        for key in keys:
+            value = self._memory.get((namespace, key))
+            if value is not None:
+                self._memory.move_to_end((namespace, key))
+                found[key] = value
+        self.memory_hits += len(found)
+        keys = [key for key in keys if key not in found]
+        on_disk = {}
+        for i in range(0, len(keys), 500):  # SQLite limits the number of query parameters.
+            chunk = keys[i:i + 500]
+            rows = self._db.execute(
+                "SELECT key, value FROM entries WHERE namespace = ? AND key IN ({})".format(",".join("?" * len(chunk))),
+                [namespace] + chunk)
+            for key, value in rows:
+                on_disk[key] = json.loads(value)
+        if on_disk:
+            now = time.time()
+            self._db.executemany(
+                "UPDATE entries SET accessed = ? WHERE namespace = ? AND key = ?",
+                [(now, namespace, key) for key in on_disk])
+            self._db.commit()
+            self._remember(namespace, on_disk)
+        found.update(on_disk)
+        self.hits += len(found)
+        self.misses += len(keys) - len(on_disk)
+        return found
+
+    def _remember(self, namespace, items):
+        if not self.memory_items:
+            return
+        for key, value in items.items():
+            self._memory[(namespace, key)] = value
+            self._memory.move_to_end((namespace, key))
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def put_many(self, namespace, items):
+        """Stores several values at once and evicts old entries if needed.
+
+        Args:
+            namespace (str): The namespace of the keys.
+            items (dict): Keys and JSON-serializable values.
+
+        """
+
+        now = time.time()
+        rows = []
+        for key, value in items.items():
+            encoded = json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+            rows.append((namespace, key, encoded, len(encoded), now))
+        self._db.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)", rows)
+        self._db.commit()
+        self._size += sum(row[3] for row in rows)
+        self._remember(namespace, items)
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the cache is below 90% of its size limit."""
+
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        target = self._size - int(self.max_bytes * 0.9)
+        if target <= 0:
+            return
+        freed = 0
+        rowids = []
+        for rowid, size in self._db.execute("SELECT rowid, size FROM entries ORDER BY accessed"):
+            rowids.append((rowid,))
+            freed += size
+            if freed >= target:
+                break
+        self._db.executemany("DELETE FROM entries WHERE rowid = ?", rowids)
+        self._db.commit()
+        self._size -= freed
+        self._memory.clear()  # Evicted entries must not be served from memory.
+
+    def clear(self):
+        """Removes all entries."""
+
+        self._db.execute("DELETE FROM entries")
+        self._db.commit()
+        self._size = 0
+        self._memory.clear()
+
+    def stats(self):
+        """Returns the hit and miss counts and the size of the cache.
+
+        Returns:
+            dict: hits, memory_hits, misses, hit_rate, entries and bytes.
+
+        """
+
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "memory_hits": self.memory_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "entries": len(self),
+            "bytes": self._size,
+        }
+
+    def close(self):
+        self._db.close()
+
+def get_default_cache():
+    """Returns the shared default cache and creates it on first use.
+
+    Returns:
+        DiskCache: The cache in DEFAULT_CACHE_DIR.
+
+    """
+
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = DiskCache()
+    return _default_cache
+
+def doc_to_entry(doc):
+    """Serializes the tokens and entities of a predicted Doc.
+
+    Args:
+        doc (Doc): A Doc predicted by a spaCy pipeline.
+
+    Returns:
+        dict: The words, trailing spaces and entities as token offsets.
+
+    """
+
+    return {
+        "words": [token.text for token in doc],
+        "spaces": [bool(token.whitespace_) for token in doc],
+        "ents": [[ent.start, ent.end, ent.label_] for ent in doc.ents],
+    }
+
+def entry_to_doc(entry, vocab):
+    """Rebuilds a predicted Doc from a cache entry.
+
+    Args:
+        entry (dict): The entry created by doc_to_entry.
+        vocab (Vocab): The vocabulary of the evaluation pipeline.
+
+    Returns:
+        Doc: A Doc with the same text, tokens and entities as the prediction.
+
+    """
+
+    doc = Doc(vocab, words=entry["words"], spaces=entry["spaces"])
+    doc.ents = [Span(doc, start, end, label=label) for start, end, label in entry["ents"]]
+    return doc
+
+def predict_reference(sentences, nlp_model, cache=None, batch_size=1000):
+    """Predicts named entities with the evaluation pipeline, using the cache.
+
+    Only sentences that are not cached yet are passed to the pipeline, in
+    batches with Language.pipe. Their predictions are added to the cache.
+
+    Args:
+        sentences (Iterable[str or Doc]): The sentences. Unannotated Docs
+            are used as they are instead of tokenizing the text.
+        nlp_model (Language): The spaCy pipeline used for evaluation.
+        cache (DiskCache): The cache. If None, the default cache is used. If
+            False, nothing is cached.
+        batch_size (int): Number of sentences per batch.
+
+    Yields:
+        Doc: One predicted Doc per sentence in input order.
+
+    """
+
+    if cache is None:
+        cache = get_default_cache()
+    if cache is False:
+        yield from nlp_model.pipe((s if isinstance(s, Doc) else str(s) for s in sentences), batch_size=batch_size)
+        return
+    namespace = model_fingerprint(nlp_model)
+    batch = []
+    for sentence in sentences:
+        batch.append(sentence if isinstance(sentence, Doc) else str(sentence))
+        if len(batch) == batch_size:
+            yield from _predict_batch(batch, nlp_model, cache, namespace)
+            batch = []
+    if batch:
+        yield from _predict_batch(batch, nlp_model, cache, namespace)
+
+def _predict_batch(batch, nlp_model, cache, namespace):
+    keys = [sentence_hash(sentence) for sentence in batch]
+    found = cache.get_many(namespace, set(keys))
+    missing = [i for i, key in enumerate(keys) if key not in found]
+    predicted = {}
+    if missing:
+        docs = nlp_model.pipe([batch[i] for i in missing], batch_size=len(missing))
+        for i, doc in zip(missing, docs):
+            predicted[i] = doc
+        cache.put_many(namespace, {keys[i]: doc_to_entry(doc) for i, doc in predicted.items()})
+    for i, key in enumerate(keys):
+        if i in predicted:
+            yield predicted[i]
+        else:
+            yield entry_to_doc(found[key], nlp_model.vocab)
+
+def tag_cached(lang_sent, nlp_model, tag, cache=None, batch_size=1000, with_ids=False):
+    """Tags sentences, looking up their entities in the cache first.
+
+    The cache is queried for every batch of batch_size sentences. Only the
+    sentences that are not cached are passed to tag, all in one call, so a
+    pipeline with worker processes is started once. The results are yielded
+    in input order and are the same as without cache.
+
+    Args:
+        lang_sent (Iterable[str]): The sentences, or (sentence id, sentence)
+            tuples if with_ids is True.
+        nlp_model (Language or Pipeline): The tagging pipeline, used for the
+            cache key.
+        tag (Callable): Takes an iterable of sentences and yields one
+            ('Sentence.', [[start_char, end_char, 'LABEL']]) per sentence in
+            order, e.g. tag_sentences_sp with its pipeline.
+        cache (DiskCache): The cache. If None, the default cache is used.
+        batch_size (int): Number of sentences per cache lookup and write.
+        with_ids (bool): Whether lang_sent contains (sentence id, sentence)
+            tuples.
+
+    Yields:
+        tuple: ('Sentence.', [[...]]) or (id, 'Sentence.', [[...]]) per
+            sentence in input order.
+
+    """
+
+    if cache is None:
+        cache = get_default_cache()
+    namespace = "ents:" + pipeline_key(nlp_model)
+    pending = collections.deque()  # [record, key, entities] in input order; entities is None until tagged.
+    new_entries = {}
+
+    def misses():
+        for batch in chunks(lang_sent, batch_size):
+            keys = [normalized_hash(record[1] if with_ids else record) for record in batch]
+            found = cache.get_many(namespace, {key for key in keys if key is not None})
+            for record, key in zip(batch, keys):
+                pending.append([record, key, found.get(key)])
+                if key not in found:
+                    yield str(record[1] if with_ids else record)
+
+    def result(record, entities):
+        return (record[0], str(record[1]), entities) if with_ids else (str(record), entities)
+
+    for _, entities in tag(misses()):
+        while pending[0][2] is not None:
+            yield result(*pending.popleft()[::2])
+        record, key, _ = pending.popleft()
+        if key is not None:
+            new_entries[key] = entities
+            if len(new_entries) >= batch_size:
+                cache.put_many(namespace, new_entries)
+                new_entries = {}
+        yield result(record, entities)
+    while pending:
+        yield result(*pending.popleft()[::2])
+    if new_entries:
+        cache.put_many(namespace, new_entries)
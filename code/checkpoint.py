@@ -0,0 +1,223 @@
+"""Checkpoints long tagging and evaluation runs so they can be resumed.
+
+A RunJournal is an append-only JSON Lines file. After every completed batch,
+the corpus position reached so far is appended together with the batch's
+tagging results or the evaluation counts up to that point, and the file is
+synced to disk. Running the same configuration again reads the journal,
+skips the sentences that were already committed and continues after the last
+committed batch. A batch that was being written during a crash is ignored.
+
+The journal name and configuration do not identify the corpus or its slice,
+so every record also holds a digest of the batch's input. A resumed run
+checks the committed part of its input against these digests and refuses to
+continue a journal of different sentences.
+
+Requires "collections", "hashlib", "itertools", "json", and "os".
+
+Example:
+    results = named_entity_recognition_sp(read_corpus("de"), load("nlp_de2"), checkpoint="ger_sp_nlp_de2")
+    scores = evaluate_ner_sp(results, load("nlp_de3"), checkpoint="ger_sp_nlp_de2_eval")
+
+Attributes:
+    CHECKPOINT_DIR (str): Directory of the journals. Can be set with the
+        environment variable NER_CHECKPOINT_DIR.
+
+"""
+
+import collections
+import hashlib
+import itertools
+import json
+import os
+
+from batching import chunks
+
+CHECKPOINT_DIR = os.environ.get("NER_CHECKPOINT_DIR", r"./checkpoints")
+
+class RunJournal:
+    """Append-only journal of the committed batches of one run.
+
+    Args:
+        name (str): Name of the run, e.g. "ger_sp_nlp_de2".
+        config (dict): Everything that determines the results, e.g. task and
+            pipeline. A different configuration gets a different journal.
+        directory (str): Directory of the journal file.
+
+    Attributes:
+        path (str): The journal file, named after the run and a hash of
+            config.
+        position (int): Number of input sentences committed so far.
+
+    """
+
+    def __init__(self, name, config, directory=CHECKPOINT_DIR):
+        os.makedirs(directory, exist_ok=True)
+        digest = hashlib.sha1(json.dumps(config, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+        self.path = os.path.join(directory, "{}-{}.jsonl".format(name, digest))
+        self.config = config
+        self.position = 0
+        self._committed_bytes = 0
+        if os.path.exists(self.path):
+            for record in self.records():
+                self.position = record["position"]
+        with open(self.path, "ab") as journal:
+            journal.truncate(self._committed_bytes)  # Drop a batch that was only partly written.
+
+    def records(self):
+        """Yields the committed records in order.
+
+        Yields:
+            dict: A record with the corpus position and the batch data.
+
+        """
+
+        if not os.path.exists(self.path):
+            return
+        offset = 0
+        with open(self.path, "rb") as journal:
+            for line in journal:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                offset += len(line)
+                self._committed_bytes = offset
+                yield record
+
+    def commit(self, position, **data):
+        """Appends a completed batch and syncs it to disk.
+
+        Args:
+            position (int): The corpus position after the batch.
+            **data: The JSON-serializable batch data.
+
+        """
+
+        line = json.dumps(dict(data, position=position), ensure_ascii=False) + "\n"
+        with open(self.path, "ab") as journal:
+            journal.write(line.encode("utf-8"))
+            journal.flush()
+            os.fsync(journal.fileno())
+        self.position = position
+        self._committed_bytes += len(line.encode("utf-8"))
+
+    def remove(self):
+        """Deletes the journal, e.g. to start the run from scratch."""
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.position = 0
+        self._committed_bytes = 0
+
+    def verify(self, inputs):
+        """Checks that the committed batches were made from these inputs.
+
+        Consumes as many items of inputs as the journal has committed.
+
+        Args:
+            inputs (Iterator): The input of the run, from its start.
+
+        Raises:
+            ValueError: If the input differs from the committed one, e.g.
+                because the checkpoint name is reused for another corpus or
+                slice.
+
+        """
+
+        start = 0
+        for record in self.records():
+            batch = list(itertools.islice(inputs, record["position"] - start))
+            if "inputs" in record and (len(batch) != record["position"] - start or input_digest(batch) != record["inputs"]):
+                raise ValueError("The input of {} differs from the committed input at sentences {}-{}. Use another "
+                                 "checkpoint name or remove the journal.".format(self.path, start, record["position"]))
+            start = record["position"]
+
+def input_digest(items):
+    """Returns a short hash of the input items of a batch."""
+
+    data = json.dumps(list(items), ensure_ascii=False, default=str)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()[:16]
+
+def _recorded(items, pending):
+    for item in items:
+        pending.append(item)
+        yield item
+
+def resume_tagging(lang_sent, tag, journal, batch_size=1000):
+    """Tags sentences and commits every batch to a journal.
+
+    The results of committed batches are read from the journal, and only the
+    remaining sentences are tagged.
+
+    Args:
+        lang_sent (Iterable[str]): All sentences of the run, including the
+            committed ones.
+        tag (Callable): Takes an iterable of sentences and yields one result
+            per sentence in order, e.g. tag_sentences_sp with its pipeline.
+        journal (RunJournal): The journal of the run.
+        batch_size (int): Number of sentences per committed batch.
+
+    Yields:
+        tuple: The results of all sentences in input order.
+
+    Raises:
+        ValueError: If lang_sent differs from the committed input.
+
+    """
+
+    inputs = iter(lang_sent)
+    journal.verify(inputs)
+    for record in journal.records():
+        for result in record["results"]:
+            yield tuple(result)
+    pending = collections.deque()  # Inputs of the results that are not committed yet.
+    for batch in chunks(tag(_recorded(inputs, pending)), batch_size):
+        batch_inputs = [pending.popleft() for _ in batch]
+        journal.commit(journal.position + len(batch), results=batch, inputs=input_digest(batch_inputs))
+        yield from batch
+
+def resume_evaluation(results, make_examples, journal, batch_size=1000, callback=None):
+    """Counts the scores of tagging results and commits them after every batch.
+
+    Every record holds the counts up to its position, so a resumed run starts
+    from the counts of the last committed batch and gives exactly the same
+    scores as an uninterrupted run.
+
+    Args:
+        results (Iterable[tuple]): The tagging results of the run, including
+            the committed ones.
+        make_examples (Callable): Takes an iterable of tagging results and
+            yields one Example per result, e.g. scoring.make_examples with
+            the evaluation pipeline. Only called for the remaining results.
+        journal (RunJournal): The journal of the run.
+        batch_size (int): Number of results per committed batch.
+        callback (Callable): Called as callback(counts, position) after
+            every committed batch, e.g. to print counts.snapshot().
+
+    Returns:
+        ScoreCounts: The counts of all results.
+
+    Raises:
+        ValueError: If results differ from the committed input.
+
+    """
+
+    from scoring import ScoreCounts, score_examples  # Imported here, so tagging journals do not need spaCy.
+
+    inputs = iter(results)
+    journal.verify(inputs)
+    counts = ScoreCounts()
+    for record in journal.records():
+        counts = ScoreCounts.from_dict(record["counts"])
+    start = journal.position
+    pending = collections.deque()  # Results that are not committed yet.
+
+    def commit(counts, n):
+        batch_inputs = [pending.popleft() for _ in range(start + n - journal.position)]
+        journal.commit(start + n, counts=counts.to_dict(), inputs=input_digest(batch_inputs))
+        if callback is not None:
+            callback(counts, start + n)
+
+    return score_examples(make_examples(_recorded(inputs, pending)), counts, batch_size, commit)
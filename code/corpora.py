@@ -1,57 +1,165 @@
-"""Exports a list of sentences from a corpus file per language.
+"""Reads the sentences of a corpus file per language.
 
-Opens the three corpus.tsv files (e.g. deu_sentences.tsv) used in this project
-and strips them of their index numbering and language tags before appending
-every sentence in the corpus to an empty list. Do not do anything but execute
-this module.
+Reads the three corpus files (e.g. deu_sentences.tsv) used in this project
+lazily and strips them of their index numbering and language tags. The
+sentences are yielded one at a time, so memory stays bounded regardless of the
+corpus size. The files can be plain (.tsv) or compressed (.tsv.bz2, .tsv.gz);
+compressed files do not have to be unzipped.
 
-Requires "csv".
+Requires "bz2", "csv", "gzip", "io", "itertools", and "os".
+
+Example:
+    for sentence in read_corpus("de", stop=10):
+        print(sentence)
+
+    ger_first = list(read_corpus("de", stop=163111))  # Replaces ger_sent[:163111].
+
+    for sentence_id, lang, sentence in read_records("./sentences.tsv.bz2", stop=10):
+        print(sentence_id, lang, sentence)  # A mixed-language file, see router.py.
+
+    For random access by line or Tatoeba id, see corpus_index.py.
 
 Attributes:
-    ger_sent (list): Final list of German sentences.
-    eng_sent (list): Final list of English sentences.
-    nld_sent (list): Final list of Dutch sentences.
-    german (TextIOWrapper): The German .tsv file, unchanged.
-    tsv__ger_file (_reader): An iterable reader object of the original German
-        .tsv file.
-    ger_removed (list[str]): List of German sentences without index numbers or
-        language tags.
-    english (TextIOWrapper): The English .tsv file, unchanged.
-    tsv__eng_file (_reader): An iterable reader object of the original English
-        .tsv file.
-    eng_removed (list[str]): List of English sentences without index numbers
-        or language tags.
-    dutch (TextIOWrapper): The Dutch .tsv file, unchanged.
-    tsv__nld_file (_reader): An iterable reader object of the original Dutch
-        .tsv file.
+    CORPUS_FILES (dict): File names of the corpus files by language code,
+        without extension.
+    EXTENSIONS (list[str]): Supported file extensions, in order of preference.
+    CORPUS_DIRS (list[str]): Directories that are searched for the corpus
+        files. The environment variable NER_CORPUS_DIR is searched first.
+    READ_BUFFER (int): Number of bytes read from a corpus file at once.
+    TATOEBA_LANGUAGES (dict): The language codes of this project by Tatoeba
+        language tag.
+    ger_sent (list): All German sentences. Only read if accessed, use
+        read_corpus("de") instead.
+    eng_sent (list): All English sentences. Only read if accessed, use
+        read_corpus("en") instead.
+    nld_sent (list): All Dutch sentences. Only read if accessed, use
+        read_corpus("nl") instead.
 
 """
 
+import bz2
 import csv
+import gzip
+import io
+import itertools
+import os
+
+CORPUS_FILES = {"de": "deu_sentences", "en": "eng_sentences", "nl": "nld_sentences"}
+
+EXTENSIONS = [".tsv", ".tsv.bz2", ".tsv.gz"]
+
+_module_dir = os.path.dirname(os.path.abspath(__file__))
+CORPUS_DIRS = [d for d in (os.environ.get("NER_CORPUS_DIR"), ".", _module_dir, os.path.dirname(_module_dir)) if d]
+
+READ_BUFFER = 1024 ** 2
+
+TATOEBA_LANGUAGES = {"deu": "de", "eng": "en", "nld": "nl"}
+
+_LEGACY_LISTS = {"ger_sent": "de", "eng_sent": "en", "nld_sent": "nl"}
+
+def find_corpus(lang):
+    """Finds the corpus file of a language.
+
+    Args:
+        lang (str): A language code from CORPUS_FILES or the path of a
+            corpus file.
+
+    Returns:
+        str: The path of the corpus file.
+
+    Raises:
+        FileNotFoundError: No corpus file was found in CORPUS_DIRS.
+
+    """
+
+    if lang not in CORPUS_FILES:
+        if os.path.exists(lang):
+            return lang
+        raise FileNotFoundError("No corpus file {!r}.".format(lang))
+    for directory in CORPUS_DIRS:
+        for extension in EXTENSIONS:
+            path = os.path.join(directory, CORPUS_FILES[lang] + extension)
+            if os.path.exists(path):
+                return path
+    raise FileNotFoundError("No corpus file {}{{{}}} in {}. Set NER_CORPUS_DIR to the directory of the corpus files.".format(
+        CORPUS_FILES[lang], ",".join(EXTENSIONS), ", ".join(CORPUS_DIRS)))
+
+def open_corpus(path):
+    """Opens a plain or compressed corpus file for reading.
+
+    Args:
+        path (str): Path of a .tsv, .tsv.bz2 or .tsv.gz file.
+
+    Returns:
+        TextIOWrapper: The decoded text of the file.
+
+    """
+
+    if path.endswith(".bz2"):
+        raw = bz2.BZ2File(path)
+    elif path.endswith(".gz"):
+        raw = gzip.GzipFile(path)
+    else:
+        raw = io.FileIO(path)
+    return io.TextIOWrapper(io.BufferedReader(raw, buffer_size=READ_BUFFER), encoding="utf-8", newline="")
+
+def read_corpus(lang, start=0, stop=None, step=1, with_ids=False):
+    """Yields the sentences of a corpus file.
+
+    The slice is applied while reading, so read_corpus("de", stop=163111)
+    yields the same sentences as ger_sent[:163111] without building the list.
+
+    Args:
+        lang (str): A language code from CORPUS_FILES ("de", "en", "nl") or
+            the path of a corpus file.
+        start (int): Index of the first sentence.
+        stop (int): Index after the last sentence. None reads to the end.
+        step (int): Only every step-th sentence is yielded.
+        with_ids (bool): Whether to yield the Tatoeba sentence id as well.
+
+    Yields:
+        str: The sentences without index number and language tag. If with_ids
+            is True, tuples of (Tatoeba sentence id, sentence) instead.
+
+    """
+
+    with open_corpus(find_corpus(lang)) as corpus:
+        tsv_file = csv.reader(corpus, delimiter="\t")
+        if with_ids:
+            sentences = ((int(line[0]), sentence) for line in tsv_file for sentence in line[2:])
+        else:
+            sentences = (sentence for line in tsv_file for sentence in line[2:])  # Remove index number and language tag from list.
+        yield from itertools.islice(sentences, start, stop, step)
+
+def read_records(lang, start=0, stop=None, step=1):
+    """Yields the sentences of a corpus file with their id and language.
+
+    Unlike read_corpus, the language tag is kept, so files with sentences in
+    several languages (e.g. Tatoeba's sentences.tsv) can be read.
+
+    Args:
+        lang (str): A language code from CORPUS_FILES or the path of a
+            corpus file.
+        start (int): Index of the first sentence.
+        stop (int): Index after the last sentence. None reads to the end.
+        step (int): Only every step-th sentence is yielded.
+
+    Yields:
+        tuple: (Tatoeba sentence id, language code, sentence). Tags in
+            TATOEBA_LANGUAGES are translated (e.g. "deu" to "de"), other tags
+            are kept.
+
+    """
+
+    with open_corpus(find_corpus(lang)) as corpus:
+        tsv_file = csv.reader(corpus, delimiter="\t")
+        records = ((int(line[0]), TATOEBA_LANGUAGES.get(line[1], line[1]), sentence) for line in tsv_file for sentence in line[2:])
+        yield from itertools.islice(records, start, stop, step)
+
+def __getattr__(name):
+    """Reads ger_sent, eng_sent and nld_sent completely on first access."""
 
-ger_sent = []
-eng_sent = []
-nld_sent = []
-
-with open(r"./deu_sentences.tsv", encoding="utf-8") as german:  # Put in the file path. If you get a FileNotFoundError please put in the absolute path.
-    tsv__ger_file = csv.reader(german, delimiter="\t")
-    for line_ger in tsv__ger_file:
-        ger_removed = line_ger[2:]  # Remove index number and language tag from list.
-        ger_sent.extend(ger_removed)
-    #print(len(ger_sent))
-
-with open(r"./eng_sentences.tsv", encoding="utf-8") as english:
-    tsv__eng_file = csv.reader(english, delimiter="\t")
-    for line_eng in tsv__eng_file:
-        eng_removed = line_eng[2:]  # Remove index number and language tag from list.
-        eng_sent.extend(eng_removed)
-    #print(len(eng_sent))
-
-with open(r"./nld_sentences.tsv", encoding="utf-8") as dutch:
-    tsv__nld_file = csv.reader(dutch, delimiter="\t")
-    for line_nld in tsv__nld_file:
-        nld_removed = line_nld[2:]  # Remove index number and language tag from list.
-        nld_sent.extend(nld_removed)
-    #print(len(nld_sent))
-
-print("All corpus files successfully read.")
+    if name in _LEGACY_LISTS:
+        globals()[name] = list(read_corpus(_LEGACY_LISTS[name]))
+        return globals()[name]
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
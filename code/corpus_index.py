@@ -0,0 +1,246 @@
+"""Indexes the lines of a corpus file for random access.
+
+Builds a sidecar index for a Tatoeba corpus file once: a NumPy array with the
+sentence id and the byte offset of every line. The index is memory-mapped, so
+sentence N is read with a single seek, and samples or shards of the corpus can
+be read without parsing the lines before them. Compressed corpus files are
+extracted next to the original file once, because compressed streams cannot be
+seeked efficiently.
+
+Requires "bz2", "csv", "gzip", "os", "shutil", and "numpy".
+
+Example:
+    index = CorpusIndex(find_corpus("nl"))
+    print(index.sentence(0), index.by_id(5946))
+    for sentence_id, sentence in index.records(*index.shards(4)[2]):
+        print(sentence_id, sentence)
+
+Attributes:
+    INDEX_DTYPE (dtype): Layout of one index row: the Tatoeba sentence id and
+        the byte offset of the line. The last row has the id -1 and the size
+        of the corpus file as offset.
+
+"""
+
+import bz2
+import csv
+import gzip
+import os
+import shutil
+
+import numpy as np
+
+from corpora import READ_BUFFER
+
+INDEX_DTYPE = np.dtype([("id", "<i8"), ("offset", "<i8")])
+
+def plain_corpus(path):
+    """Returns an uncompressed version of a corpus file.
+
+    Args:
+        path (str): Path of a .tsv, .tsv.bz2 or .tsv.gz file.
+
+    Returns:
+        str: The path of the .tsv file. Compressed files are extracted next
+            to the original file if the .tsv file does not exist yet.
+
+    """
+
+    for extension, opener in ((".bz2", bz2.open), (".gz", gzip.open)):
+        if path.endswith(extension):
+            plain = path[:-len(extension)]
+            if not os.path.exists(plain):
+                temporary = "{}.{}.part".format(plain, os.getpid())  # Processes that extract at the same time do not share the file.
+                with opener(path, "rb") as compressed, open(temporary, "wb") as extracted:
+                    shutil.copyfileobj(compressed, extracted, READ_BUFFER)
+                os.replace(temporary, plain)
+            return plain
+    return path
+
+def build_index(path):
+    """Builds the index of a plain corpus file.
+
+    Args:
+        path (str): Path of a .tsv file.
+
+    Returns:
+        str: The path of the index file (path + ".idx.npy").
+
+    """
+
+    ids = []
+    offsets = []
+    offset = 0
+    with open(path, "rb", buffering=READ_BUFFER) as corpus:
+        for line in corpus:
+            if line.strip():
+                ids.append(int(line.split(b"\t", 1)[0]))
+                offsets.append(offset)
+            offset += len(line)
+    index = np.empty(len(ids) + 1, dtype=INDEX_DTYPE)
+    index["id"][:-1] = ids
+    index["offset"][:-1] = offsets
+    index[-1] = (-1, offset)
+    index_path = path + ".idx.npy"
+    temporary = "{}.{}.part".format(index_path, os.getpid())
+    with open(temporary, "wb") as index_file:
+        np.save(index_file, index)
+    os.replace(temporary, index_path)
+    return index_path
+
+def _parse(line):
+    fields = next(csv.reader([line.decode("utf-8").rstrip("\r\n")], delimiter="\t"))
+    return int(fields[0]), "\t".join(fields[2:])  # Remove index number and language tag.
+
+class CorpusIndex:
+    """Random access to the sentences of a corpus file.
+
+    The index is built on first use and rebuilt if the corpus file changed
+    size.
+
+    Args:
+        path (str): Path of a .tsv, .tsv.bz2 or .tsv.gz file.
+
+    """
+
+    def __init__(self, path):
+        self.path = plain_corpus(path)
+        index_path = self.path + ".idx.npy"
+        index = np.load(index_path, mmap_mode="r") if os.path.exists(index_path) else None
+        if index is None or index["offset"][-1] != os.path.getsize(self.path):
+            index = np.load(build_index(self.path), mmap_mode="r")
+        self.ids = index["id"][:-1]
+        self.offsets = index["offset"]
+        self._order = None
+        self._sorted_ids = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _read(self, start, stop):
+        with open(self.path, "rb") as corpus:
+            corpus.seek(self.offsets[start])
+            return corpus.read(self.offsets[stop] - self.offsets[start])
+
+    def record(self, n):
+        """Returns the record in line n.
+
+        Args:
+            n (int): The line number (0-based, empty lines are skipped).
+
+        Returns:
+            tuple: (Tatoeba sentence id, sentence).
+
+        """
+
+        if n < 0:
+            n += len(self)
+        return _parse(self._read(n, n + 1))
+
+    def sentence(self, n):
+        """Returns the sentence in line n.
+
+        Args:
+            n (int): The line number (0-based).
+
+        Returns:
+            str: The sentence.
+
+        """
+
+        return self.record(n)[1]
+
+    def position(self, sentence_id):
+        """Finds the line of a Tatoeba sentence id.
+
+        Tatoeba exports are sorted by id, so this is a binary search on the
+        memory-mapped ids. Unsorted files are searched through a sort order
+        that is computed once.
+
+        Args:
+            sentence_id (int): The Tatoeba sentence id.
+
+        Returns:
+            int: The line number.
+
+        Raises:
+            KeyError: The id is not in the corpus.
+
+        """
+
+        if self._sorted_ids is None:
+            if np.all(self.ids[1:] > self.ids[:-1]):
+                self._order, self._sorted_ids = None, self.ids
+            else:
+                self._order = np.argsort(self.ids, kind="stable")
+                self._sorted_ids = self.ids[self._order]
+        i = int(np.searchsorted(self._sorted_ids, sentence_id))
+        if i == len(self) or self._sorted_ids[i] != sentence_id:
+            raise KeyError(sentence_id)
+        return i if self._order is None else int(self._order[i])
+
+    def by_id(self, sentence_id):
+        """Returns the sentence with a Tatoeba sentence id.
+
+        Args:
+            sentence_id (int): The Tatoeba sentence id.
+
+        Returns:
+            str: The sentence.
+
+        """
+
+        return self.sentence(self.position(sentence_id))
+
+    def records(self, start=0, stop=None):
+        """Yields the records of a range of lines with a single seek.
+
+        Args:
+            start (int): The first line.
+            stop (int): The line after the last line. None reads to the end.
+
+        Yields:
+            tuple: (Tatoeba sentence id, sentence).
+
+        """
+
+        stop = len(self) if stop is None else min(stop, len(self))
+        if start >= stop:
+            return
+        with open(self.path, "rb", buffering=READ_BUFFER) as corpus:
+            corpus.seek(self.offsets[start])
+            end = self.offsets[stop]
+            while corpus.tell() < end:
+                line = corpus.readline()
+                if line.strip():
+                    yield _parse(line)
+
+    def sample(self, k, seed=0):
+        """Draws a reproducible random sample of sentences.
+
+        Args:
+            k (int): The sample size. At most the corpus size.
+            seed (int): The random seed. The same seed gives the same sample.
+
+        Returns:
+            list[tuple]: (Tatoeba sentence id, sentence) in corpus order.
+
+        """
+
+        rows = np.sort(np.random.default_rng(seed).choice(len(self), size=min(k, len(self)), replace=False))
+        return [self.record(int(n)) for n in rows]
+
+    def shards(self, k):
+        """Splits the corpus into k shards of (almost) equal size.
+
+        Args:
+            k (int): The number of shards.
+
+        Returns:
+            list[tuple]: (start, stop) line ranges that can be passed to
+                records().
+
+        """
+
+        bounds = np.linspace(0, len(self), k + 1).round().astype(int)
+        return [(int(bounds[i]), int(bounds[i + 1])) for i in range(k)]
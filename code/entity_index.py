@@ -0,0 +1,327 @@
+"""Indexes the entities of stored tagging runs by surface form and label.
+
+Questions like "in which sentences did Stanza tag 'Tom' as PER but spaCy md
+did not" otherwise need a scan over all results. The index maps every
+normalized surface form (NFC, case-folded, single spaces) and label to the
+sorted ids of the sentences it occurs in, with one posting list per system
+(tagging run). Posting lists are stored delta-encoded in the smallest
+sufficient integer type and zlib-compressed, and are only decompressed when
+queried. The number of spans per term and system is stored uncompressed for
+frequency reports. Sentence texts are not loaded, but read from the
+memory-mapped runs on request.
+
+Sentences are identified by the ids of the runs, or by their text if one of
+the runs was imported from a .csv file in results/ (see agreement.py).
+
+Layout of an index directory:
+    meta.json: The systems with the paths of their runs, and the matching.
+    terms.json: [surface, label] of every term id.
+    postings.bin: The compressed posting lists, ordered by term and system.
+    postings_offset.i8: Start of every posting list in postings.bin, with
+        one extra row at the end.
+    spans.i8: Number of spans per term and system.
+    sentence_key.i8, sentence_system.i2, sentence_row.i8: Sorted sentence
+        ids and the system and row where their text is stored.
+
+Requires "argparse", "json", "os", "unicodedata", "zlib", and "numpy".
+
+Example:
+    Build and query from the code directory::
+
+        python entity_index.py build ./index_de stanza=runs/ger_st_results md=runs/ger_sp_results_nlp_de2
+        python entity_index.py query ./index_de "tom/PER/stanza" --not "tom/PER/md" --show 10
+        python entity_index.py top ./index_de --label LOC --system md -k 20
+
+    index = EntityIndex("./index_de")
+    ids = index.query([("Tom", "PER", "stanza")], exclude=[("Tom", "PER", "md")])
+
+"""
+
+import argparse
+import json
+import os
+import unicodedata
+import zlib
+
+import numpy as np
+
+from agreement import LABEL_MAPS, open_run, text_ids
+from results_store import RunStore
+
+def normalize(surface):
+    """Normalizes the surface form of an entity for the index."""
+
+    return " ".join(unicodedata.normalize("NFC", surface).casefold().split())
+
+def encode_postings(ids):
+    """Compresses sorted unique sentence ids.
+
+    Args:
+        ids (ndarray): Sorted non-negative sentence ids.
+
+    Returns:
+        bytes: The item size of the deltas, followed by the zlib-compressed
+            deltas.
+
+    """
+
+    deltas = np.diff(np.asarray(ids, dtype=np.int64), prepend=0)
+    dtype = np.min_scalar_type(int(deltas.max())) if len(deltas) else np.dtype(np.uint8)
+    return bytes([dtype.itemsize]) + zlib.compress(deltas.astype(dtype).tobytes())
+
+def decode_postings(data):
+    """Decompresses sentence ids encoded by encode_postings."""
+
+    dtype = {1: np.uint8, 2: np.uint16, 4: np.uint32, 8: np.uint64}[data[0]]
+    return np.cumsum(np.frombuffer(zlib.decompress(data[1:]), dtype=dtype), dtype=np.int64)
+
+def _entity_terms(run, ids, label_map, terms):
+    # Returns the term id and sentence id of every entity of the run.
+    labels = [(label_map or {}).get(label, label) for label in run.labels]
+    order = np.argsort(run.sentence_id, kind="stable")
+    rows = order[np.searchsorted(np.asarray(run.sentence_id)[order], np.asarray(run.ent_sentence))]
+    term_ids = []
+    row, text = -1, ""
+    for entity_row, start, end, label_id in zip(rows.tolist(), run.ent_start.tolist(), run.ent_end.tolist(), run.ent_label.tolist()):
+        label = labels[label_id]
+        if label is None:
+            term_ids.append(-1)
+            continue
+        if entity_row != row:
+            row, text = entity_row, run.sentence(entity_row)
+        term_ids.append(terms.setdefault((normalize(text[start:end]), label), len(terms)))
+    term_ids = np.array(term_ids, dtype=np.int64)
+    keep = term_ids >= 0
+    return term_ids[keep], ids[rows[keep]]
+
+def build_index(path, runs, label_map=None, by_text=False):
+    """Builds an index from tagging runs.
+
+    Args:
+        path (str): The new index directory. Existing files are overwritten.
+        runs (dict): RunStore per system name.
+        label_map (dict): Renames labels. Labels mapped to None are dropped.
+        by_text (bool): Whether to identify sentences by their text instead
+            of their ids.
+
+    Returns:
+        EntityIndex: The index.
+
+    """
+
+    os.makedirs(path, exist_ok=True)
+    names = list(runs)
+    run_ids = text_ids(list(runs.values())) if by_text else [np.asarray(run.sentence_id, dtype=np.int64) for run in runs.values()]
+    terms = {}
+    entries = []  # Per system: (term ids, sentence ids) of its entities.
+    for run, ids in zip(runs.values(), run_ids):
+        entries.append(_entity_terms(run, ids, label_map, terms))
+    n_systems = len(names)
+    spans = np.zeros((len(terms), n_systems), dtype=np.int64)
+    offsets = np.zeros(len(terms) * n_systems + 1, dtype=np.int64)
+    postings = [[b""] * n_systems for _ in range(len(terms))]
+    for system, (term_ids, sentence_ids) in enumerate(entries):
+        spans[:, system] = np.bincount(term_ids, minlength=len(terms))
+        pairs = np.unique(np.stack([term_ids, sentence_ids], axis=1), axis=0)  # Sorted by term, then sentence.
+        bounds = np.searchsorted(pairs[:, 0], np.arange(len(terms) + 1))
+        for term in np.flatnonzero(np.diff(bounds)):
+            postings[term][system] = encode_postings(pairs[bounds[term]:bounds[term + 1], 1])
+    with open(os.path.join(path, "postings.bin"), "wb") as postings_file:
+        for term, lists in enumerate(postings):
+            for system, data in enumerate(lists):
+                postings_file.write(data)
+                offsets[term * n_systems + system + 1] = offsets[term * n_systems + system] + len(data)
+    offsets.tofile(os.path.join(path, "postings_offset.i8"))
+    spans.tofile(os.path.join(path, "spans.i8"))
+    keys = np.concatenate(run_ids)
+    systems = np.repeat(np.arange(n_systems, dtype=np.int16), [len(ids) for ids in run_ids])
+    rows = np.concatenate([np.arange(len(ids), dtype=np.int64) for ids in run_ids])
+    keys, first = np.unique(keys, return_index=True)  # The first system that contains a sentence stores its text.
+    keys.tofile(os.path.join(path, "sentence_key.i8"))
+    systems[first].tofile(os.path.join(path, "sentence_system.i2"))
+    rows[first].tofile(os.path.join(path, "sentence_row.i8"))
+    with open(os.path.join(path, "terms.json"), "w", encoding="utf-8") as terms_file:
+        json.dump([list(term) for term in terms], terms_file, ensure_ascii=False)
+    with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as meta_file:
+        json.dump({"systems": {name: os.path.abspath(run.path) for name, run in runs.items()}, "by_text": by_text,
+                   "n_terms": len(terms), "n_sentences": len(keys)}, meta_file, indent=1)
+    return EntityIndex(path)
+
+class EntityIndex:
+    """Queries an index directory written by build_index.
+
+    Args:
+        path (str): The index directory.
+
+    Attributes:
+        systems (list[str]): The system names in index order.
+        terms (list[tuple]): (surface, label) of every term id.
+        spans (ndarray): Number of spans per term and system.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as meta_file:
+            self.meta = json.load(meta_file)
+        with open(os.path.join(path, "terms.json"), encoding="utf-8") as terms_file:
+            self.terms = [tuple(term) for term in json.load(terms_file)]
+        self.systems = list(self.meta["systems"])
+        self._term_ids = {}  # Surface -> {label: term id}.
+        for term, (surface, label) in enumerate(self.terms):
+            self._term_ids.setdefault(surface, {})[label] = term
+        n_systems = len(self.systems)
+        self.spans = np.fromfile(os.path.join(path, "spans.i8"), dtype=np.int64).reshape(-1, n_systems)
+        self._offsets = np.fromfile(os.path.join(path, "postings_offset.i8"), dtype=np.int64)
+        self._postings = np.memmap(os.path.join(path, "postings.bin"), dtype=np.uint8, mode="r") if self._offsets[-1] else b""
+        self._runs = {}
+
+    def labels(self, surface):
+        """Returns the labels a surface form was tagged with."""
+
+        return sorted(self._term_ids.get(normalize(surface), {}))
+
+    def _system_numbers(self, system):
+        if system is None:
+            return range(len(self.systems))
+        return [self.systems.index(name) for name in ([system] if isinstance(system, str) else system)]
+
+    def postings(self, surface, label=None, system=None):
+        """Returns the sentences in which a surface form was tagged.
+
+        Args:
+            surface (str): The surface form. It is normalized.
+            label (str or list[str]): One or more labels. None matches all.
+            system (str or list[str]): One or more systems. None matches all.
+
+        Returns:
+            ndarray: The sorted sentence ids.
+
+        """
+
+        by_label = self._term_ids.get(normalize(surface), {})
+        labels = by_label if label is None else [label] if isinstance(label, str) else label
+        lists = []
+        for term in (by_label[l] for l in labels if l in by_label):
+            for number in self._system_numbers(system):
+                start, end = self._offsets[term * len(self.systems) + number:term * len(self.systems) + number + 2]
+                if end > start:
+                    lists.append(decode_postings(bytes(self._postings[start:end])))
+        if not lists:
+            return np.empty(0, dtype=np.int64)
+        return lists[0] if len(lists) == 1 else np.unique(np.concatenate(lists))
+
+    def query(self, include, exclude=()):
+        """Combines posting lists with set operations.
+
+        Args:
+            include (list[tuple]): (surface, label, system) patterns that
+                must all match. label and system may be None for any.
+            exclude (list[tuple]): Patterns of which none may match.
+
+        Returns:
+            ndarray: The sorted ids of the matching sentences.
+
+        """
+
+        result = None
+        for pattern in include:
+            ids = self.postings(*pattern)
+            result = ids if result is None else np.intersect1d(result, ids, assume_unique=True)
+        if result is None:
+            return np.empty(0, dtype=np.int64)
+        for pattern in exclude:
+            result = np.setdiff1d(result, self.postings(*pattern), assume_unique=True)
+        return result
+
+    def top(self, k=10, label=None, system=None):
+        """Returns the most frequent terms.
+
+        Args:
+            k (int): Number of terms.
+            label (str): Only count terms with this label. None counts all.
+            system (str or list[str]): Only count spans of these systems.
+
+        Returns:
+            list[tuple]: (surface, label, spans per system) of the k terms
+                with the most spans, most frequent first.
+
+        """
+
+        numbers = list(self._system_numbers(system))
+        counts = self.spans[:, numbers].sum(axis=1)
+        if label is not None:
+            counts = np.where([term_label == label for _, term_label in self.terms], counts, 0)
+        k = min(k, int(np.count_nonzero(counts)))
+        if k == 0:
+            return []
+        best = np.argpartition(-counts, k - 1)[:k]
+        best = best[np.argsort(-counts[best], kind="stable")]
+        return [(self.terms[term][0], self.terms[term][1], dict(zip(self.systems, self.spans[term].tolist()))) for term in best]
+
+    def sentences(self, ids):
+        """Reads the texts of sentences from the runs.
+
+        Args:
+            ids (Iterable[int]): Sentence ids from postings or query.
+
+        Returns:
+            list[str]: The texts.
+
+        """
+
+        keys = np.fromfile(os.path.join(self.path, "sentence_key.i8"), dtype=np.int64)
+        systems = np.memmap(os.path.join(self.path, "sentence_system.i2"), dtype=np.int16, mode="r")
+        rows = np.memmap(os.path.join(self.path, "sentence_row.i8"), dtype=np.int64, mode="r")
+        texts = []
+        for position in np.searchsorted(keys, np.asarray(list(ids), dtype=np.int64)):
+            name = self.systems[systems[position]]
+            if name not in self._runs:
+                self._runs[name] = RunStore(self.meta["systems"][name])
+            texts.append(self._runs[name].sentence(int(rows[position])))
+        return texts
+
+def _pattern(text):
+    # Parses "surface/LABEL/system"; empty parts match anything.
+    surface, label, system = (text.split("/") + ["", ""])[:3]
+    return surface, label or None, system or None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Builds and queries an inverted index of tagged entities.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="index runs given as name=path (run directories or .csv files)")
+    build.add_argument("index")
+    build.add_argument("runs", nargs="+")
+    build.add_argument("--map", help="label mapping: " + ", ".join(LABEL_MAPS))
+    build.add_argument("--by-text", action="store_true", help="match sentences by text (default for .csv files)")
+    query = commands.add_parser("query", help="sentences matching all patterns surface/LABEL/system")
+    query.add_argument("index")
+    query.add_argument("patterns", nargs="+")
+    query.add_argument("--not", dest="exclude", nargs="*", default=[], help="patterns that must not match")
+    query.add_argument("--show", type=int, default=0, help="print the texts of the first n sentences")
+    top = commands.add_parser("top", help="the most frequent entities")
+    top.add_argument("index")
+    top.add_argument("-k", type=int, default=20)
+    top.add_argument("--label")
+    top.add_argument("--system", nargs="*")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        runs = dict(spec.split("=", 1) if "=" in spec else (os.path.basename(os.path.normpath(spec)), spec) for spec in args.runs)
+        runs = {name: open_run(path) for name, path in runs.items()}
+        by_text = args.by_text or any(run.meta.get("source", "").endswith(".csv") for run in runs.values())
+        index = build_index(args.index, runs, LABEL_MAPS.get(args.map), by_text)
+        print("{} terms in {} sentences".format(index.meta["n_terms"], index.meta["n_sentences"]))
+    elif args.command == "query":
+        index = EntityIndex(args.index)
+        ids = index.query([_pattern(p) for p in args.patterns], [_pattern(p) for p in args.exclude])
+        print("{} sentences".format(len(ids)))
+        for sentence_id, text in zip(ids, index.sentences(ids[:args.show])):
+            print(sentence_id, text)
+    else:
+        index = EntityIndex(args.index)
+        for surface, label, spans in index.top(args.k, args.label, args.system):
+            print("{:30} {:8}".format(surface, label), *("{}={}".format(name, count) for name, count in spans.items()))
+
+if __name__ == "__main__":
+    main()
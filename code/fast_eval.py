@@ -0,0 +1,253 @@
+"""Estimates the evaluation scores from a stratified sample of sentences.
+
+Evaluating a whole corpus with a large spaCy pipeline takes much longer than
+tagging it. For comparing pipelines, an estimate with a known uncertainty is
+often enough. The tagging results are divided into strata by sentence length
+and by the label the tagger predicted most often in the sentence ("-" for
+none). A reproducible random sample is drawn from every stratum in
+proportion to its size and evaluated like evaluate_ner_sp. Precision, recall
+and F1-score are estimated from the per-sentence counts, weighted by the
+size of each stratum, and their confidence intervals by a stratified
+bootstrap: the sentences of every stratum are resampled with replacement.
+
+In adaptive mode, the sample grows in rounds until the confidence interval
+of the F1-score is narrower than a target width or the whole corpus has been
+evaluated.
+
+Requires "argparse", "bisect", "collections", "json", "numpy", and "spacy".
+
+Example:
+    estimate = fast_evaluate(ger_sp_results_nlp_de2, nlp_de3, sample_size=5000)
+    estimate = fast_evaluate(ger_sp_results_nlp_de2, nlp_de3, target_width=0.01)
+    print(estimate["ents_f"], estimate["ci"]["ents_f"])
+
+    Or with a stored run from the code directory::
+
+        python fast_eval.py ./runs/ger_sp_results_nlp_de2 --lang de --evaluator lg --target-width 0.01
+
+Attributes:
+    LENGTH_BUCKETS (list[int]): Upper bounds of the sentence length strata in
+        estimated tokens. Longer sentences form the last stratum.
+
+"""
+
+import argparse
+import bisect
+import collections
+import json
+
+import numpy as np
+
+from batching import token_length
+from scoring import ScoreCounts, make_examples
+
+LENGTH_BUCKETS = [5, 8, 12, 20]
+
+def stratum(result):
+    """Returns the stratum of a tagging result.
+
+    Args:
+        result (tuple): ('Sentence.', [[start_char, end_char, 'LABEL']]),
+            optionally with the sentence id first.
+
+    Returns:
+        tuple: (length bucket, most frequent predicted label or "-").
+
+    """
+
+    sentence, entities = result[-2:]
+    bucket = bisect.bisect_left(LENGTH_BUCKETS, token_length(str(sentence)))
+    labels = collections.Counter(label for _, _, label in entities)
+    return bucket, min(labels, key=lambda label: (-labels[label], label)) if labels else "-"
+
+def _totals(counts):
+    tp = sum(score.tp for score in counts.ents.values())
+    fp = sum(score.fp for score in counts.ents.values())
+    fn = sum(score.fn for score in counts.ents.values())
+    return tp, fp, fn
+
+def _prf(tp, fp, fn):
+    # Works on numbers and on arrays of bootstrap replicates.
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.where(tp + fp > 0, tp / np.maximum(tp + fp, 1e-12), 0.0)
+        recall = np.where(tp + fn > 0, tp / np.maximum(tp + fn, 1e-12), 0.0)
+        fscore = np.where(precision + recall > 0, 2 * precision * recall / np.maximum(precision + recall, 1e-12), 0.0)
+    return precision, recall, fscore
+
+class StratifiedSample:
+    """Draws a reproducible stratified sample of tagging results.
+
+    Every stratum is shuffled once with the seed. A sample of size n takes
+    the first sentences of every stratum in proportion to its size, so a
+    larger sample contains every smaller one.
+
+    Args:
+        results (list[tuple]): All tagging results.
+        seed (int): Seed of the random order.
+
+    Attributes:
+        strata (dict): The shuffled positions of the results per stratum.
+
+    """
+
+    def __init__(self, results, seed=0):
+        self.results = results
+        rng = np.random.default_rng(seed)
+        positions = collections.defaultdict(list)
+        for position, result in enumerate(results):
+            positions[stratum(result)].append(position)
+        self.strata = {key: rng.permutation(positions[key]) for key in sorted(positions)}
+
+    def __len__(self):
+        return len(self.results)
+
+    def allocation(self, n):
+        """Returns the number of sampled sentences per stratum for sample size n.
+
+        Every stratum gets at least two sentences (if it has them), so its
+        variance can be estimated.
+
+        """
+
+        total = len(self.results)
+        return {key: min(len(positions), max(2, int(round(n * len(positions) / total)))) for key, positions in self.strata.items()}
+
+class Estimate:
+    """Collects per-sentence counts of the sampled sentences per stratum.
+
+    Args:
+        sample (StratifiedSample): The sample.
+
+    """
+
+    def __init__(self, sample):
+        self.sample = sample
+        self.rows = {key: [] for key in sample.strata}  # Per stratum: [tp, fp, fn] per sampled sentence.
+        self.counts = {key: ScoreCounts() for key in sample.strata}
+
+    def add(self, key, example):
+        """Counts one evaluated example of a stratum."""
+
+        counts = ScoreCounts()
+        counts.add(example)
+        self.rows[key].append(_totals(counts))
+        self.counts[key].merge(counts)
+
+    def scores(self, n_boot=1000, confidence=0.95, seed=0):
+        """Estimates the scores and their confidence intervals.
+
+        Args:
+            n_boot (int): Number of bootstrap replicates.
+            confidence (float): Coverage of the confidence intervals.
+            seed (int): Seed of the bootstrap.
+
+        Returns:
+            dict: Estimated ents_p, ents_r, ents_f and ents_per_type, their
+                confidence intervals as "ci", and the sample size.
+
+        """
+
+        rng = np.random.default_rng(seed)
+        weighted = np.zeros(3)
+        replicates = np.zeros((n_boot, 3))
+        per_type = collections.defaultdict(lambda: np.zeros(3))
+        for key, rows in self.rows.items():
+            if not rows:
+                continue
+            rows = np.asarray(rows, dtype=float)
+            weight = len(self.sample.strata[key]) / len(rows)  # Sentences of the stratum per sampled sentence.
+            weighted += weight * rows.sum(axis=0)
+            step = max(1, 2 ** 20 // len(rows))  # Replicates per block, to bound the memory of large strata.
+            for start in range(0, n_boot, step):
+                resampled = rng.integers(0, len(rows), size=(min(step, n_boot - start), len(rows)))
+                replicates[start:start + len(resampled)] += weight * rows[resampled].sum(axis=1)
+            for label, score in self.counts[key].ents.items():
+                per_type[label] += weight * np.array([score.tp, score.fp, score.fn])
+        precision, recall, fscore = _prf(*weighted)
+        boot = _prf(replicates[:, 0], replicates[:, 1], replicates[:, 2])
+        bounds = [100 * (1 - confidence) / 2, 100 * (1 + confidence) / 2]
+        return {
+            "ents_p": float(precision),
+            "ents_r": float(recall),
+            "ents_f": float(fscore),
+            "ci": {name: [float(v) for v in np.percentile(values, bounds)] for name, values in zip(("ents_p", "ents_r", "ents_f"), boot)},
+            "confidence": confidence,
+            "ents_per_type": {label: dict(zip("prf", (float(v) for v in _prf(*values)))) for label, values in sorted(per_type.items())},
+            "n_sampled": sum(len(rows) for rows in self.rows.values()),
+            "n_total": len(self.sample),
+        }
+
+def fast_evaluate(results, nlp_model, sample_size=None, target_width=None, round_size=1000, confidence=0.95, n_boot=1000, seed=0, cache=None, batch_size=1000):
+    """Estimates the scores of evaluate_ner_sp from a stratified sample.
+
+    Args:
+        results (list[tuple]): The tagging results, e.g. of
+            named_entity_recognition_sp.
+        nlp_model (Language): The spaCy pipeline used for evaluation.
+        sample_size (int): Number of sentences to evaluate. In adaptive mode,
+            the largest sample. Defaults to 5000, or to all sentences in
+            adaptive mode.
+        target_width (float): If given, sentences are evaluated in rounds of
+            round_size until the confidence interval of the F1-score is at
+            most this wide.
+        round_size (int): Number of sentences added per round.
+        confidence (float): Coverage of the confidence intervals.
+        n_boot (int): Number of bootstrap replicates.
+        seed (int): Seed of the sample and the bootstrap.
+        cache (DiskCache): Cache of the predictions of nlp_model. If None,
+            the default cache is used. If False, nothing is cached.
+        batch_size (int): Number of sentences per batch of nlp_model.
+
+    Returns:
+        dict: The estimate (see Estimate.scores) and the number of rounds.
+
+    """
+
+    results = list(results)
+    sample = StratifiedSample(results, seed)
+    if sample_size is None:
+        sample_size = len(results) if target_width else 5000
+    estimate = Estimate(sample)
+    taken = {key: 0 for key in sample.strata}
+    size = min(sample_size, round_size) if target_width else sample_size
+    rounds = 0
+    while True:
+        wanted = sample.allocation(size)
+        positions = [(key, position) for key in sample.strata for position in sample.strata[key][taken[key]:wanted[key]]]
+        taken.update(wanted)
+        examples = make_examples((results[position] for _, position in positions), nlp_model, cache, batch_size)
+        for (key, _), example in zip(positions, examples):
+            estimate.add(key, example)
+        rounds += 1
+        scores = estimate.scores(n_boot, confidence, seed)
+        low, high = scores["ci"]["ents_f"]
+        if not target_width or high - low <= target_width or size >= min(sample_size, len(sample)):
+            break
+        size = min(size + round_size, sample_size)
+    scores["rounds"] = rounds
+    return scores
+
+def main(argv=None):
+    from models import load, pipeline_name
+    from results_store import RunStore
+
+    parser = argparse.ArgumentParser(description="Estimates evaluation scores from a stratified sample with bootstrap confidence intervals.")
+    parser.add_argument("run", help="a run directory (see results_store.py)")
+    parser.add_argument("--lang", required=True)
+    parser.add_argument("--evaluator", default="lg")
+    parser.add_argument("--sample", type=int, help="sample size (default: 5000, or the largest sample with --target-width)")
+    parser.add_argument("--target-width", type=float, help="grow the sample until the F1 interval is this narrow")
+    parser.add_argument("--round-size", type=int, default=1000)
+    parser.add_argument("--confidence", type=float, default=0.95)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    scores = fast_evaluate(RunStore(args.run).results(), load(pipeline_name(args.evaluator, args.lang)), args.sample,
+                           args.target_width, args.round_size, args.confidence, seed=args.seed)
+    for name in ("ents_p", "ents_r", "ents_f"):
+        print("{} {:.4f} [{:.4f}, {:.4f}]".format(name, scores[name], *scores["ci"][name]))
+    print("{} of {} sentences in {} round(s)".format(scores["n_sampled"], scores["n_total"], scores["rounds"]))
+    print(json.dumps(scores["ents_per_type"], indent=1))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""Loads spaCy and Stanza pipelines on first use.
+
+All modules of this project get their pipelines from one shared
+ModelRegistry instead of loading every pipeline at import. A pipeline is
+loaded the first time it is requested and then reused by spacy_test.py,
+stanza_test.py and results.py alike. If a memory budget is set, the least
+recently used pipelines are dropped from the registry once the budget is
+exceeded.
+
+spaCy pipelines are loaded without the components that named entity
+recognition does not need (tagger, parser, lemmatizer, etc.). With the option
+shared_vectors=True, their word vectors are memory-mapped from a file that
+all processes share (see shared_vectors.py). With the option quantized=True,
+Stanza pipelines run on the CPU with int8 weights (see quantize.py).
+
+Requires "collections", "gc", "os", "resource", "spacy", and "stanza" (only
+for Stanza pipelines).
+
+Example:
+    nlp_de2 = load("nlp_de2")  # Same as load("de_core_news_md").
+    nlp_de = load("stanza", "de")  # Same as load("nlp_de").
+    nlp_de3 = load("nlp_de3", shared_vectors=True)
+    nlp_de = load("stanza", "de", quantized=True)
+
+Attributes:
+    SPACY_PIPELINES (dict): The spaCy pipelines used in this project by
+        variable name, as (package name, language).
+    STANZA_PIPELINES (dict): The Stanza pipelines used in this project by
+        variable name, as ("stanza", language).
+    NER_EXCLUDE (list[str]): spaCy components that are not loaded.
+    STANZA_OPTIONS (dict): Default options of stanza.Pipeline.
+    LANGUAGES (dict): The corpus languages and their prefixes in results.py.
+    TAGGERS (dict): The taggers of the README naming scheme by short name.
+    EVALUATORS (dict): The evaluation pipelines by short name.
+    COMBINATIONS (list[tuple]): The (tagger, evaluator) pairs compared in
+        this project, as in the "Results Table" PDF plus the large pipeline
+        evaluated with the multi-language pipeline.
+    registry (ModelRegistry): The registry shared by all modules. Its memory
+        budget can be set in megabytes with the environment variable
+        NER_MEMORY_BUDGET_MB.
+
+"""
+
+import gc
+import os
+import resource
+
+from collections import OrderedDict
+
+SPACY_PIPELINES = {
+    "nlp_de2": ("de_core_news_md", "de"),
+    "nlp_de3": ("de_core_news_lg", "de"),
+    "nlp_en2": ("en_core_web_md", "en"),
+    "nlp_en3": ("en_core_web_lg", "en"),
+    "nlp_nl2": ("nl_core_news_md", "nl"),
+    "nlp_nl3": ("nl_core_news_lg", "nl"),
+    "nlp_multi": ("xx_ent_wiki_sm", "xx"),
+}
+
+STANZA_PIPELINES = {
+    "nlp_de": ("stanza", "de"),
+    "nlp_en": ("stanza", "en"),
+    "nlp_nl": ("stanza", "nl"),
+}
+
+NER_EXCLUDE = ["tagger", "morphologizer", "parser", "lemmatizer", "attribute_ruler", "senter"]
+
+STANZA_OPTIONS = {"processors": "tokenize,ner", "use_gpu": True, "verbose": False}
+
+LANGUAGES = {"de": "ger", "en": "eng", "nl": "nld"}
+
+TAGGERS = {"md": "nlp_{}2", "lg": "nlp_{}3", "multi": "nlp_multi", "stanza": "nlp_{}"}
+
+EVALUATORS = {"lg": "nlp_{}3", "multi": "nlp_multi"}
+
+COMBINATIONS = [("md", "lg"), ("multi", "lg"), ("stanza", "lg"), ("stanza", "multi"), ("lg", "multi")]
+
+def pipeline_name(system, lang):
+    """Returns the variable name of a tagger or evaluator for a language.
+
+    Args:
+        system (str): A key of TAGGERS or EVALUATORS, e.g. "md" or "stanza".
+        lang (str): The language code, e.g. "de".
+
+    Returns:
+        str: The variable name, e.g. "nlp_de2".
+
+    """
+
+    return dict(EVALUATORS, **TAGGERS)[system].format(lang)
+
+def current_rss():
+    """Returns the resident set size of the current process in bytes.
+
+    Falls back to the peak resident set size on systems without /proc.
+
+    Returns:
+        int: The resident set size in bytes.
+
+    """
+
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def resolve(name, lang=None):
+    """Translates a variable or package name into a registry key.
+
+    Args:
+        name (str): A variable name like "nlp_de2", a spaCy package name like
+            "de_core_news_md", or "stanza".
+        lang (str): The language code. Only needed for "stanza".
+
+    Returns:
+        tuple: (package name, language).
+
+    Raises:
+        ValueError: "stanza" was requested without a language.
+
+    """
+
+    if name in SPACY_PIPELINES:
+        return SPACY_PIPELINES[name]
+    if name in STANZA_PIPELINES:
+        return STANZA_PIPELINES[name]
+    if name == "stanza":
+        if lang is None:
+            raise ValueError("A language is needed to load a Stanza pipeline.")
+        return name, lang
+    return name, lang or name.split("_")[0]
+
+class ModelRegistry:
+    """Loads pipelines lazily and keeps them in least recently used order.
+
+    Args:
+        memory_budget (int): Memory that all loaded pipelines may use in
+            bytes. None means no limit. The memory of a pipeline is measured
+            as the growth of the resident set size while loading it.
+
+    """
+
+    def __init__(self, memory_budget=None):
+        self.memory_budget = memory_budget
+        self._models = OrderedDict()  # key -> (model, size in bytes), least recently used first.
+
+    def __contains__(self, key):
+        return key in self._models
+
+    def get(self, name, lang=None, **options):
+        """Returns a pipeline and loads it if necessary.
+
+        Args:
+            name (str): A variable name, spaCy package name or "stanza".
+            lang (str): The language code. Only needed for "stanza".
+            **options: Options for spacy.load or stanza.Pipeline that replace
+                the defaults, e.g. exclude=[] to load all spaCy components.
+                shared_vectors=True memory-maps the vectors of a spaCy
+                pipeline, quantized=True runs a Stanza pipeline with int8
+                weights on the CPU.
+
+        Returns:
+            Language or Pipeline: The pipeline.
+
+        """
+
+        key = resolve(name, lang) + tuple(sorted((k, repr(v)) for k, v in options.items()))
+        if key in self._models:
+            self._models.move_to_end(key)
+            return self._models[key][0]
+        rss_before = current_rss()
+        model = self._load(key[0], key[1], options)
+        self._models[key] = (model, max(current_rss() - rss_before, 0))
+        self._enforce_budget()
+        return model
+
+    def _load(self, package, lang, options):
+        if package == "stanza":
+            import stanza
+            if options.pop("quantized", False):
+                from quantize import quantize_pipeline
+                return quantize_pipeline(stanza.Pipeline(lang, **dict(STANZA_OPTIONS, **dict(options, use_gpu=False))))
+            return stanza.Pipeline(lang, **dict(STANZA_OPTIONS, **options))
+        import spacy
+        options = dict({"exclude": NER_EXCLUDE}, **options)
+        if options.pop("shared_vectors", False):
+            from shared_vectors import load_shared
+            nlp = load_shared(package, **options)
+        else:
+            nlp = spacy.load(package, **options)
+        if "tok2vec" in nlp.pipe_names and not nlp.get_pipe("tok2vec").listening_components:
+            nlp.disable_pipe("tok2vec")  # Only the excluded components listened to it.
+        return nlp
+
+    def _enforce_budget(self):
+        if self.memory_budget is None:
+            return
+        while len(self._models) > 1 and self.memory_used() > self.memory_budget:
+            key, _ = self._models.popitem(last=False)
+            print("Unloaded", key[0], key[1])
+        gc.collect()
+
+    def memory_used(self):
+        """Returns the estimated memory of all loaded pipelines in bytes."""
+
+        return sum(size for _, size in self._models.values())
+
+    def unload(self, name, lang=None):
+        """Removes all variants of a pipeline from the registry.
+
+        Args:
+            name (str): A variable name, spaCy package name or "stanza".
+            lang (str): The language code. Only needed for "stanza".
+
+        """
+
+        package, lang = resolve(name, lang)
+        for key in [k for k in self._models if k[:2] == (package, lang)]:
+            del self._models[key]
+        gc.collect()
+
+    def clear(self):
+        """Removes all pipelines from the registry."""
+
+        self._models.clear()
+        gc.collect()
+
+_budget = os.environ.get("NER_MEMORY_BUDGET_MB")
+registry = ModelRegistry(int(_budget) * 1024 ** 2 if _budget else None)
+
+def load(name, lang=None, **options):
+    """Returns a pipeline from the shared registry.
+
+    Args:
+        name (str): A variable name like "nlp_de2", a spaCy package name or
+            "stanza".
+        lang (str): The language code. Only needed for "stanza".
+        **options: Options for spacy.load or stanza.Pipeline.
+
+    Returns:
+        Language or Pipeline: The pipeline.
+
+    """
+
+    return registry.get(name, lang, **options)
@@ -0,0 +1,305 @@
+"""Keeps pipelines loaded in a local service that tags sentences on request.
+
+Loading the pipelines takes longer than tagging a few sentences, and every
+run of results.py loads them again. The service loads each pipeline once and
+answers requests from local clients over a Unix domain socket. Requests for
+the same pipeline that arrive within max_wait seconds are merged into one
+batch of up to max_batch sentences, so many small requests are tagged as
+efficiently as one large request. Every pipeline is run in its own thread,
+one batch at a time, while the event loop keeps accepting requests.
+Pipelines are loaded one at a time in another thread, since the model
+registry is shared.
+
+The protocol consists of JSON objects, one per line:
+    {"op": "tag", "pipeline": "nlp_de2", "sentences": ["..."]} is answered
+        with {"results": [["Sentence.", [[start_char, end_char, "LABEL"]]]]},
+        the format of named_entity_recognition_sp/_st.
+    {"op": "metrics"} is answered with the queue depth, batch sizes and
+        request latencies of every pipeline.
+    Errors are answered with {"error": "message"}.
+
+Requires "argparse", "asyncio", "collections", "concurrent.futures", "json",
+"os", "socket", "time", "spacy", and "stanza".
+
+Example:
+    Start the service from the code directory::
+
+        python ner_service.py --preload nlp_de2 nlp_de
+
+    and tag from any other process::
+
+        results = tag_remote(["Tom wohnt in Berlin."], "nlp_de2")
+
+Attributes:
+    SOCKET_PATH (str): Default path of the socket. Can be set with the
+        environment variable NER_SOCKET.
+
+"""
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import json
+import os
+import socket
+import time
+
+from batching import percentile
+from models import STANZA_PIPELINES, load
+
+SOCKET_PATH = os.environ.get("NER_SOCKET", "/tmp/ner_tatoeba.sock")
+
+class MicroBatcher:
+    """Merges the requests for one pipeline into batches.
+
+    Args:
+        tag (Callable): Takes a list of sentences and returns one result per
+            sentence. Called in a separate thread.
+        max_batch (int): Maximum number of sentences per batch. A larger
+            request is tagged as one batch.
+        max_wait (float): Seconds to wait for more requests after the first
+            request of a batch.
+
+    Attributes:
+        batch_sizes (deque): Sizes of the recent batches.
+        latencies (deque): Seconds from the arrival of recent requests to
+            their answer.
+
+    """
+
+    def __init__(self, tag, max_batch=256, max_wait=0.01):
+        self.tag = tag
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.batch_sizes = collections.deque(maxlen=10000)
+        self.latencies = collections.deque(maxlen=10000)
+        self.sentences = 0
+        self._queue = asyncio.Queue()
+        self._executor = concurrent.futures.ThreadPoolExecutor(1)  # Pipelines must not be used by two threads at once.
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, sentences):
+        """Tags sentences as part of the next batch.
+
+        Args:
+            sentences (list[str]): The sentences.
+
+        Returns:
+            list: One result per sentence.
+
+        """
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((list(sentences), future, time.perf_counter()))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = [await self._queue.get()]
+            size = len(requests[0][0])
+            deadline = loop.time() + self.max_wait
+            while size < self.max_batch:
+                try:
+                    request = await asyncio.wait_for(self._queue.get(), max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    break
+                requests.append(request)
+                size += len(request[0])
+            batch = [sentence for sentences, _, _ in requests for sentence in sentences]
+            try:
+                results = await loop.run_in_executor(self._executor, self.tag, batch)
+            except Exception as e:
+                for _, future, _ in requests:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batch_sizes.append(len(batch))
+            self.sentences += len(batch)
+            position = 0
+            for sentences, future, arrived in requests:
+                if not future.done():  # The client may have disconnected.
+                    future.set_result(results[position:position + len(sentences)])
+                position += len(sentences)
+                self.latencies.append(time.perf_counter() - arrived)
+
+    def metrics(self):
+        """Returns the current queue depth and statistics of recent batches."""
+
+        return {
+            "queue_depth": self._queue.qsize(),
+            "sentences": self.sentences,
+            "batches": len(self.batch_sizes),
+            "batch_size_mean": sum(self.batch_sizes) / len(self.batch_sizes) if self.batch_sizes else None,
+            "latency_p50_s": percentile(list(self.latencies), 50),
+            "latency_p99_s": percentile(list(self.latencies), 99),
+        }
+
+def _tagger(name):
+    # Imported here, so the service only imports spaCy and Stanza modules
+    # that it needs.
+    nlp_model = load(name)
+    if name in STANZA_PIPELINES:
+        from stanza_test import tag_sentences_st
+        return lambda batch: list(tag_sentences_st(batch, nlp_model, chunk_size=len(batch)))
+    from spacy_test import tag_sentences_sp
+    return lambda batch: list(tag_sentences_sp(batch, nlp_model, batch_size=len(batch)))
+
+class NERService:
+    """Answers tagging requests with one MicroBatcher per pipeline.
+
+    Args:
+        max_batch (int): Maximum number of sentences per batch.
+        max_wait (float): Seconds to wait for more requests per batch.
+
+    """
+
+    def __init__(self, max_batch=256, max_wait=0.01):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.started = time.time()
+        self._batchers = {}
+        self._loading = {}
+        self._loader = concurrent.futures.ThreadPoolExecutor(1)  # The model registry must not be changed by two threads at once.
+
+    async def batcher(self, name):
+        """Returns the MicroBatcher of a pipeline and loads it on first use.
+
+        Args:
+            name (str): A pipeline name from models.py, e.g. "nlp_de2".
+
+        Returns:
+            MicroBatcher: The batcher.
+
+        """
+
+        if name not in self._batchers:
+            if name not in self._loading:  # Concurrent requests wait for the same load.
+                self._loading[name] = asyncio.get_running_loop().run_in_executor(self._loader, _tagger, name)
+            try:
+                tag = await self._loading[name]
+            finally:
+                self._loading.pop(name, None)
+            if name not in self._batchers:
+                self._batchers[name] = MicroBatcher(tag, self.max_batch, self.max_wait)
+        return self._batchers[name]
+
+    async def handle(self, request):
+        """Answers one request.
+
+        Args:
+            request (dict): A decoded request.
+
+        Returns:
+            dict: The answer.
+
+        """
+
+        if request.get("op") == "tag":
+            batcher = await self.batcher(request["pipeline"])
+            return {"results": await batcher.submit(request["sentences"])}
+        if request.get("op") == "metrics":
+            return {"uptime_s": time.time() - self.started, "pipelines": {name: b.metrics() for name, b in self._batchers.items()}}
+        raise ValueError("Unknown op {!r}.".format(request.get("op")))
+
+    async def client_connected(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    answer = await self.handle(json.loads(line))
+                except Exception as e:
+                    answer = {"error": "{}: {}".format(type(e).__name__, e)}
+                writer.write(json.dumps(answer, ensure_ascii=False).encode("utf-8") + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+async def serve(path=SOCKET_PATH, preload=(), max_batch=256, max_wait=0.01):
+    """Runs the service until it is cancelled.
+
+    Args:
+        path (str): Path of the socket. An existing file is replaced.
+        preload (list[str]): Pipelines that are loaded before the first
+            request.
+        max_batch (int): Maximum number of sentences per batch.
+        max_wait (float): Seconds to wait for more requests per batch.
+
+    """
+
+    service = NERService(max_batch, max_wait)
+    for name in preload:
+        print("Loading", name)
+        await service.batcher(name)
+    if os.path.exists(path):
+        os.remove(path)
+    server = await asyncio.start_unix_server(service.client_connected, path, limit=64 * 1024 ** 2)
+    print("Listening on", path)
+    async with server:
+        await server.serve_forever()
+
+def request(message, path=SOCKET_PATH):
+    """Sends one request to the service and waits for the answer.
+
+    Args:
+        message (dict): The request.
+        path (str): Path of the socket.
+
+    Returns:
+        dict: The answer.
+
+    Raises:
+        RuntimeError: The service answered with an error.
+
+    """
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(path)
+        client.sendall(json.dumps(message, ensure_ascii=False).encode("utf-8") + b"\n")
+        with client.makefile("rb") as answers:
+            answer = json.loads(answers.readline())
+    if "error" in answer:
+        raise RuntimeError(answer["error"])
+    return answer
+
+def tag_remote(lang_sent, pipeline, path=SOCKET_PATH):
+    """Tags sentences with a pipeline of the service.
+
+    Args:
+        lang_sent (list[str]): The sentences.
+        pipeline (str): A pipeline name from models.py, e.g. "nlp_de2".
+        path (str): Path of the socket.
+
+    Returns:
+        list[tuple]: One ('Sentence.', [[start_char, end_char, 'LABEL']]) per
+            sentence, like named_entity_recognition_sp/_st.
+
+    """
+
+    answer = request({"op": "tag", "pipeline": pipeline, "sentences": [str(s) for s in lang_sent]}, path)
+    return [tuple(result) for result in answer["results"]]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Keeps NER pipelines loaded and tags sentences for local clients.")
+    parser.add_argument("--socket", default=SOCKET_PATH)
+    parser.add_argument("--preload", nargs="*", default=[], help="pipelines to load at start, e.g. nlp_de2 nlp_de")
+    parser.add_argument("--max-batch", type=int, default=256)
+    parser.add_argument("--max-wait-ms", type=float, default=10)
+    parser.add_argument("--metrics", action="store_true", help="print the metrics of a running service and exit")
+    args = parser.parse_args(argv)
+
+    if args.metrics:
+        print(json.dumps(request({"op": "metrics"}, args.socket), indent=1))
+        return
+    try:
+        asyncio.run(serve(args.socket, args.preload, args.max_batch, args.max_wait_ms / 1000))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
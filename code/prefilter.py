@@ -0,0 +1,377 @@
+"""Skips sentences that are unlikely to contain named entities.
+
+Many Tatoeba sentences ("Hoe oud bent u?", "ik ben moe.") contain no
+capitalized word apart from a frequent first word, no digits and no word
+that was part of an entity before, and the NER pipelines find nothing in
+them. A Prefilter
+scores every sentence from a few cheap features with a logistic model, and
+only sentences whose score reaches the threshold are passed to the pipeline.
+Skipped sentences get an empty entity list, like sentences in which the
+pipeline finds nothing.
+
+Features (counted per sentence, as log(1 + n)):
+    capitalized: Capitalized words. The first word only counts if it is not
+        one of the few frequent words of the language in router.STOPWORDS,
+        so "Tom is hier." and "Wilt u een kopje koffie?" count and "Hoe oud
+        bent u?" does not. In German, most
+        capitalized words are nouns, so the learned weight is low.
+    all_caps: Words of two or more capital letters.
+    digits: Words with digits.
+    gazetteer: Words that were part of entities in the training sentences.
+    length: Number of words.
+
+Without training, the weights keep every sentence with at least one of the
+first four features. Since most sentences start with a capitalized word that
+is not in the short stopword lists, this skips few entities but also few
+sentences (about half of the Dutch corpus is kept). Only a calibrated
+prefilter skips enough sentences to pay off. fit() learns the weights and the
+gazetteer from the results of the full pipeline. Since skipping sentences can
+lose entities, calibration_report() lists, per threshold, the share of
+sentences skipped and the share of the entities of the full pipeline that
+would be lost, so the threshold can be chosen knowing what it costs.
+
+Requires "argparse", "collections", "hashlib", "json", "os", "re", "numpy",
+"spacy", and "stanza".
+
+Example:
+    Calibrate from the code directory::
+
+        python prefilter.py --languages de en nl --tagger md --sample 10000 --max-recall-loss 0.01
+
+    Then use the saved prefilter::
+
+        prefilter = load_prefilter("nl", "md")
+        nld_sp_results_nlp_nl2 = named_entity_recognition_sp(nld_sent, nlp_nl2, prefilter=prefilter)
+
+Attributes:
+    PREFILTER_DIR (str): Directory of the calibrated prefilters. Can be set
+        with the environment variable NER_PREFILTER_DIR.
+    FEATURES (list[str]): The names of the features.
+    THRESHOLDS (list[float]): The thresholds of the calibration report.
+
+"""
+
+import argparse
+import collections
+import hashlib
+import json
+import os
+import re
+
+import numpy as np
+from spacy.tokens import Doc
+
+from batching import chunks
+from cache import DEFAULT_CACHE_DIR, predict_reference
+from corpora import read_corpus
+from models import LANGUAGES, STANZA_PIPELINES, load, pipeline_name
+from router import STOPWORDS
+
+PREFILTER_DIR = os.environ.get("NER_PREFILTER_DIR", os.path.join(DEFAULT_CACHE_DIR, "prefilter"))
+
+FEATURES = ["capitalized", "all_caps", "digits", "gazetteer", "length"]
+
+THRESHOLDS = [0.01, 0.02, 0.05, 0.1, 0.2, 0.3, 0.5, 0.7]
+
+_WORD = re.compile(r"\w+")
+
+class Prefilter:
+    """Scores sentences by how likely they contain named entities.
+
+    Args:
+        lang (str): The language code.
+        weights (list[float]): The bias followed by one weight per feature.
+            Defaults to the untrained heuristic.
+        gazetteer (Iterable[str]): Lowercase words of known entities.
+        threshold (float): Sentences with a lower score are skipped.
+
+    """
+
+    def __init__(self, lang, weights=None, gazetteer=(), threshold=0.5):
+        self.lang = lang
+        self.weights = np.array(weights if weights is not None else [-2.0, 6.0, 6.0, 6.0, 6.0, 0.0])
+        self.gazetteer = set(gazetteer)
+        self.threshold = threshold
+        self.stopwords = STOPWORDS.get(lang, set())
+
+    def features(self, sentences):
+        """Computes the feature matrix of a list of sentences.
+
+        Returns:
+            ndarray: One row per sentence: 1 for the bias, then FEATURES.
+
+        """
+
+        rows = np.zeros((len(sentences), len(FEATURES) + 1))
+        rows[:, 0] = 1
+        for i, sentence in enumerate(sentences):
+            words = _WORD.findall(str(sentence))
+            rows[i, 1] = sum(word[0].isupper() for word in words[1:])
+            rows[i, 1] += bool(words) and words[0][0].isupper() and words[0].lower() not in self.stopwords
+            rows[i, 2] = sum(len(word) > 1 and word.isupper() for word in words)
+            rows[i, 3] = sum(any(c.isdigit() for c in word) for word in words)
+            rows[i, 4] = sum(word.lower() in self.gazetteer for word in words)
+            rows[i, 5] = len(words)
+        rows[:, 1:] = np.log1p(rows[:, 1:])
+        return rows
+
+    def scores(self, sentences):
+        """Returns the probability of every sentence to contain an entity."""
+
+        return 1 / (1 + np.exp(-self.features(sentences) @ self.weights))
+
+    def keep(self, sentences):
+        """Returns a boolean mask of the sentences that are passed to the pipeline."""
+
+        return self.scores(sentences) >= self.threshold
+
+    def fit(self, sentences, has_entities, epochs=300, learning_rate=0.5, l2=1e-3, entities=None):
+        """Learns the weights, and the gazetteer if entities are given.
+
+        Args:
+            sentences (list[str]): Training sentences.
+            has_entities (list[bool]): Whether the full pipeline found an
+                entity in each sentence.
+            epochs (int): Number of gradient descent steps.
+            learning_rate (float): Step size.
+            l2 (float): L2 penalty of the feature weights.
+            entities (list[list]): [[start_char, end_char, 'LABEL']] of each
+                sentence, for the gazetteer.
+
+        Returns:
+            Prefilter: self.
+
+        """
+
+        if entities is not None:
+            self.gazetteer = {word.lower() for sentence, ents in zip(sentences, entities) for start, end, _ in ents
+                              for word in _WORD.findall(str(sentence)[start:end]) if word.lower() not in self.stopwords}
+        x = self.features(sentences)
+        y = np.asarray(has_entities, dtype=float)
+        penalty = np.full(x.shape[1], l2)
+        penalty[0] = 0  # The bias is not penalized.
+        for _ in range(epochs):
+            p = 1 / (1 + np.exp(-x @ self.weights))
+            self.weights -= learning_rate * (x.T @ (p - y) / len(y) + penalty * self.weights)
+        return self
+
+    def to_dict(self):
+        return {"lang": self.lang, "weights": self.weights.tolist(), "gazetteer": sorted(self.gazetteer), "threshold": self.threshold}
+
+    def digest(self):
+        """Returns a short hash of the weights, gazetteer and threshold."""
+
+        data = json.dumps(self.to_dict(), sort_keys=True, ensure_ascii=False)
+        return hashlib.sha1(data.encode("utf-8")).hexdigest()[:12]
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["lang"], data["weights"], data["gazetteer"], data["threshold"])
+
+    def save(self, path):
+        """Writes the prefilter as JSON."""
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as prefilter_file:
+            json.dump(self.to_dict(), prefilter_file, ensure_ascii=False)
+
+def prefilter_path(lang, tagger):
+    """Returns the path of the calibrated prefilter of a language and tagger."""
+
+    return os.path.join(PREFILTER_DIR, "{}_{}.json".format(lang, tagger))
+
+def load_prefilter(lang, tagger, threshold=None):
+    """Loads a calibrated prefilter.
+
+    Args:
+        lang (str): The language code.
+        tagger (str): The tagger it was calibrated for, e.g. "md".
+        threshold (float): Replaces the calibrated threshold.
+
+    Returns:
+        Prefilter: The prefilter.
+
+    """
+
+    with open(prefilter_path(lang, tagger), encoding="utf-8") as prefilter_file:
+        prefilter = Prefilter.from_dict(json.load(prefilter_file))
+    if threshold is not None:
+        prefilter.threshold = threshold
+    return prefilter
+
+def tag_filtered(lang_sent, prefilter, tag, batch_size=1000, with_ids=False):
+    """Tags only the sentences that pass the prefilter.
+
+    Args:
+        lang_sent (Iterable[str]): The sentences, or (sentence id, sentence)
+            tuples if with_ids is True.
+        prefilter (Prefilter): The prefilter.
+        tag (Callable): Takes an iterable of sentences and yields one
+            ('Sentence.', [[start_char, end_char, 'LABEL']]) per sentence in
+            order, e.g. tag_sentences_sp with its pipeline.
+        batch_size (int): Number of sentences scored at once.
+        with_ids (bool): Whether lang_sent contains (sentence id, sentence)
+            tuples.
+
+    Yields:
+        tuple: ('Sentence.', [[...]]) or (id, 'Sentence.', [[...]]) per
+            sentence in input order. Skipped sentences get [].
+
+    """
+
+    pending = collections.deque()  # (record, kept) in input order.
+
+    def kept():
+        for batch in chunks(lang_sent, batch_size):
+            for record, keep in zip(batch, prefilter.keep([record[1] if with_ids else record for record in batch])):
+                pending.append((record, keep))
+                if keep:
+                    yield str(record[1] if with_ids else record)
+
+    def result(record, entities):
+        return (record[0], str(record[1]), entities) if with_ids else (str(record), entities)
+
+    for _, entities in tag(kept()):
+        while not pending[0][1]:
+            yield result(pending.popleft()[0], [])
+        yield result(pending.popleft()[0], entities)
+    while pending:  # Skipped sentences after the last tagged one.
+        yield result(pending.popleft()[0], [])
+
+def predict_filtered(sentences, nlp_model, prefilter, cache=None, batch_size=1000):
+    """Predicts entities with the evaluation pipeline for likely sentences only.
+
+    Args:
+        sentences (Iterable[str or Doc]): The sentences.
+        nlp_model (Language): The spaCy pipeline used for evaluation.
+        prefilter (Prefilter): The prefilter, calibrated for nlp_model.
+        cache (DiskCache): Cache of the predictions of nlp_model.
+        batch_size (int): Number of sentences per batch.
+
+    Yields:
+        Doc: One predicted Doc per sentence in input order. Skipped
+            sentences get a Doc without entities.
+
+    """
+
+    pending = collections.deque()  # (sentence, kept) in input order.
+
+    def kept():
+        for batch in chunks(sentences, batch_size):
+            for sentence, keep in zip(batch, prefilter.keep([str(sentence) for sentence in batch])):
+                pending.append((sentence, keep))
+                if keep:
+                    yield sentence
+
+    def skipped(sentence):
+        return sentence if isinstance(sentence, Doc) else nlp_model.make_doc(str(sentence))
+
+    for predicted in predict_reference(kept(), nlp_model, cache, batch_size):
+        while not pending[0][1]:
+            yield skipped(pending.popleft()[0])
+        pending.popleft()
+        yield predicted
+    while pending:  # Skipped sentences after the last predicted one.
+        yield skipped(pending.popleft()[0])
+
+def calibration_report(prefilter, results, thresholds=THRESHOLDS):
+    """Measures what skipping sentences costs against the full pipeline.
+
+    Args:
+        prefilter (Prefilter): The prefilter.
+        results (list[tuple]): Results of the full pipeline, ('Sentence.',
+            [[start_char, end_char, 'LABEL']]), optionally with ids first.
+            Should not be the training sentences.
+        thresholds (list[float]): The thresholds to report.
+
+    Returns:
+        list[dict]: Per threshold: the share of sentences skipped, the share
+            of sentences with entities skipped, the share of entities lost
+            (recall lost) and the estimated speedup of the pipeline.
+
+    """
+
+    sentences = [result[-2] for result in results]
+    n_entities = np.array([len(result[-1]) for result in results])
+    scores = prefilter.scores(sentences)
+    rows = []
+    for threshold in thresholds:
+        skipped = scores < threshold
+        share = float(skipped.mean()) if len(skipped) else 0.0
+        rows.append({
+            "threshold": threshold,
+            "skipped": share,
+            "entity_sentences_skipped": float(skipped[n_entities > 0].mean()) if (n_entities > 0).any() else 0.0,
+            "recall_lost": float(n_entities[skipped].sum() / max(n_entities.sum(), 1)),
+            "speedup": 1 / max(1 - share, 1e-9),  # If the pipeline time is proportional to the sentences it tags.
+        })
+    return rows
+
+def choose_threshold(rows, max_recall_loss=0.01):
+    """Returns the highest threshold that loses at most max_recall_loss of the entities.
+
+    Returns:
+        float: The threshold, or 0 (nothing skipped) if none qualifies.
+
+    """
+
+    return max((row["threshold"] for row in rows if row["recall_lost"] <= max_recall_loss), default=0.0)
+
+def calibrate(lang, tagger="md", sample=10000, max_recall_loss=0.01, batch_size=1000):
+    """Trains and calibrates a prefilter against the full pipeline.
+
+    A sample of the corpus is tagged with the full pipeline (using the
+    tagging cache). Every other sentence is used for training, the rest for
+    the calibration report.
+
+    Args:
+        lang (str): The language code.
+        tagger (str): A key of TAGGERS or EVALUATORS.
+        sample (int): Number of corpus sentences.
+        max_recall_loss (float): The share of entities that may be lost.
+        batch_size (int): Number of sentences per batch.
+
+    Returns:
+        tuple: The Prefilter with the chosen threshold and the report rows.
+
+    """
+
+    name = pipeline_name(tagger, lang)
+    sentences = read_corpus(lang, stop=sample)
+    # Imported here, since both modules import this one.
+    if name in STANZA_PIPELINES:
+        from stanza_test import tag_sentences_st
+        results = list(tag_sentences_st(sentences, load(name), batch_size, cache=None))
+    else:
+        from spacy_test import tag_sentences_sp
+        results = list(tag_sentences_sp(sentences, load(name), batch_size, cache=None))
+    train, test = results[::2], results[1::2]
+    prefilter = Prefilter(lang).fit([s for s, _ in train], [bool(e) for _, e in train], entities=[e for _, e in train])
+    rows = calibration_report(prefilter, test)
+    prefilter.threshold = choose_threshold(rows, max_recall_loss)
+    return prefilter, rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Calibrates entity prefilters against the full pipelines.")
+    parser.add_argument("--languages", nargs="+", default=list(LANGUAGES))
+    parser.add_argument("--tagger", default="md", help="md, lg, multi or stanza")
+    parser.add_argument("--sample", type=int, default=10000)
+    parser.add_argument("--max-recall-loss", type=float, default=0.01)
+    parser.add_argument("--output", help="write the reports of all languages as JSON")
+    args = parser.parse_args(argv)
+
+    reports = {}
+    for lang in args.languages:
+        prefilter, rows = calibrate(lang, args.tagger, args.sample, args.max_recall_loss)
+        prefilter.save(prefilter_path(lang, args.tagger))
+        reports[lang] = {"threshold": prefilter.threshold, "weights": dict(zip(["bias"] + FEATURES, prefilter.weights.tolist())), "rows": rows}
+        print("{} {}: threshold {} (saved to {})".format(lang, args.tagger, prefilter.threshold, prefilter_path(lang, args.tagger)))
+        print("  threshold  skipped  entity sentences skipped  recall lost  speedup")
+        for row in rows:
+            print("  {threshold:9.2f}  {skipped:7.1%}  {entity_sentences_skipped:24.1%}  {recall_lost:11.2%}  {speedup:6.2f}x".format(**row))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(reports, output, indent=1)
+
+if __name__ == "__main__":
+    main()
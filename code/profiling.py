@@ -0,0 +1,282 @@
+"""Measures where tagging and evaluation spend their time, per component.
+
+A Profiler is attached to spaCy and Stanza pipelines for the duration of a
+run. It wraps the tokenizer and every component of a spaCy pipeline and every
+processor of a Stanza pipeline, and records per component the wall time, the
+number of calls, the number of documents and, optionally, the memory
+allocated by Python (tracemalloc). Components of spaCy pipelines process the
+documents as chained generators, so every measurement excludes the time and
+memory of the components nested inside it: the numbers of all components add
+up to the time spent in the pipeline.
+
+The report lists the components of every pipeline with their share of the
+run time as bars, next to the evaluation scores. folded() returns the same
+numbers in the folded stack format of flame graph tools.
+
+Memory allocated by PyTorch and other native libraries is not seen by
+tracemalloc, and tracemalloc slows down the run, so memory tracing is off by
+default. Profiling only works in the current process (n_process = 1).
+
+Requires "argparse", "collections", "contextlib", "functools", "json", "os",
+"time", "tracemalloc", "spacy", and "stanza".
+
+Example:
+    profiler = Profiler()
+    with profiler.attach(nlp_de2, "nlp_de2"), profiler.attach(nlp_de3, "nlp_de3"):
+        scores = evaluate_ner_sp(named_entity_recognition_sp(sentences, nlp_de2), nlp_de3, cache=False)
+    print(profiler.report(scores))
+
+    Or from the code directory::
+
+        python profiling.py --lang de --tagger stanza --evaluator lg --size 1000 --memory
+
+"""
+
+import argparse
+import collections
+import contextlib
+import functools
+import json
+import os
+import time
+import tracemalloc
+
+from corpora import read_corpus
+from models import STANZA_PIPELINES, load, pipeline_name
+
+class _Timed:
+    """Stands in for a spaCy component or tokenizer and times it."""
+
+    def __init__(self, profiler, name, component):
+        self._profiler = profiler
+        self._name = name
+        self._component = component
+
+    def __getattr__(self, attribute):
+        return getattr(self._component, attribute)
+
+    def __call__(self, doc, *args, **kwargs):
+        return self._profiler.call(self._name, self._component, doc, *args, **kwargs)
+
+    def pipe(self, docs, *args, **kwargs):
+        if not hasattr(self._component, "pipe"):  # Function components only process single documents.
+            return (self(doc) for doc in docs)
+        self._profiler.stats[self._name]["calls"] += 1
+        return self._profiler.iterate(self._name, self._component.pipe(docs, *args, **kwargs))
+
+class Profiler:
+    """Collects the time and memory of pipeline components.
+
+    Args:
+        memory (bool): Whether to trace memory allocations with tracemalloc.
+
+    Attributes:
+        stats (dict): Per component ("pipeline/component"): seconds, calls,
+            docs and alloc_bytes (net Python allocations).
+
+    """
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.stats = collections.defaultdict(lambda: {"seconds": 0.0, "calls": 0, "docs": 0, "alloc_bytes": 0})
+        self._stack = []
+
+    def _enter(self, name):
+        memory = tracemalloc.get_traced_memory()[0] if self.memory else 0
+        self._stack.append([time.perf_counter(), memory, 0.0, 0, name])
+
+    def _exit(self, name, docs):
+        start_time, start_memory, child_seconds, child_memory, _ = self._stack.pop()
+        seconds = time.perf_counter() - start_time
+        memory = (tracemalloc.get_traced_memory()[0] - start_memory) if self.memory else 0
+        stats = self.stats[name]
+        stats["seconds"] += seconds - child_seconds  # Time of nested components is counted for them.
+        stats["alloc_bytes"] += memory - child_memory
+        stats["docs"] += docs
+        if self._stack:
+            self._stack[-1][2] += seconds
+            self._stack[-1][3] += memory
+
+    def call(self, name, function, *args, **kwargs):
+        """Calls a component that processes one document and times it."""
+
+        if self._stack and self._stack[-1][4] == name:  # Called by the same component, e.g. from bulk_process.
+            return function(*args, **kwargs)
+        self.stats[name]["calls"] += 1
+        self._enter(name)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self._exit(name, 1)
+
+    def iterate(self, name, iterator):
+        """Times every step of a component that yields documents."""
+
+        iterator = iter(iterator)
+        while True:
+            self._enter(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self._exit(name, 0)
+                return
+            except BaseException:
+                self._exit(name, 0)
+                raise
+            self._exit(name, 1)
+            yield item
+
+    def _bulk(self, name, function):
+        def timed(docs, *args, **kwargs):
+            self.stats[name]["calls"] += 1
+            self._enter(name)
+            try:
+                return function(docs, *args, **kwargs)
+            finally:
+                self._exit(name, len(docs))
+        return timed
+
+    @contextlib.contextmanager
+    def attach(self, nlp_model, label=None):
+        """Wraps the components of a pipeline while the context is active.
+
+        Args:
+            nlp_model (Language or Pipeline): A spaCy or Stanza pipeline.
+            label (str): Name of the pipeline in the report. Defaults to the
+                model fingerprint.
+
+        """
+
+        if label is None:
+            from cache import model_fingerprint
+            label = model_fingerprint(nlp_model)
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if hasattr(nlp_model, "pipe_names"):  # spaCy pipeline.
+            components = list(nlp_model._components)
+            tokenizer = nlp_model.tokenizer
+            nlp_model.tokenizer = _Timed(self, label + "/tokenizer", tokenizer)
+            nlp_model._components[:] = [(name, _Timed(self, label + "/" + name, proc)) for name, proc in components]
+            try:
+                yield self
+            finally:
+                nlp_model.tokenizer = tokenizer
+                nlp_model._components[:] = components
+        else:  # Stanza pipeline.
+            processors = nlp_model.processors
+            for name, processor in processors.items():  # Instance attributes hide the methods of the class.
+                processor.process = functools.partial(self.call, label + "/" + name, type(processor).process, processor)
+                processor.bulk_process = self._bulk(label + "/" + name, functools.partial(type(processor).bulk_process, processor))
+            try:
+                yield self
+            finally:
+                for processor in processors.values():
+                    del processor.process, processor.bulk_process
+
+    def to_dict(self):
+        """Returns the statistics sorted by time."""
+
+        return dict(sorted(self.stats.items(), key=lambda item: -item[1]["seconds"]))
+
+    def folded(self):
+        """Returns the statistics in the folded stack format of flame graphs.
+
+        Returns:
+            str: One line "pipeline;component microseconds" per component.
+
+        """
+
+        return "".join("{} {}\n".format(name.replace("/", ";"), int(stats["seconds"] * 1e6)) for name, stats in self.stats.items())
+
+    def report(self, scores=None, total_seconds=None, width=40):
+        """Formats a breakdown of the run time by pipeline and component.
+
+        Args:
+            scores (dict): Evaluation scores shown above the breakdown.
+            total_seconds (float): Wall time of the run. The time outside
+                of all components is shown as "other".
+            width (int): Width of the longest bar.
+
+        Returns:
+            str: The report.
+
+        """
+
+        lines = []
+        if scores:
+            lines.append("Scores: P {} R {} F {}".format(scores.get("ents_p"), scores.get("ents_r"), scores.get("ents_f")))
+        pipelines = collections.OrderedDict()
+        for name, stats in self.to_dict().items():
+            pipelines.setdefault(name.split("/")[0], []).append((name.split("/", 1)[1], stats))
+        measured = sum(stats["seconds"] for stats in self.stats.values())
+        total = max(total_seconds or measured, measured, 1e-9)
+        for label, components in pipelines.items():
+            seconds = sum(stats["seconds"] for _, stats in components)
+            lines.append("{:<28} {:9.3f}s {:6.1%} {}".format(label, seconds, seconds / total, "#" * round(width * seconds / total)))
+            for name, stats in components:
+                lines.append("  {:<26} {:9.3f}s {:6.1%} {:<{}} {:>8} calls {:>9} docs{}".format(
+                    name, stats["seconds"], stats["seconds"] / total, "#" * round(width * stats["seconds"] / total), width,
+                    stats["calls"], stats["docs"], " {:+.1f} MB".format(stats["alloc_bytes"] / 1024 ** 2) if self.memory else ""))
+        if total_seconds:
+            other = total_seconds - measured
+            lines.append("{:<28} {:9.3f}s {:6.1%}".format("other", other, other / total))
+        return "\n".join(lines)
+
+def profile_run(lang, tagger, evaluator, size=1000, batch_size=1000, memory=False):
+    """Tags and evaluates a corpus slice with profiled pipelines.
+
+    Evaluation does not use the prediction cache, so the evaluation pipeline
+    is measured as well.
+
+    Args:
+        lang (str): The language code.
+        tagger (str): A key of TAGGERS.
+        evaluator (str): A key of EVALUATORS.
+        size (int): Number of corpus sentences.
+        batch_size (int): Number of sentences per batch.
+        memory (bool): Whether to trace memory allocations.
+
+    Returns:
+        tuple: The Profiler, the scores and the wall time in seconds.
+
+    """
+
+    from scoring import make_examples, score_examples
+    from spacy_test import tag_sentences_sp
+    from stanza_test import tag_sentences_st
+
+    tagger_name, evaluator_name = pipeline_name(tagger, lang), pipeline_name(evaluator, lang)
+    tagger_model, evaluator_model = load(tagger_name), load(evaluator_name)
+    tag = tag_sentences_st if tagger_name in STANZA_PIPELINES else tag_sentences_sp
+    profiler = Profiler(memory)
+    start_time = time.perf_counter()
+    with profiler.attach(tagger_model, tagger_name), profiler.attach(evaluator_model, evaluator_name):
+        results = list(tag(read_corpus(lang, stop=size), tagger_model, batch_size))
+        scores = score_examples(make_examples(results, evaluator_model, cache=False, batch_size=batch_size)).scores()
+    return profiler, scores, time.perf_counter() - start_time
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Profiles the components of a tagger and an evaluator.")
+    parser.add_argument("--lang", default="de")
+    parser.add_argument("--tagger", default="md")
+    parser.add_argument("--evaluator", default="lg")
+    parser.add_argument("--size", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--memory", action="store_true", help="trace Python memory allocations (slower)")
+    parser.add_argument("--output", help="directory for report.txt, profile.json and profile.folded")
+    args = parser.parse_args(argv)
+
+    profiler, scores, seconds = profile_run(args.lang, args.tagger, args.evaluator, args.size, args.batch_size, args.memory)
+    report = profiler.report(scores, seconds)
+    print(report)
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+        with open(os.path.join(args.output, "report.txt"), "w", encoding="utf-8") as output:
+            output.write(report + "\n")
+        with open(os.path.join(args.output, "profile.json"), "w", encoding="utf-8") as output:
+            json.dump({"config": vars(args), "seconds": seconds, "scores": scores, "components": profiler.to_dict()}, output, indent=1)
+        with open(os.path.join(args.output, "profile.folded"), "w", encoding="utf-8") as output:
+            output.write(profiler.folded())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""Runs the Stanza NER and tokenizer models with int8 weights on the CPU.
+
+Our machines have no GPU, and on the CPU the NER processor takes most of the
+time of a Stanza pipeline. Dynamic quantization stores the weights of the
+LSTM and linear layers as 8-bit integers and quantizes the activations on
+the fly, which makes these layers faster and smaller on the CPU at a small
+cost in accuracy. The quantized models are saved in QUANTIZED_DIR, named
+after a hash of the original weights, so a model is only quantized once, and
+another package or a re-downloaded model is quantized again.
+
+compare() tags the same corpus slice with the quantized and the original
+pipeline and reports the throughput of both and the change in precision,
+recall and F1-score, both against the spaCy evaluation pipeline and as the
+agreement of the quantized with the original predictions. The report is
+saved next to the quantized models. Measuring the change needs the original
+pipeline as well, so other quantized runs do not measure it again:
+named_entity_recognition_st prints their throughput together with the saved
+report of the same models (see run_report).
+
+Requires "argparse", "hashlib", "json", "os", "time", "torch", "spacy", and
+"stanza".
+
+Example:
+    nlp_de = load("stanza", "de", quantized=True)
+
+    Or compare from the code directory::
+
+        python quantize.py --lang de --size 5000 --evaluator lg
+
+Attributes:
+    QUANTIZED_DIR (str): Directory of the quantized models. Can be set with
+        the environment variable NER_QUANTIZED_DIR.
+    QUANTIZED_PROCESSORS (list[str]): The Stanza processors that are
+        quantized.
+
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import torch
+
+from cache import DEFAULT_CACHE_DIR, model_fingerprint
+from corpora import read_corpus
+from models import load, pipeline_name
+
+QUANTIZED_DIR = os.environ.get("NER_QUANTIZED_DIR", os.path.join(DEFAULT_CACHE_DIR, "quantized"))
+
+QUANTIZED_PROCESSORS = ["tokenize", "ner"]
+
+def _trainers(processor):
+    # NER processors hold a list of trainers (one per model), the other
+    # processors a single one. A pretokenized tokenizer has no trainer.
+    trainers = getattr(processor, "trainers", None) or [processor._trainer]
+    return [trainer for trainer in trainers if trainer is not None]
+
+def _state_digest(model):
+    digest = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        digest.update(name.encode("utf-8"))
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()[:12]
+
+def _load_module(path):
+    try:
+        return torch.load(path, map_location="cpu", weights_only=False)
+    except TypeError:  # torch < 1.13 has no weights_only and always unpickles.
+        return torch.load(path, map_location="cpu")
+
+def quantize_pipeline(nlp_model, processors=QUANTIZED_PROCESSORS, directory=QUANTIZED_DIR):
+    """Replaces the models of Stanza processors with int8 quantized models.
+
+    Args:
+        nlp_model (Pipeline): A Stanza pipeline loaded with use_gpu=False.
+        processors (list[str]): The processors to quantize.
+        directory (str): Where quantized models are stored and reused.
+
+    Returns:
+        Pipeline: nlp_model.
+
+    Raises:
+        ValueError: The pipeline runs on the GPU. Quantized models only run
+            on the CPU.
+
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    fingerprint = model_fingerprint(nlp_model).replace(":", "_").replace(",", "-")
+    digests = []
+    for name in processors:
+        if name not in nlp_model.processors:
+            continue
+        for i, trainer in enumerate(_trainers(nlp_model.processors[name])):
+            if any(parameter.is_cuda for parameter in trainer.model.parameters()):
+                raise ValueError("Quantized models only run on the CPU. Load the pipeline with use_gpu=False.")
+            digests.append(_state_digest(trainer.model))  # Tells apart packages and model files of the same processor.
+            path = os.path.join(directory, "{}_{}_{}_{}.pt".format(fingerprint, name, i, digests[-1]))
+            if os.path.exists(path):
+                trainer.model = _load_module(path)
+                continue
+            trainer.model = torch.quantization.quantize_dynamic(trainer.model, {torch.nn.LSTM, torch.nn.Linear}, dtype=torch.qint8)
+            temporary = "{}.{}.part".format(path, os.getpid())  # Worker processes may quantize the same model at once.
+            torch.save(trainer.model, temporary)
+            os.replace(temporary, path)
+    nlp_model.quantized = True  # Changes the fingerprint, so cached predictions are kept apart.
+    nlp_model.quantized_id = hashlib.sha1("".join(digests).encode("utf-8")).hexdigest()[:12]
+    return nlp_model
+
+def report_path(nlp_model, directory=QUANTIZED_DIR):
+    """Returns the path of the saved compare() report of a quantized pipeline."""
+
+    return os.path.join(directory, "report_{}_{}.json".format(nlp_model.lang, nlp_model.quantized_id))
+
+def run_report(nlp_model, n_sentences, seconds):
+    """Describes a run of a quantized pipeline.
+
+    Args:
+        nlp_model (Pipeline): The quantized pipeline.
+        n_sentences (int): Number of sentences tagged.
+        seconds (float): Wall time of the run.
+
+    Returns:
+        str: The throughput of the run, and the speedup and change in
+            precision, recall and F1-score from the saved compare() report
+            of the same models, or how to make that report.
+
+    """
+
+    line = "Quantized {}: {} sentences in {:.1f}s ({:.1f} sentences/s).".format(
+        model_fingerprint(nlp_model), n_sentences, seconds, n_sentences / max(seconds, 1e-9))
+    path = report_path(nlp_model)
+    if not os.path.exists(path):
+        return line + " Not compared with the original yet, run python quantize.py --lang {} for the change in accuracy.".format(nlp_model.lang)
+    with open(path, encoding="utf-8") as report_file:
+        report = json.load(report_file)
+    parts = ["speedup {:.2f}x".format(report["speedup"])]
+    if "delta" in report:
+        parts.append("delta P {ents_p:+.4f} R {ents_r:+.4f} F {ents_f:+.4f} ({evaluator})".format(evaluator=report["evaluator"], **report["delta"]))
+    parts.append("agreement with the original F {:.4f}".format(report["agreement"]["f"]))
+    return line + " Compared with the original on {} sentences ({}): {}.".format(report["size"], report["created"], ", ".join(parts))
+
+def agreement(reference, results):
+    """Scores tagging results against other results of the same sentences.
+
+    Args:
+        reference (list[tuple]): The reference results.
+        results (list[tuple]): The results to score, in the same order.
+
+    Returns:
+        dict: Entity precision "p", recall "r" and F1-score "f" of exact
+            matches.
+
+    """
+
+    tp = fp = fn = 0
+    for (_, gold), (_, predicted) in zip(reference, results):
+        gold, predicted = {tuple(e) for e in gold}, {tuple(e) for e in predicted}
+        tp += len(gold & predicted)
+        fp += len(predicted - gold)
+        fn += len(gold - predicted)
+    p = tp / (tp + fp) if tp + fp else 0.0
+    r = tp / (tp + fn) if tp + fn else 0.0
+    return {"p": p, "r": r, "f": 2 * p * r / (p + r) if p + r else 0.0}
+
+def compare(lang, size=1000, evaluator="lg", chunk_size=1000, torch_threads=None):
+    """Tags a corpus slice with the original and the quantized pipeline.
+
+    Args:
+        lang (str): The language code.
+        size (int): Number of corpus sentences.
+        evaluator (str): A key of EVALUATORS, or None to skip the
+            evaluation.
+        chunk_size (int): Number of sentences per pipeline call.
+        torch_threads (int): Number of torch threads. None keeps the default.
+
+    Returns:
+        dict: Throughput and scores of both pipelines and their differences.
+            It is also saved for run_report().
+
+    """
+
+    from scoring import make_examples, score_examples
+    from stanza_test import tag_sentences_st
+
+    if torch_threads is not None:
+        torch.set_num_threads(torch_threads)
+    sentences = list(read_corpus(lang, stop=size))
+    report = {"lang": lang, "size": len(sentences), "evaluator": evaluator, "torch_threads": torch.get_num_threads(),
+              "created": time.strftime("%Y-%m-%d %H:%M:%S")}
+    results = {}
+    for variant, quantized in (("original", False), ("quantized", True)):
+        nlp_model = load("stanza", lang, use_gpu=False, quantized=quantized)
+        start_time = time.perf_counter()
+        results[variant] = list(tag_sentences_st(sentences, nlp_model, chunk_size))
+        seconds = time.perf_counter() - start_time
+        report[variant] = {"seconds": seconds, "sentences_per_s": len(sentences) / max(seconds, 1e-9)}
+        if evaluator:
+            scores = score_examples(make_examples(results[variant], load(pipeline_name(evaluator, lang)))).scores()
+            report[variant].update({name: scores[name] for name in ("ents_p", "ents_r", "ents_f")})
+    report["speedup"] = report["quantized"]["sentences_per_s"] / report["original"]["sentences_per_s"]
+    if evaluator:
+        report["delta"] = {name: report["quantized"][name] - report["original"][name] for name in ("ents_p", "ents_r", "ents_f")}
+    report["agreement"] = agreement(results["original"], results["quantized"])
+    with open(report_path(nlp_model), "w", encoding="utf-8") as report_file:  # nlp_model is the quantized pipeline.
+        json.dump(report, report_file, indent=1)
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compares quantized and original Stanza NER on a corpus slice.")
+    parser.add_argument("--lang", default="de")
+    parser.add_argument("--size", type=int, default=1000)
+    parser.add_argument("--evaluator", default="lg", help="lg, multi or none")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--torch-threads", type=int)
+    parser.add_argument("--output", help="write the report as JSON")
+    args = parser.parse_args(argv)
+
+    report = compare(args.lang, args.size, None if args.evaluator == "none" else args.evaluator, args.chunk_size, args.torch_threads)
+    for variant in ("original", "quantized"):
+        print("{:<10} {:8.1f} sentences/s".format(variant, report[variant]["sentences_per_s"]), end="")
+        print("  P {ents_p:.4f} R {ents_r:.4f} F {ents_f:.4f}".format(**report[variant]) if "ents_f" in report[variant] else "")
+    print("Speedup {:.2f}x".format(report["speedup"]))
+    if "delta" in report:
+        print("Delta P {ents_p:+.4f} R {ents_r:+.4f} F {ents_f:+.4f}".format(**report["delta"]))
+    print("Agreement with original: P {p:.4f} R {r:.4f} F {f:.4f}".format(**report["agreement"]))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(report, output, indent=1)
+
+if __name__ == "__main__":
+    main()
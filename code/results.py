@@ -1,9 +1,11 @@
 """Prints results.
 
 Imports and executes functions from spacy_test.py and stanza_test.py on
-lists from corpora.py. If desired, the results of named_entity_recognition_sp/
-named_entity_recognition_st can be exported to a .csv file with pandas. This 
+sentences read with corpora.py. If desired, the results of
+named_entity_recognition_sp/named_entity_recognition_st can be exported to a .csv file with pandas. This 
 file is purely for legibility and should not be used before further editing.
+For further processing, export_run writes the results to a columnar run
+directory instead (see results_store.py).
 
 This module requires "pandas", "time", "csv", "spacy", and "stanza".
 
@@ -11,11 +13,12 @@ Example:
     Follow the naming of the variables and run one pipeline and its evaluation at a
     time. Otherwise, the results will be skewed::
     
-        ger_sp_results_nlp_de2 = named_entity_recognition_sp(ger_sent[:163111], nlp_de2)
+        ger_sp_results_nlp_de2 = named_entity_recognition_sp(read_corpus("de", stop=163111), load("nlp_de2"))
         print(ger_sp_results_nlp_de2)  # Optional.
-        ger_sp_results_nlp_de2_eval = evaluate_ner_sp(ger_sp_results_nlp_de2, nlp_de3)
+        ger_sp_results_nlp_de2_eval = evaluate_ner_sp(ger_sp_results_nlp_de2, load("nlp_de3"))
         print(ger_sp_results_nlp_de2_eval)
         export_to_csv(ger_sp_results_nlp_de2)  # Optional.
+        export_run(ger_sp_results_nlp_de2, "ger_sp_results_nlp_de2", tagger="nlp_de2")  # Optional.
 
 Attributes:
     start_time_all (float): Tracks CPU time across the entire module.
@@ -83,12 +86,15 @@ Attributes:
     
 """
 
+import os
 import pandas as pd
 import time
 
-from corpora import ger_sent, eng_sent, nld_sent
-from spacy_test import *
-from stanza_test import *
+from corpora import read_corpus
+from models import load
+from results_store import RunStore, RunWriter
+from spacy_test import named_entity_recognition_sp, evaluate_ner_sp
+from stanza_test import named_entity_recognition_st, evaluate_ner_st
 
 def export_to_csv(result):
     """Exports annotation results to a .csv file.
@@ -107,6 +113,30 @@ def export_to_csv(result):
     df.to_csv(r"./results.csv", index=False, header=True, mode="a", encoding="utf-8-sig")
     return df
 
+def export_run(result, name, **meta):
+    """Exports annotation results to a columnar run directory.
+
+    Unlike export_to_csv, every run gets its own directory in ./runs, and the
+    entities are stored as integer columns that can be read back with
+    RunStore from results_store.py.
+
+    Args:
+        result (Iterable[tuple]): The result from named_entity_recognition_sp/
+            named_entity_recognition_st, or the generator of
+            tag_sentences_sp/tag_sentences_st to write while tagging.
+        name (str): Name of the run, e.g. "ger_sp_results_nlp_de2".
+        **meta: Metadata of the run, e.g. tagger="nlp_de2".
+
+    Returns:
+        RunStore: The stored run.
+
+    """
+
+    with RunWriter(os.path.join(r"./runs", name), **meta) as writer:
+        for _ in writer.tee(result):
+            pass
+    return RunStore(os.path.join(r"./runs", name))
+
 start_time_all = time.process_time()
 
 print()
@@ -115,19 +145,21 @@ print("spaCy:")
 print("German:")
 start_time_ger = time.process_time()
 print("Tagging German...")
-ger_sp_results_nlp_de2 = named_entity_recognition_sp(ger_sent[:163111], nlp_de2)
-#ger_sp_results_nlp_multi = named_entity_recognition_sp(ger_sent[:163111], nlp_multi)
+ger_sp_results_nlp_de2 = named_entity_recognition_sp(read_corpus("de", stop=163111), load("nlp_de2"))
+#ger_sp_results_nlp_multi = named_entity_recognition_sp(read_corpus("de", stop=163111), load("nlp_multi"))
 print(ger_sp_results_nlp_de2)
 #print(ger_sp_results_nlp_multi)
 
 print("Evaluating German...")
-ger_sp_results_nlp_de2_eval = evaluate_ner_sp(ger_sp_results_nlp_de2, nlp_de3)
-#ger_sp_results_nlp_multi_eval = evaluate_ner_sp(ger_sp_results_nlp_multi, nlp_de3)
+ger_sp_results_nlp_de2_eval = evaluate_ner_sp(ger_sp_results_nlp_de2, load("nlp_de3"))
+#ger_sp_results_nlp_multi_eval = evaluate_ner_sp(ger_sp_results_nlp_multi, load("nlp_de3"))
 print(ger_sp_results_nlp_de2_eval)
 #print(ger_sp_results_nlp_multi_eval)
 
 #export_to_csv(ger_sp_results_nlp_de2)
+#export_run(ger_sp_results_nlp_de2, "ger_sp_results_nlp_de2")
 #export_to_csv(ger_sp_results_nlp_multi)
+#export_run(ger_sp_results_nlp_multi, "ger_sp_results_nlp_multi")
 
 end_time_ger = time.process_time()
 print("Time: ", end_time_ger - start_time_ger)  
@@ -137,19 +169,21 @@ print()
 print("English:")
 start_time_eng = time.process_time()
 print("Tagging English...")
-#eng_sp_results_nlp_en2 = named_entity_recognition_sp(eng_sent[:163111], nlp_en2)
-#eng_sp_results_nlp_multi = named_entity_recognition_sp(eng_sent[:163111], nlp_multi)
+#eng_sp_results_nlp_en2 = named_entity_recognition_sp(read_corpus("en", stop=163111), load("nlp_en2"))
+#eng_sp_results_nlp_multi = named_entity_recognition_sp(read_corpus("en", stop=163111), load("nlp_multi"))
 #print(eng_sp_results_nlp_en2)
 #print(eng_sp_results_nlp_multi)
 
 print("Evaluating English...")
-#eng_sp_results_nlp_en2_eval = evaluate_ner_sp(eng_sp_results_nlp_en2, nlp_en3)
-#eng_sp_results_nlp_multi_eval = evaluate_ner_sp(eng_sp_results_nlp_multi, nlp_en3)
+#eng_sp_results_nlp_en2_eval = evaluate_ner_sp(eng_sp_results_nlp_en2, load("nlp_en3"))
+#eng_sp_results_nlp_multi_eval = evaluate_ner_sp(eng_sp_results_nlp_multi, load("nlp_en3"))
 #print(eng_sp_results_nlp_en2_eval)
 #print(eng_sp_results_nlp_multi_eval)
 
 #export_to_csv(eng_sp_results_nlp_en2)
+#export_run(eng_sp_results_nlp_en2, "eng_sp_results_nlp_en2")
 #export_to_csv(eng_sp_results_nlp_multi)
+#export_run(eng_sp_results_nlp_multi, "eng_sp_results_nlp_multi")
 
 end_time_eng = time.process_time()
 print("Time: ", end_time_eng - start_time_eng)  
@@ -159,19 +193,21 @@ print()
 print("Dutch:")
 start_time_nld = time.process_time()
 print("Tagging Dutch...")
-#nld_sp_results_nlp_nl2 = named_entity_recognition_sp(nld_sent, nlp_nl2)
-#nld_sp_results_nlp_multi = named_entity_recognition_sp(nld_sent, nlp_multi)
+#nld_sp_results_nlp_nl2 = named_entity_recognition_sp(read_corpus("nl"), load("nlp_nl2"))
+#nld_sp_results_nlp_multi = named_entity_recognition_sp(read_corpus("nl"), load("nlp_multi"))
 #print(nld_sp_results_nlp_nl2)
 #print(nld_sp_results_nlp_multi)
 
 print("Evaluating Dutch...")
-#nld_sp_results_nlp_nl2_eval = evaluate_ner_sp(nld_sp_results_nlp_nl2, nlp_nl3)
-#nld_sp_results_nlp_multi_eval = evaluate_ner_sp(nld_sp_results_nlp_multi, nlp_nl3)
+#nld_sp_results_nlp_nl2_eval = evaluate_ner_sp(nld_sp_results_nlp_nl2, load("nlp_nl3"))
+#nld_sp_results_nlp_multi_eval = evaluate_ner_sp(nld_sp_results_nlp_multi, load("nlp_nl3"))
 #print(nld_sp_results_nlp_nl2_eval)
 #print(nld_sp_results_nlp_multi_eval)
 
 #export_to_csv(nld_sp_results_nlp_nl2)
+#export_run(nld_sp_results_nlp_nl2, "nld_sp_results_nlp_nl2")
 #export_to_csv(nld_sp_results_nlp_multi)
+#export_run(nld_sp_results_nlp_multi, "nld_sp_results_nlp_multi")
 
 end_time_nld = time.process_time()
 print("Time: ", end_time_nld - start_time_nld)  
@@ -190,16 +226,17 @@ print("Stanza:")
 print("German:")
 start_time_ger = time.process_time()
 print("Tagging German...")
-#ger_st_results = named_entity_recognition_st(ger_sent[:163111], nlp_de)
+#ger_st_results = named_entity_recognition_st(read_corpus("de", stop=163111), load("nlp_de"))
 #print(ger_st_results)
 
 print("Evaluating German...")
-#ger_st_results_eval = evaluate_ner_st(ger_st_results, nlp_de3)
-#ger_st_results_multi_eval = evaluate_ner_st(ger_st_results, nlp_multi)
+#ger_st_results_eval = evaluate_ner_st(ger_st_results, load("nlp_de3"))
+#ger_st_results_multi_eval = evaluate_ner_st(ger_st_results, load("nlp_multi"))
 #print(ger_st_results_eval)
 #print(ger_st_results_multi_eval)
 
 #export_to_csv(ger_st_results)
+#export_run(ger_st_results, "ger_st_results")
 
 end_time_ger = time.process_time()
 print("Time: ", end_time_ger - start_time_ger)  
@@ -209,16 +246,17 @@ print()
 print("English:")
 start_time_eng = time.process_time()
 print("Tagging English...")
-#eng_st_results = named_entity_recognition_st(eng_sent[:163111], nlp_en)
+#eng_st_results = named_entity_recognition_st(read_corpus("en", stop=163111), load("nlp_en"))
 #print(eng_st_results)
 
 print("Evaluating English...")
-#eng_st_results_eval = evaluate_ner_st(eng_st_results, nlp_en3)
-#eng_st_results_multi_eval = evaluate_ner_st(eng_st_results, nlp_multi)
+#eng_st_results_eval = evaluate_ner_st(eng_st_results, load("nlp_en3"))
+#eng_st_results_multi_eval = evaluate_ner_st(eng_st_results, load("nlp_multi"))
 #print(eng_st_results_eval)
 #print(eng_st_results_multi_eval)
 
 #export_to_csv(eng_st_results)
+#export_run(eng_st_results, "eng_st_results")
 
 end_time_eng = time.process_time()
 print("Time: ", end_time_eng - start_time_eng)  
@@ -228,16 +266,17 @@ print()
 print("Dutch:")
 start_time_nld = time.process_time()
 print("Tagging Dutch...")
-#nld_st_results = named_entity_recognition_st(nld_sent, nlp_nl)
+#nld_st_results = named_entity_recognition_st(read_corpus("nl"), load("nlp_nl"))
 #print(nld_st_results)
 
 print("Evaluating Dutch...")
-#nld_st_results_eval = evaluate_ner_st(nld_st_results, nlp_nl3)
-#nld_st_results_multi_eval = evaluate_ner_st(nld_st_results, nlp_multi)
+#nld_st_results_eval = evaluate_ner_st(nld_st_results, load("nlp_nl3"))
+#nld_st_results_multi_eval = evaluate_ner_st(nld_st_results, load("nlp_multi"))
 #print(nld_st_results_eval)
 #print(nld_st_results_multi_eval)
 
 #export_to_csv(nld_st_results)
+#export_run(nld_st_results, "nld_st_results")
 
 end_time_nld = time.process_time()
 print("Time: ", end_time_nld - start_time_nld)  
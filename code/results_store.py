@@ -0,0 +1,284 @@
+"""Stores tagging results as memory-mappable columns.
+
+Every tagging run gets its own directory. The entities are stored as four
+integer columns (sentence id, start, end, label id) in raw binary files, next
+to the sentence ids and texts, a label dictionary and the run metadata in
+meta.json. A RunWriter appends to the columns while the tagger is running, and
+a RunStore maps them back into memory without parsing, so filtering by label
+or sentence range is a vectorized NumPy operation.
+
+Layout of a run directory:
+    meta.json: Metadata, label dictionary and row counts.
+    ent_sentence.i8, ent_start.i4, ent_end.i4, ent_label.i2: One row per
+        entity.
+    sentence_id.i8, text_offset.i8, text.bin: One row per sentence and the
+        UTF-8 encoded sentences. text_offset has one extra row at the end.
+
+Requires "ast", "csv", "json", "os", "time", and "numpy".
+
+Example:
+    with RunWriter("./runs/ger_sp_nlp_de2", tagger="de_core_news_md") as writer:
+        for result in writer.tee(tag_sentences_sp(read_corpus("de"), load("nlp_de2"))):
+            pass
+    run = RunStore("./runs/ger_sp_nlp_de2")
+    persons = run.select(label="PER", sentences=(0, 1000))
+
+Attributes:
+    COLUMNS (dict): File name and dtype of every column.
+
+"""
+
+import ast
+import csv
+import json
+import os
+import time
+
+import numpy as np
+
+COLUMNS = {
+    "ent_sentence": ("ent_sentence.i8", np.int64),
+    "ent_start": ("ent_start.i4", np.int32),
+    "ent_end": ("ent_end.i4", np.int32),
+    "ent_label": ("ent_label.i2", np.int16),
+    "sentence_id": ("sentence_id.i8", np.int64),
+    "text_offset": ("text_offset.i8", np.int64),
+}
+
+class RunWriter:
+    """Writes the results of one tagging run incrementally.
+
+    Results are buffered and appended to the column files every flush_every
+    sentences. meta.json is rewritten at every flush, so an interrupted run
+    can still be read up to its last flush.
+
+    Args:
+        path (str): The run directory. Existing columns are overwritten.
+        flush_every (int): Number of sentences between two flushes.
+        **meta: Metadata of the run, e.g. tagger, language and corpus.
+
+    """
+
+    def __init__(self, path, flush_every=10000, **meta):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.flush_every = flush_every
+        self.meta = dict(meta, created=time.strftime("%Y-%m-%d %H:%M:%S"))
+        self.labels = {}
+        self.n_sentences = 0
+        self.n_entities = 0
+        self._text_bytes = 0
+        self._files = {name: open(os.path.join(path, file_name), "wb") for name, (file_name, _) in COLUMNS.items()}
+        self._text = open(os.path.join(path, "text.bin"), "wb")
+        self._buffer = {name: [] for name in COLUMNS}
+        self._buffer["text_offset"].append(0)
+        self._text_buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, result):
+        """Adds the result of one sentence.
+
+        Args:
+            result (tuple): ('Sentence.', [[start_char, end_char, 'LABEL']])
+                or (sentence id, 'Sentence.', [[...]]). Without an id, the
+                position of the sentence in the run is used.
+
+        """
+
+        if len(result) == 3:
+            sentence_id, sentence, entities = result
+        else:
+            sentence_id, (sentence, entities) = self.n_sentences, result
+        encoded = str(sentence).encode("utf-8")
+        self._text_bytes += len(encoded)
+        self._text_buffer.append(encoded)
+        self._buffer["sentence_id"].append(sentence_id)
+        self._buffer["text_offset"].append(self._text_bytes)
+        for start, end, label in entities:
+            self._buffer["ent_sentence"].append(sentence_id)
+            self._buffer["ent_start"].append(start)
+            self._buffer["ent_end"].append(end)
+            self._buffer["ent_label"].append(self.labels.setdefault(label, len(self.labels)))
+        self.n_sentences += 1
+        self.n_entities += len(entities)
+        if self.n_sentences % self.flush_every == 0:
+            self.flush()
+
+    def tee(self, results):
+        """Writes results while passing them on.
+
+        Args:
+            results (Iterable[tuple]): Results of a tagging function.
+
+        Yields:
+            tuple: The same results.
+
+        """
+
+        for result in results:
+            self.write(result)
+            yield result
+
+    def flush(self):
+        """Appends the buffered results to the files and updates meta.json."""
+
+        for name, (_, dtype) in COLUMNS.items():
+            np.asarray(self._buffer[name], dtype=dtype).tofile(self._files[name])
+            self._buffer[name] = []
+            self._files[name].flush()
+        self._text.write(b"".join(self._text_buffer))
+        self._text.flush()
+        self._text_buffer = []
+        meta = dict(self.meta, labels=sorted(self.labels, key=self.labels.get), n_sentences=self.n_sentences, n_entities=self.n_entities)
+        with open(os.path.join(self.path, "meta.json.part"), "w", encoding="utf-8") as meta_file:
+            json.dump(meta, meta_file, ensure_ascii=False, indent=1)
+        os.replace(os.path.join(self.path, "meta.json.part"), os.path.join(self.path, "meta.json"))
+
+    def close(self):
+        """Flushes the remaining results and closes the files."""
+
+        if self._text.closed:
+            return
+        self.flush()
+        for column in self._files.values():
+            column.close()
+        self._text.close()
+
+def _map(path, dtype, count):
+    if count == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(count,))
+
+class RunStore:
+    """Reads a run directory with memory-mapped columns.
+
+    Only the rows counted in meta.json are mapped, so a run that is still
+    being written can be read up to its last flush.
+
+    Args:
+        path (str): The run directory.
+
+    Attributes:
+        meta (dict): The metadata of the run.
+        labels (list[str]): The label of every label id.
+        ent_sentence, ent_start, ent_end, ent_label (memmap): The entity
+            columns.
+        sentence_id (memmap): The id of every sentence in run order.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as meta_file:
+            self.meta = json.load(meta_file)
+        self.labels = self.meta["labels"]
+        n_sentences, n_entities = self.meta["n_sentences"], self.meta["n_entities"]
+        for name, (file_name, dtype) in COLUMNS.items():
+            count = n_entities if name.startswith("ent_") else n_sentences + (name == "text_offset")
+            setattr(self, name, _map(os.path.join(path, file_name), dtype, count))
+        self._text = _map(os.path.join(path, "text.bin"), np.uint8, int(self.text_offset[-1]) if n_sentences else 0)
+
+    def __len__(self):
+        return self.meta["n_sentences"]
+
+    def label_id(self, label):
+        """Returns the id of a label, or -1 if the run does not contain it."""
+
+        return self.labels.index(label) if label in self.labels else -1
+
+    def sentence(self, n):
+        """Returns the text of the n-th sentence of the run."""
+
+        return bytes(self._text[self.text_offset[n]:self.text_offset[n + 1]]).decode("utf-8")
+
+    def mask(self, label=None, sentences=None):
+        """Selects entity rows by label and sentence id range.
+
+        Args:
+            label (str or list[str]): One or more labels. None selects all.
+            sentences (tuple): (first id, id after the last). None selects
+                all.
+
+        Returns:
+            ndarray: A boolean mask over the entity rows.
+
+        """
+
+        mask = np.ones(len(self.ent_label), dtype=bool)
+        if label is not None:
+            labels = [label] if isinstance(label, str) else label
+            mask &= np.isin(self.ent_label, [self.label_id(l) for l in labels])
+        if sentences is not None:
+            mask &= (self.ent_sentence >= sentences[0]) & (self.ent_sentence < sentences[1])
+        return mask
+
+    def select(self, label=None, sentences=None):
+        """Returns the entities that match a label and sentence id range.
+
+        Args:
+            label (str or list[str]): One or more labels. None selects all.
+            sentences (tuple): (first id, id after the last). None selects
+                all.
+
+        Returns:
+            dict: The selected entity columns as arrays.
+
+        """
+
+        mask = self.mask(label, sentences)
+        return {name: np.asarray(getattr(self, name)[mask]) for name in ("ent_sentence", "ent_start", "ent_end", "ent_label")}
+
+    def results(self, with_ids=True):
+        """Yields the run in the format of the tagging functions.
+
+        Args:
+            with_ids (bool): Whether to prepend the sentence id.
+
+        Yields:
+            tuple: (sentence id, 'Sentence.', [[start_char, end_char, 'LABEL']])
+                or ('Sentence.', [[...]]).
+
+        """
+
+        row = 0
+        for n in range(len(self)):
+            sentence_id = int(self.sentence_id[n])
+            entities = []
+            while row < len(self.ent_sentence) and self.ent_sentence[row] == sentence_id:
+                entities.append([int(self.ent_start[row]), int(self.ent_end[row]), self.labels[self.ent_label[row]]])
+                row += 1
+            yield (sentence_id, self.sentence(n), entities) if with_ids else (self.sentence(n), entities)
+
+def import_csv(csv_path, path, **meta):
+    """Converts a .csv file written by export_to_csv into a run directory.
+
+    The CSV files in results/ contain one row per entity instead of one row
+    per sentence, and every row of a sentence repeats all of its entities.
+    Consecutive duplicate rows are therefore merged. Sentences are numbered
+    by their position in the file.
+
+    Args:
+        csv_path (str): The .csv file.
+        path (str): The new run directory.
+        **meta: Additional metadata of the run.
+
+    Returns:
+        RunStore: The imported run.
+
+    """
+
+    previous = None
+    with open(csv_path, encoding="utf-8-sig", newline="") as csv_file, RunWriter(path, source=os.path.basename(csv_path), **meta) as writer:
+        rows = csv.reader(csv_file)
+        next(rows)  # Skip the header.
+        for sentence, entities in rows:
+            if (sentence, entities) == previous:
+                continue
+            previous = (sentence, entities)
+            writer.write((sentence, ast.literal_eval(entities)))
+    return RunStore(path)
@@ -0,0 +1,205 @@
+"""Tags a stream of sentences in mixed languages with per-language pipelines.
+
+Every record (id, language, sentence) is sent to the pipeline of its
+language. The language comes from the Tatoeba language column or, if it is
+missing or unknown, from a language detector. Sentences of a language
+without a pipeline go to the multi-language pipeline (xx_ent_wiki_sm).
+
+Each pipeline has its own queue, and a queue is tagged once it holds a full
+batch, so every pipeline still gets full batches even if its language is
+rare in the stream. The results are put back into input order in a reorder
+buffer. If the buffer grows too large because a rare language holds back
+the output, the queue with the oldest record is tagged early.
+
+Requires "argparse", "collections", "json", "re", "spacy", and "stanza".
+
+Example:
+    router = Router(system="md")
+    for sentence_id, lang, sentence, entities in router.route(read_records("./sentences.tsv")):
+        print(sentence_id, lang, entities)
+
+    Detect the language instead of using the column::
+
+        python router.py ./sentences.tsv --detect --stop 10000 --output routed.tsv
+
+Attributes:
+    STOPWORDS (dict): Frequent words per language code, used by
+        StopwordDetector.
+
+"""
+
+import argparse
+import collections
+import json
+import re
+
+from corpora import read_records
+from models import LANGUAGES, STANZA_PIPELINES, load, pipeline_name
+
+STOPWORDS = {
+    "de": {"der", "die", "das", "und", "ist", "nicht", "ich", "du", "er", "sie", "es", "wir", "ein", "eine", "zu", "mit",
+           "auf", "für", "sich", "den", "dem", "hat", "habe", "war", "ja", "nein", "auch", "was", "wie", "bin", "bist"},
+    "en": {"the", "and", "is", "not", "i", "you", "he", "she", "it", "we", "they", "a", "an", "to", "of", "with", "on",
+           "for", "this", "that", "was", "have", "has", "do", "does", "what", "how", "are", "am", "my", "your"},
+    "nl": {"de", "het", "een", "en", "is", "niet", "ik", "je", "jij", "hij", "zij", "ze", "we", "wij", "van", "met", "op",
+           "voor", "dat", "dit", "was", "heb", "heeft", "wat", "hoe", "ben", "bent", "zijn", "mijn", "u", "geen"},
+}
+
+_WORD = re.compile(r"\w+")
+
+class StopwordDetector:
+    """Guesses the language of a sentence from its frequent words.
+
+    Any other callable that takes a sentence and returns a language code or
+    None can be used as detector instead.
+
+    Args:
+        stopwords (dict): Sets of frequent words per language code.
+
+    """
+
+    def __init__(self, stopwords=STOPWORDS):
+        self.stopwords = stopwords
+
+    def __call__(self, sentence):
+        """Returns the language with the most frequent words in sentence.
+
+        Args:
+            sentence (str): The sentence.
+
+        Returns:
+            str: The language code, or None if no language has more hits
+                than all others.
+
+        """
+
+        words = [word.lower() for word in _WORD.findall(sentence)]
+        hits = sorted(((sum(word in stopwords for word in words), lang) for lang, stopwords in self.stopwords.items()), reverse=True)
+        if not hits or hits[0][0] == 0 or (len(hits) > 1 and hits[0][0] == hits[1][0]):
+            return None
+        return hits[0][1]
+
+def _tag(name, sentences):
+    # Imported here, so only the modules of the used pipelines are imported.
+    if name in STANZA_PIPELINES:
+        from stanza_test import tag_sentences_st
+        return tag_sentences_st(sentences, load(name), chunk_size=len(sentences))
+    from spacy_test import tag_sentences_sp
+    return tag_sentences_sp(sentences, load(name), batch_size=len(sentences))
+
+class Router:
+    """Dispatches records to per-language pipelines with separate queues.
+
+    Args:
+        system (str): The tagger per language, a key of TAGGERS ("md",
+            "lg", "stanza").
+        pipelines (dict): Pipeline names per language code. Replaces the
+            pipelines of system.
+        fallback (str): Pipeline for languages without a pipeline.
+        detector (Callable): Takes a sentence and returns a language code or
+            None. Used if the language of a record is None or unknown, or
+            always if detect_all is True. Defaults to StopwordDetector.
+        detect_all (bool): Whether to ignore the language of the records.
+        batch_size (int): Number of sentences per pipeline call.
+        max_buffered (int): Number of records that may wait for their
+            results. Defaults to ten batches.
+
+    Attributes:
+        counts (Counter): Number of sentences per pipeline.
+
+    """
+
+    def __init__(self, system="md", pipelines=None, fallback="nlp_multi", detector=None, detect_all=False, batch_size=1000, max_buffered=None):
+        self.pipelines = pipelines or {lang: pipeline_name(system, lang) for lang in LANGUAGES}
+        self.fallback = fallback
+        self.detector = detector or StopwordDetector()
+        self.detect_all = detect_all
+        self.batch_size = batch_size
+        self.max_buffered = max_buffered or 10 * batch_size
+        self.counts = collections.Counter()
+
+    def language(self, lang, sentence):
+        """Returns the language a record is routed by.
+
+        Args:
+            lang (str): The language of the record, or None.
+            sentence (str): The sentence.
+
+        Returns:
+            str: A language code of pipelines, or None for the fallback.
+
+        """
+
+        if self.detect_all or lang not in self.pipelines:
+            lang = self.detector(sentence)
+        return lang if lang in self.pipelines else None
+
+    def route(self, records):
+        """Tags records with the pipelines of their languages.
+
+        Args:
+            records (Iterable[tuple]): (id, language code, sentence) tuples,
+                e.g. from read_records. The language may be None.
+
+        Yields:
+            tuple: (id, language code, sentence, [[start_char, end_char,
+                'LABEL']]) per record in input order. The language code is
+                the one used for routing, "xx" for the fallback pipeline.
+
+        """
+
+        queues = collections.OrderedDict()  # Pipeline -> [(position, id, language, sentence)].
+        done = {}  # Position -> result, the reorder buffer.
+        next_position = 0
+        buffered = 0
+
+        def tag(name):
+            queue = queues.pop(name)
+            self.counts[name] += len(queue)
+            for (position, sentence_id, lang, _), (sentence, entities) in zip(queue, _tag(name, [record[3] for record in queue])):
+                done[position] = (sentence_id, lang, sentence, entities)
+
+        for position, (sentence_id, lang, sentence) in enumerate(records):
+            lang = self.language(lang, sentence)
+            name = self.pipelines[lang] if lang else self.fallback
+            queues.setdefault(name, []).append((position, sentence_id, lang or "xx", sentence))
+            buffered += 1
+            if len(queues[name]) >= self.batch_size:
+                tag(name)
+            elif buffered > self.max_buffered:
+                tag(min(queues, key=lambda n: queues[n][0][0]))  # The queue that holds back the output.
+            while next_position in done:
+                yield done.pop(next_position)
+                next_position += 1
+                buffered -= 1
+        while queues:
+            tag(min(queues, key=lambda n: queues[n][0][0]))
+            while next_position in done:
+                yield done.pop(next_position)
+                next_position += 1
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tags a mixed-language corpus file with per-language pipelines.")
+    parser.add_argument("corpus", help="a Tatoeba .tsv(.bz2/.gz) file with a language column")
+    parser.add_argument("--system", default="md", help="tagger per language: md, lg or stanza")
+    parser.add_argument("--detect", action="store_true", help="detect the language instead of using the column")
+    parser.add_argument("--start", type=int, default=0)
+    parser.add_argument("--stop", type=int)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--output", help="write id, language, sentence and entities as TSV")
+    args = parser.parse_args(argv)
+
+    router = Router(args.system, detect_all=args.detect, batch_size=args.batch_size)
+    output = open(args.output, "w", encoding="utf-8") if args.output else None
+    try:
+        for sentence_id, lang, sentence, entities in router.route(read_records(args.corpus, args.start, args.stop)):
+            if output:
+                output.write("{}\t{}\t{}\t{}\n".format(sentence_id, lang, sentence, json.dumps(entities, ensure_ascii=False)))
+    finally:
+        if output:
+            output.close()
+    for name, count in router.counts.most_common():
+        print(name, count)
+
+if __name__ == "__main__":
+    main()
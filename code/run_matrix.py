@@ -0,0 +1,237 @@
+"""Runs a matrix of taggers and evaluators from the command line.
+
+Instead of commenting lines in and out of results.py, the languages,
+tagger/evaluator combinations and corpus slices are passed as arguments. The
+jobs are planned first: jobs with the same language, tagger and slice form a
+group that tags once and is then evaluated with every requested evaluator.
+Groups run in parallel worker processes as long as their estimated memory and
+CPU threads fit into the given budget. Every worker limits its BLAS, OpenMP
+and torch threads, so parallel groups do not oversubscribe the machine.
+
+Every group writes its tagging results as a run directory (see
+results_store.py) and its scores as JSON files to the output directory,
+named like the variables in results.py. summary.json collects all scores.
+
+Requires "argparse", "concurrent.futures", "json", "multiprocessing", "os",
+"time", "spacy", and "stanza".
+
+Example:
+    Regenerate the whole results table on 8 cores and 16 GB from the code
+    directory::
+
+        python run_matrix.py --cpus 8 --memory 16000 --output ./matrix
+        python run_matrix.py --languages de --combinations md/lg stanza/lg stanza/multi --slices :10000 --dry-run
+
+Attributes:
+    MODEL_MEMORY_MB (dict): Estimated memory of a loaded pipeline in MB by
+        system name, used for planning.
+    BASE_MEMORY_MB (int): Estimated memory of a worker without pipelines.
+
+"""
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import time
+
+from models import COMBINATIONS, LANGUAGES, STANZA_PIPELINES, pipeline_name
+
+MODEL_MEMORY_MB = {"md": 400, "lg": 1200, "multi": 200, "stanza": 1500}
+
+BASE_MEMORY_MB = 400
+
+def parse_slice(text):
+    """Parses a corpus slice like "0:10000" or "::10".
+
+    Args:
+        text (str): start:stop[:step], parts may be empty.
+
+    Returns:
+        tuple: (start, stop, step) with None for stop if empty.
+
+    """
+
+    parts = (text.split(":") + ["", ""])[:3]
+    return int(parts[0] or 0), int(parts[1]) if parts[1] else None, int(parts[2] or 1)
+
+def result_name(lang, tagger, evaluator=None):
+    """Names results like the variables in results.py.
+
+    Args:
+        lang (str): The language code.
+        tagger (str): A key of TAGGERS.
+        evaluator (str): A key of EVALUATORS, for the name of the evaluation.
+
+    Returns:
+        str: E.g. "ger_sp_results_nlp_de2", "ger_st_results_multi_eval".
+
+    """
+
+    tagger_name = pipeline_name(tagger, lang)
+    name = LANGUAGES[lang] + ("_st_results" if tagger_name in STANZA_PIPELINES else "_sp_results_" + tagger_name)
+    if evaluator is None:
+        return name
+    return name + ("_eval" if evaluator == "lg" else "_{}_eval".format(evaluator))
+
+def plan(languages, combinations, slices):
+    """Groups the jobs of the matrix by tagging run.
+
+    Args:
+        languages (list[str]): Language codes.
+        combinations (list[tuple]): (tagger, evaluator) pairs.
+        slices (list[tuple]): (start, stop, step) corpus slices.
+
+    Returns:
+        list[dict]: One group per (language, tagger, slice) with its
+            evaluators and estimated peak memory in MB, largest first.
+
+    """
+
+    groups = {}
+    for lang in languages:
+        for corpus_slice in slices:
+            for tagger, evaluator in combinations:
+                group = groups.setdefault((lang, tagger, corpus_slice), {"lang": lang, "tagger": tagger, "slice": corpus_slice, "evaluators": []})
+                if evaluator not in group["evaluators"]:
+                    group["evaluators"].append(evaluator)
+    for group in groups.values():  # The tagger is unloaded before the evaluators are loaded.
+        group["memory_mb"] = BASE_MEMORY_MB + max(MODEL_MEMORY_MB[system] for system in [group["tagger"]] + group["evaluators"])
+    return sorted(groups.values(), key=lambda group: -group["memory_mb"])
+
+def run_group(group, threads, output, batch_size=1000, shared_vectors=False):
+    """Tags one corpus slice and evaluates it. Runs in a worker process.
+
+    Args:
+        group (dict): A group from plan().
+        threads (int): Number of threads the worker may use.
+        output (str): The output directory.
+        batch_size (int): Number of sentences per batch.
+        shared_vectors (bool): Whether spaCy pipelines memory-map their
+            vectors from a file shared by all workers.
+
+    Returns:
+        list[dict]: One summary row per evaluator.
+
+    """
+
+    for variable in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[variable] = str(threads)  # Must be set before NumPy and torch are imported.
+    import torch
+    torch.set_num_threads(threads)
+
+    from corpora import read_corpus
+    from models import load, registry
+    from results_store import RunStore, RunWriter
+    from scoring import ScoreCounts, make_examples
+    from spacy_test import tag_sentences_sp
+    from stanza_test import tag_sentences_st
+
+    lang, tagger = group["lang"], group["tagger"]
+    start, stop, step = group["slice"]
+    suffix = "" if group["slice"] == (0, None, 1) else "_{}_{}_{}".format(start, stop or "end", step)
+    run_path = os.path.join(output, result_name(lang, tagger) + suffix)
+
+    start_time = time.perf_counter()
+    tagger_name = pipeline_name(tagger, lang)
+    sentences = read_corpus(lang, start, stop, step, with_ids=True)
+    if tagger_name in STANZA_PIPELINES:
+        tagged = tag_sentences_st(sentences, load(tagger_name, use_gpu=False), chunk_size=batch_size, with_ids=True)
+    else:
+        tagged = tag_sentences_sp(sentences, load(tagger_name, shared_vectors=shared_vectors), batch_size=batch_size, with_ids=True)
+    with RunWriter(run_path, tagger=tagger_name, lang=lang, slice=[start, stop, step]) as writer:
+        for _ in writer.tee(tagged):
+            pass
+    tag_time = time.perf_counter() - start_time
+    registry.unload(tagger_name)
+
+    rows = []
+    for evaluator in group["evaluators"]:
+        start_time = time.perf_counter()
+        counts = ScoreCounts()
+        for example in make_examples(RunStore(run_path).results(), load(pipeline_name(evaluator, lang), shared_vectors=shared_vectors), batch_size=batch_size):
+            counts.add(example)
+        scores = counts.scores()
+        with open(os.path.join(output, result_name(lang, tagger, evaluator) + suffix + ".json"), "w", encoding="utf-8") as score_file:
+            json.dump(scores, score_file, indent=1)
+        rows.append({"lang": lang, "tagger": tagger, "evaluator": evaluator, "slice": [start, stop, step], "sentences": counts.n_examples,
+                     "ents_p": scores["ents_p"], "ents_r": scores["ents_r"], "ents_f": scores["ents_f"],
+                     "tag_s": tag_time, "eval_s": time.perf_counter() - start_time})
+    return rows
+
+def schedule(groups, cpus, memory_mb, threads, output, batch_size=1000, shared_vectors=False):
+    """Runs the groups in parallel within the CPU and memory budget.
+
+    The largest group that fits into the free budget is started next. A
+    group that does not even fit into the whole budget runs alone.
+
+    Args:
+        groups (list[dict]): Groups from plan().
+        cpus (int): Total number of threads for all workers.
+        memory_mb (int): Total memory for all workers in MB.
+        threads (int): Threads per worker.
+        output (str): The output directory.
+        batch_size (int): Number of sentences per batch.
+        shared_vectors (bool): Whether spaCy pipelines share their vectors.
+
+    Returns:
+        list[dict]: The summary rows of all groups.
+
+    """
+
+    context = multiprocessing.get_context("spawn")  # Fresh workers do not inherit loaded pipelines.
+    pending = list(groups)
+    running = {}
+    rows = []
+    free_cpus, free_memory = cpus, memory_mb
+    while pending or running:
+        for group in list(pending):
+            if (threads <= free_cpus and group["memory_mb"] <= free_memory) or not running:
+                pending.remove(group)
+                executor = concurrent.futures.ProcessPoolExecutor(1, mp_context=context)
+                running[executor.submit(run_group, group, threads, output, batch_size, shared_vectors)] = (group, executor)
+                free_cpus -= threads
+                free_memory -= group["memory_mb"]
+                print("Started {} {} slice {} ({} MB, {} threads)".format(group["lang"], group["tagger"], group["slice"], group["memory_mb"], threads))
+        done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            group, executor = running.pop(future)
+            executor.shutdown()
+            free_cpus += threads
+            free_memory += group["memory_mb"]
+            for row in future.result():
+                print("Finished {lang} {tagger}/{evaluator}: P {ents_p} R {ents_r} F {ents_f}".format(**row))
+                rows.append(row)
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tags and evaluates a matrix of languages, pipelines and corpus slices.")
+    parser.add_argument("--languages", nargs="+", default=list(LANGUAGES), choices=list(LANGUAGES))
+    parser.add_argument("--combinations", nargs="+", default=["/".join(c) for c in COMBINATIONS],
+                        help="tagger/evaluator pairs, e.g. md/lg stanza/multi")
+    parser.add_argument("--slices", nargs="+", default=[":"], help="corpus slices as start:stop[:step]")
+    parser.add_argument("--cpus", type=int, default=os.cpu_count() or 1, help="total threads of all workers")
+    parser.add_argument("--memory", type=int, default=8000, help="total memory of all workers in MB")
+    parser.add_argument("--threads", type=int, help="threads per worker (default: spread --cpus over the groups)")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--output", default="./matrix")
+    parser.add_argument("--shared-vectors", action="store_true", help="memory-map spaCy vectors shared by all workers")
+    parser.add_argument("--dry-run", action="store_true", help="only print the plan")
+    args = parser.parse_args(argv)
+
+    groups = plan(args.languages, [tuple(c.split("/")) for c in args.combinations], [parse_slice(s) for s in args.slices])
+    threads = args.threads or max(1, args.cpus // len(groups))
+    print("{} groups, {} thread(s) per worker:".format(len(groups), threads))
+    for group in groups:
+        print("  {lang} {tagger} slice {slice} -> {evaluators} (~{memory_mb} MB)".format(**group))
+    if args.dry_run:
+        return
+    os.makedirs(args.output, exist_ok=True)
+    rows = schedule(groups, args.cpus, args.memory, threads, args.output, args.batch_size, args.shared_vectors)
+    with open(os.path.join(args.output, "summary.json"), "w", encoding="utf-8") as summary:
+        json.dump(rows, summary, indent=1)
+    print("Summary written to", os.path.join(args.output, "summary.json"))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+"""Counts the scores of evaluate_ner_sp and evaluate_ner_st.
+
+spaCy's Scorer only returns precision, recall, and F1-score, which cannot be
+combined across batches or runs. ScoreCounts keeps the underlying counts
+instead: true positives, false positives and false negatives per entity type,
+and the counts behind the tokenization accuracy. They are counted exactly like
+spaCy's get_ner_prf and Scorer.score_tokenization, so scores() returns the
+same dictionary as Scorer.score on the same examples. The counts can be saved
+as JSON and added up.
+
+score_examples counts a stream of examples one at a time, so only the
+examples of the current batch of make_examples are in memory instead of a
+list of two Docs per sentence, and reports snapshots of the scores while the
+run is going.
+
+Requires "collections" and "spacy".
+
+Example:
+    counts = ScoreCounts()
+    for example in make_examples(example_results, nlp_en3):
+        counts.add(example)
+    print(counts.scores())
+
+    counts = score_examples(make_examples(ger_results, nlp_de3), every=10000, callback=lambda counts, n: print(counts.snapshot()))
+
+"""
+
+import collections
+
+from spacy.scorer import PRFScore, Scorer
+from spacy.training import Example
+
+from cache import predict_reference
+from prefilter import predict_filtered
+
+_template = None
+
+def make_examples(results, nlp_model, cache=None, batch_size=1000, tokens=None, prefilter=None):
+    """Pairs tagging results with the predictions of the evaluation pipeline.
+
+    Args:
+        results (Iterable[tuple]): Tagging results in the format
+            ('Sentence.', [[start_char, end_char, 'ENTITY_TYPE']]). The tuples
+            may start with the sentence id.
+        nlp_model (Language): The spaCy pipeline used for evaluation.
+        cache (DiskCache): Cache of the predictions of nlp_model. If None,
+            the default cache is used. If False, nothing is cached.
+        batch_size (int): Number of sentences per batch when nlp_model has to
+            make predictions.
+        tokens (TokenCache): If given, both Docs are built from the tokens of
+            the cache, and misaligned entities are counted by the cache
+            instead of warned about (see tokens.py).
+        prefilter (Prefilter): If given, nlp_model only makes predictions for
+            sentences that pass it, the others get a Doc without entities
+            (see prefilter.py).
+
+    Yields:
+        Example: The tagging result as reference and the prediction of
+            nlp_model as predicted Doc, one per result.
+
+    Raises:
+        UserWarning: [W030] Some entities could not be aligned in the text.
+
+    """
+
+    pending = collections.deque()  # Results whose prediction has not been made yet.
+
+    def sentences():
+        for result in results:
+            pending.append(result)
+            yield result[-2] if tokens is None else tokens.doc(result[-2], nlp_model.vocab)  # nlp_model skips its tokenizer for Docs.
+
+    if prefilter is not None:
+        predictions = predict_filtered(sentences(), nlp_model, prefilter, cache, batch_size)
+    else:
+        predictions = predict_reference(sentences(), nlp_model, cache, batch_size)
+    for predicted in predictions:  # NLP model makes predictions on the input, unless they are cached.
+        input_, annot = pending.popleft()[-2:]  # Tuples may start with the sentence id.
+        if tokens is not None:
+            example = tokens.example(input_, annot, nlp_model.vocab)
+        else:
+            doc = nlp_model.make_doc(str(input_))  # Creates spaCy Doc which contains predictions.
+            example = Example.from_dict(doc, {"entities": annot})  # Example object which is the gold standard.
+        example.predicted = predicted
+        yield example
+
+def _prf(tp=0, fp=0, fn=0):
+    score = PRFScore()
+    score.tp, score.fp, score.fn = tp, fp, fn
+    return score
+
+class ScoreCounts:
+    """Counts that Scorer.score computes the token and entity scores from.
+
+    Attributes:
+        ents (dict): A PRFScore per entity type.
+        token_acc (PRFScore): Counts of the tokenization accuracy.
+        token_prf (PRFScore): Counts of the tokenization precision and recall.
+        n_examples (int): The number of examples added.
+
+    """
+
+    def __init__(self):
+        self.ents = {}
+        self.token_acc = PRFScore()
+        self.token_prf = PRFScore()
+        self.n_examples = 0
+
+    def add(self, example):
+        """Counts one example like get_ner_prf and score_tokenization.
+
+        Args:
+            example (Example): An example from make_examples.
+
+        """
+
+        self.n_examples += 1
+        gold_doc = example.reference
+        pred_doc = example.predicted
+        align_x2y = example.alignment.x2y
+        if not gold_doc.has_unknown_spaces:
+            gold_spans = set()
+            pred_spans = set()
+            for token in gold_doc:
+                if not token.orth_.isspace():
+                    gold_spans.add((token.idx, token.idx + len(token)))
+            for token in pred_doc:
+                if token.orth_.isspace():
+                    continue
+                pred_spans.add((token.idx, token.idx + len(token)))
+                if align_x2y.lengths[token.i] != 1:
+                    self.token_acc.fp += 1
+                else:
+                    self.token_acc.tp += 1
+            self.token_prf.score_set(pred_spans, gold_spans)
+        if not gold_doc.has_annotation("ENT_IOB"):
+            return
+        golds = {(ent.label_, ent.start, ent.end) for ent in gold_doc.ents}
+        for pred_ent in pred_doc.ents:
+            score = self.ents.setdefault(pred_ent.label_, PRFScore())
+            indices = align_x2y[pred_ent.start:pred_ent.end]
+            indices = getattr(indices, "dataXd", indices)
+            if len(indices):
+                g_span = gold_doc[indices[0]:indices[-1] + 1]
+                if all(token.ent_iob != 0 for token in g_span):  # Predictions on spans with missing annotation are ignored.
+                    key = (pred_ent.label_, int(indices[0]), int(indices[-1]) + 1)
+                    if key in golds:
+                        score.tp += 1
+                        golds.remove(key)
+                    else:
+                        score.fp += 1
+        for label, start, end in golds:
+            self.ents.setdefault(label, PRFScore()).fn += 1
+
+    def merge(self, other):
+        """Adds the counts of another ScoreCounts object.
+
+        Args:
+            other (ScoreCounts): The counts to add.
+
+        Returns:
+            ScoreCounts: self.
+
+        """
+
+        for label, score in other.ents.items():
+            self.ents[label] = self.ents.get(label, PRFScore()) + score
+        self.token_acc += other.token_acc
+        self.token_prf += other.token_prf
+        self.n_examples += other.n_examples
+        return self
+
+    def to_dict(self):
+        """Returns the counts as a JSON-serializable dictionary."""
+
+        return {
+            "ents": {label: [s.tp, s.fp, s.fn] for label, s in self.ents.items()},
+            "token_acc": [self.token_acc.tp, self.token_acc.fp, self.token_acc.fn],
+            "token_prf": [self.token_prf.tp, self.token_prf.fp, self.token_prf.fn],
+            "n_examples": self.n_examples,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Creates ScoreCounts from the output of to_dict.
+
+        Args:
+            data (dict): The counts.
+
+        Returns:
+            ScoreCounts: The counts.
+
+        """
+
+        counts = cls()
+        counts.ents = {label: _prf(*values) for label, values in data["ents"].items()}
+        counts.token_acc = _prf(*data["token_acc"])
+        counts.token_prf = _prf(*data["token_prf"])
+        counts.n_examples = data["n_examples"]
+        return counts
+
+    def snapshot(self):
+        """Returns the scores counted so far in short.
+
+        Returns:
+            dict: The number of examples, the total entity precision, recall,
+                and F1-score, and the tokenization accuracy.
+
+        """
+
+        totals = PRFScore()
+        for score in self.ents.values():
+            totals += score
+        return {
+            "n_examples": self.n_examples,
+            "ents_p": totals.precision,
+            "ents_r": totals.recall,
+            "ents_f": totals.fscore,
+            "token_acc": self.token_acc.fscore,
+        }
+
+    def scores(self):
+        """Computes the scores like Scorer.score.
+
+        Returns:
+            Dict[str, Any]: The precision, recall, and F1-score in total and
+                per entity type as well as the tokenization accuracy. Other
+                categories receive None.
+
+        """
+
+        global _template
+        if _template is None:
+            _template = Scorer().score([])  # The categories this project does not annotate.
+        scores = dict(_template)
+        if len(self.token_acc) > 0:
+            scores.update({
+                "token_acc": self.token_acc.fscore,
+                "token_p": self.token_prf.precision,
+                "token_r": self.token_prf.recall,
+                "token_f": self.token_prf.fscore,
+            })
+        totals = PRFScore()
+        for score in self.ents.values():
+            totals += score
+        if len(totals) > 0:
+            scores.update({
+                "ents_p": totals.precision,
+                "ents_r": totals.recall,
+                "ents_f": totals.fscore,
+                "ents_per_type": {label: score.to_dict() for label, score in self.ents.items()},
+            })
+        return scores
+
+def score_examples(examples, counts=None, every=1000, callback=None):
+    """Counts a stream of examples without keeping them.
+
+    Every example is counted and released before the next one is taken, so
+    memory does not grow with the number of examples.
+
+    Args:
+        examples (Iterable[Example]): The examples, e.g. from make_examples.
+        counts (ScoreCounts): Counts to continue from. If None, counting
+            starts at zero.
+        every (int): Number of examples between two calls of callback.
+        callback (Callable): Called as callback(counts, n) after every
+            `every` examples and after the last one, with n the number of
+            examples counted by this call.
+
+    Returns:
+        ScoreCounts: The counts.
+
+    """
+
+    if counts is None:
+        counts = ScoreCounts()
+    n = 0
+    for example in examples:
+        counts.add(example)
+        n += 1
+        if callback is not None and n % every == 0:
+            callback(counts, n)
+    if callback is not None and n % every:
+        callback(counts, n)
+    return counts
@@ -0,0 +1,307 @@
+"""Runs a tagger and its evaluators on shards of a corpus and merges them.
+
+Every node tags and evaluates one shard, a range of lines of the corpus file
+(see CorpusIndex.shards), and writes a self-describing partial result to its
+own directory:
+    run/: The tagging results of the shard (see results_store.py).
+    counts.json: The raw counts of every evaluator (see ScoreCounts): true
+        positives, false positives and false negatives per label and the
+        token counts.
+    shard.json: The job (language, tagger, evaluators, corpus file and its
+        size, number of shards, pipeline versions), the shard number and
+        line range, and the number of sentences. It is written last, so a
+        shard without it is incomplete.
+
+merge() adds up the counts of any number of partial results. Since the scores
+are computed from the added counts, they are exactly the scores of a run over
+the whole corpus on one node. It refuses to merge shards of different jobs,
+and reports missing, duplicate and overlapping shards. run_local() runs all
+shards in worker processes on one machine as a stand-in for several nodes.
+
+Requires "argparse", "concurrent.futures", "json", "multiprocessing", "os",
+"time", "numpy", "spacy", and "stanza".
+
+Example:
+    On node 3 of 8, from the code directory::
+
+        python shards.py run --lang de --tagger stanza --evaluators lg multi --shards 8 --shard 3 --output /shared/de_stanza
+
+    Then on any node::
+
+        python shards.py merge /shared/de_stanza --output merged.json --run ./runs/ger_st_results
+
+    Or all shards on one machine::
+
+        python shards.py local --lang nl --tagger md --evaluators lg --shards 4 --processes 4 --output ./shards_nl
+
+"""
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import time
+
+from corpora import find_corpus
+from corpus_index import CorpusIndex
+from models import STANZA_PIPELINES, pipeline_name
+
+def shard_dir(output, shard, n_shards):
+    """Returns the directory of a shard in the output directory of a job."""
+
+    return os.path.join(output, "shard-{:04d}-of-{:04d}".format(shard, n_shards))
+
+def run_shard(lang, tagger, evaluators, n_shards, shard, output, batch_size=1000, threads=None):
+    """Tags and evaluates one shard of a corpus.
+
+    Args:
+        lang (str): The language code.
+        tagger (str): A key of TAGGERS ("md", "lg", "multi", "stanza").
+        evaluators (list[str]): Keys of EVALUATORS ("lg", "multi").
+        n_shards (int): The number of shards of the job.
+        shard (int): The number of this shard, from 0.
+        output (str): The output directory of the job, shared by all shards.
+        batch_size (int): Number of sentences per batch.
+        threads (int): Number of torch threads. None keeps the default.
+
+    Returns:
+        dict: The content of shard.json.
+
+    """
+
+    import torch
+
+    from cache import model_fingerprint
+    from models import load, registry
+    from results_store import RunStore, RunWriter
+    from scoring import ScoreCounts, make_examples
+    from spacy_test import tag_sentences_sp
+    from stanza_test import tag_sentences_st
+
+    if threads:
+        torch.set_num_threads(threads)
+    index = CorpusIndex(find_corpus(lang))
+    start, stop = index.shards(n_shards)[shard]
+    path = shard_dir(output, shard, n_shards)
+    if os.path.exists(os.path.join(path, "shard.json")):
+        os.remove(os.path.join(path, "shard.json"))  # The shard is incomplete until it is written again.
+    start_time = time.perf_counter()
+    tagger_name = pipeline_name(tagger, lang)
+    if tagger_name in STANZA_PIPELINES:
+        tagger_model = load(tagger_name, use_gpu=False)
+        tagged = tag_sentences_st(index.records(start, stop), tagger_model, chunk_size=batch_size, with_ids=True)
+    else:
+        tagger_model = load(tagger_name)
+        tagged = tag_sentences_sp(index.records(start, stop), tagger_model, batch_size=batch_size, with_ids=True)
+    with RunWriter(os.path.join(path, "run"), tagger=tagger_name, lang=lang, lines=[start, stop]) as writer:
+        for _ in writer.tee(tagged):
+            pass
+    fingerprints = {tagger: model_fingerprint(tagger_model)}
+    tag_time = time.perf_counter() - start_time
+    registry.unload(tagger_name)
+
+    counts = {}
+    start_time = time.perf_counter()
+    for evaluator in evaluators:
+        evaluator_model = load(pipeline_name(evaluator, lang))
+        fingerprints[evaluator] = model_fingerprint(evaluator_model)
+        shard_counts = ScoreCounts()
+        for example in make_examples(RunStore(os.path.join(path, "run")).results(), evaluator_model, batch_size=batch_size):
+            shard_counts.add(example)
+        counts[evaluator] = shard_counts.to_dict()
+    with open(os.path.join(path, "counts.json"), "w", encoding="utf-8") as counts_file:
+        json.dump(counts, counts_file, indent=1)
+
+    info = {
+        "job": {"lang": lang, "tagger": tagger, "evaluators": list(evaluators), "corpus": os.path.basename(index.path),
+                "corpus_bytes": int(index.offsets[-1]), "corpus_lines": len(index), "n_shards": n_shards, "models": fingerprints},
+        "shard": shard,
+        "lines": [start, stop],
+        "n_sentences": writer.n_sentences,
+        "tag_s": tag_time,
+        "eval_s": time.perf_counter() - start_time,
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    with open(os.path.join(path, "shard.json.part"), "w", encoding="utf-8") as info_file:
+        json.dump(info, info_file, indent=1)
+    os.replace(os.path.join(path, "shard.json.part"), os.path.join(path, "shard.json"))
+    return info
+
+def find_shards(paths):
+    """Finds the complete shards in directories.
+
+    Args:
+        paths (list[str]): Shard directories or output directories of jobs.
+
+    Returns:
+        list[str]: The shard directories that contain a shard.json.
+
+    """
+
+    found = []
+    for path in paths:
+        if os.path.exists(os.path.join(path, "shard.json")):
+            found.append(path)
+        elif os.path.isdir(path):
+            found.extend(os.path.join(path, name) for name in sorted(os.listdir(path)) if os.path.exists(os.path.join(path, name, "shard.json")))
+    return found
+
+def check_shards(infos):
+    """Checks that shards belong to one job and cover the corpus once.
+
+    Args:
+        infos (list[dict]): The shard.json of every shard.
+
+    Returns:
+        list[str]: The problems found: different jobs, missing, duplicate
+            or overlapping shards. Empty if the shards can be merged.
+
+    """
+
+    if not infos:
+        return ["No complete shards found."]
+    problems = []
+    job = infos[0]["job"]
+    for info in infos[1:]:
+        if info["job"] != job:
+            differing = sorted(key for key in set(job) | set(info["job"]) if job.get(key) != info["job"].get(key))
+            problems.append("Shard {} belongs to another job (differs in {}).".format(info["shard"], ", ".join(differing)))
+    shards = [info["shard"] for info in infos]
+    duplicates = sorted({shard for shard in shards if shards.count(shard) > 1})
+    if duplicates:
+        problems.append("Duplicate shards: {}.".format(duplicates))
+    missing = sorted(set(range(job["n_shards"])) - set(shards))
+    if missing:
+        problems.append("Missing shards: {}.".format(missing))
+    end = 0
+    for info in sorted(infos, key=lambda info: info["lines"]):
+        start, stop = info["lines"]
+        if start > end:
+            problems.append("Lines {}-{} are not covered by any shard.".format(end, start))
+        elif start < end and info["shard"] not in duplicates:
+            problems.append("Shard {} overlaps lines {}-{}.".format(info["shard"], start, min(stop, end)))
+        end = max(end, stop)
+    if end < job["corpus_lines"]:
+        problems.append("Lines {}-{} are not covered by any shard.".format(end, job["corpus_lines"]))
+    return problems
+
+def merge(paths, run_path=None):
+    """Merges the partial results of all shards of a job.
+
+    Args:
+        paths (list[str]): Shard directories or output directories of jobs.
+        run_path (str): If given, the tagging results of all shards are
+            written to this run directory in corpus order.
+
+    Returns:
+        dict: The job, the number of sentences and the scores of every
+            evaluator, as evaluate_ner_sp returns them.
+
+    Raises:
+        ValueError: The shards do not form one complete job.
+
+    """
+
+    from results_store import RunStore, RunWriter
+    from scoring import ScoreCounts
+
+    directories = find_shards(paths)
+    infos = []
+    for directory in directories:
+        with open(os.path.join(directory, "shard.json"), encoding="utf-8") as info_file:
+            infos.append(dict(json.load(info_file), path=directory))
+    problems = check_shards(infos)
+    if problems:
+        raise ValueError("Cannot merge the shards:\n" + "\n".join(problems))
+    infos.sort(key=lambda info: info["shard"])
+    job = infos[0]["job"]
+    counts = {evaluator: ScoreCounts() for evaluator in job["evaluators"]}
+    for info in infos:
+        with open(os.path.join(info["path"], "counts.json"), encoding="utf-8") as counts_file:
+            for evaluator, data in json.load(counts_file).items():
+                counts[evaluator].merge(ScoreCounts.from_dict(data))
+    if run_path:
+        with RunWriter(run_path, tagger=pipeline_name(job["tagger"], job["lang"]), lang=job["lang"], shards=job["n_shards"]) as writer:
+            for info in infos:
+                for result in RunStore(os.path.join(info["path"], "run")).results():
+                    writer.write(result)
+    return {
+        "job": job,
+        "n_sentences": sum(info["n_sentences"] for info in infos),
+        "scores": {evaluator: shard_counts.scores() for evaluator, shard_counts in counts.items()},
+        "counts": {evaluator: shard_counts.to_dict() for evaluator, shard_counts in counts.items()},
+    }
+
+def run_local(lang, tagger, evaluators, n_shards, output, processes=None, batch_size=1000):
+    """Runs all shards of a job in worker processes and merges them.
+
+    Stands in for running the shards on several nodes. Every worker is a
+    fresh process with its own pipelines, like a node.
+
+    Args:
+        lang (str): The language code.
+        tagger (str): A key of TAGGERS.
+        evaluators (list[str]): Keys of EVALUATORS.
+        n_shards (int): The number of shards.
+        output (str): The output directory of the job.
+        processes (int): Number of worker processes. Defaults to n_shards.
+        batch_size (int): Number of sentences per batch.
+
+    Returns:
+        dict: The merged result (see merge).
+
+    """
+
+    processes = processes or n_shards
+    threads = max(1, (os.cpu_count() or 1) // processes)
+    CorpusIndex(find_corpus(lang))  # Extracts and indexes the corpus once, before the workers use it.
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(processes, mp_context=context) as executor:
+        futures = [executor.submit(run_shard, lang, tagger, evaluators, n_shards, shard, output, batch_size, threads) for shard in range(n_shards)]
+        for future in concurrent.futures.as_completed(futures):
+            info = future.result()
+            print("Shard {shard}: lines {lines}, {n_sentences} sentences, tagged in {tag_s:.1f}s, evaluated in {eval_s:.1f}s".format(**info))
+    return merge([output])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Runs shards of a corpus on several nodes and merges their results.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name, help_text in (("run", "tag and evaluate one shard"), ("local", "run all shards in local processes and merge them")):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument("--lang", required=True)
+        command.add_argument("--tagger", required=True, help="md, lg, multi or stanza")
+        command.add_argument("--evaluators", nargs="+", default=["lg"])
+        command.add_argument("--shards", type=int, required=True)
+        command.add_argument("--output", required=True, help="output directory of the job, shared by all shards")
+        command.add_argument("--batch-size", type=int, default=1000)
+    commands.choices["run"].add_argument("--shard", type=int, required=True)
+    commands.choices["run"].add_argument("--threads", type=int)
+    commands.choices["local"].add_argument("--processes", type=int)
+    merge_command = commands.add_parser("merge", help="merge the shards of a job")
+    merge_command.add_argument("paths", nargs="+", help="output directories of jobs or shard directories")
+    merge_command.add_argument("--output", help="write the merged scores as JSON")
+    merge_command.add_argument("--run", help="write the merged tagging results to this run directory")
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        info = run_shard(args.lang, args.tagger, args.evaluators, args.shards, args.shard, args.output, args.batch_size, args.threads)
+        print("Shard {shard}: lines {lines}, {n_sentences} sentences".format(**info))
+        return
+    if args.command == "local":
+        merged = run_local(args.lang, args.tagger, args.evaluators, args.shards, args.output, args.processes, args.batch_size)
+    else:
+        try:
+            merged = merge(args.paths, args.run)
+        except ValueError as e:
+            print(e)
+            raise SystemExit(1)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as output:
+                json.dump(merged, output, indent=1)
+    print("{} {} on {} sentences:".format(merged["job"]["lang"], merged["job"]["tagger"], merged["n_sentences"]))
+    for evaluator, scores in merged["scores"].items():
+        print("  {}: P {} R {} F {}".format(evaluator, scores["ents_p"], scores["ents_r"], scores["ents_f"]))
+
+if __name__ == "__main__":
+    main()
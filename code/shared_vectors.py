@@ -0,0 +1,131 @@
+"""Shares the word vectors of spaCy pipelines between processes.
+
+The md and lg pipelines carry static vector tables of hundreds of MB. Every
+process that loads such a pipeline normally reads its own copy into memory,
+so worker processes of Language.pipe(n_process=...), run_matrix.py or
+benchmark.py each pay for the table again. Here, the table of a pipeline is
+exported once as a .npy file and then memory-mapped read-only: the pipeline
+is loaded without its vectors, and a Vectors object backed by the mapped file
+is attached to its vocabulary. All processes on the machine share the same
+pages of the operating system's file cache, so an additional worker only
+needs memory for the model weights and activations. Attaching the vectors
+does not read the table; it only reads the keys and their rows (16 bytes per
+key) and builds the key-to-row dict in one step.
+
+The vectors are only read, never changed. Worker processes that are forked
+(Language.pipe on Linux) share the mapping directly; worker processes that
+are spawned have to load the pipeline with shared vectors themselves, e.g.
+through load(..., shared_vectors=True).
+
+Requires "json", "os", "shutil", "numpy", and "spacy".
+
+Example:
+    nlp_de3 = load("nlp_de3", shared_vectors=True)  # Same as load_shared("de_core_news_lg").
+
+Attributes:
+    VECTORS_DIR (str): Directory of the exported vector tables. Can be set
+        with the environment variable NER_VECTORS_DIR.
+
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+import spacy
+
+from spacy.vectors import Vectors
+
+from cache import DEFAULT_CACHE_DIR
+from models import NER_EXCLUDE
+
+VECTORS_DIR = os.environ.get("NER_VECTORS_DIR", os.path.join(DEFAULT_CACHE_DIR, "vectors"))
+
+def vectors_path(package, directory=VECTORS_DIR):
+    """Returns the directory of the exported vectors of an installed package.
+
+    Args:
+        package (str): A spaCy package name, e.g. "de_core_news_lg".
+        directory (str): The directory of all exported tables.
+
+    Returns:
+        str: The directory, named after package and version.
+
+    """
+
+    return os.path.join(directory, "{}-{}".format(package, spacy.util.get_package_version(package)))
+
+def export_vectors(package, directory=VECTORS_DIR):
+    """Writes the vector table of a pipeline as memory-mappable files.
+
+    The pipeline is loaded once with its vectors. The files are written to a
+    temporary directory first, so processes starting at the same time never
+    see a partial table.
+
+    Args:
+        package (str): A spaCy package name.
+        directory (str): The directory of all exported tables.
+
+    Returns:
+        str: The directory with data.npy, keys.npy, rows.npy and meta.json.
+
+    """
+
+    path = vectors_path(package, directory)
+    if os.path.exists(os.path.join(path, "meta.json")):
+        return path
+    vectors = spacy.load(package, exclude=NER_EXCLUDE + ["ner"]).vocab.vectors
+    temporary = "{}.{}.part".format(path, os.getpid())
+    os.makedirs(temporary, exist_ok=True)
+    np.save(os.path.join(temporary, "data.npy"), np.ascontiguousarray(vectors.data, dtype=np.float32))
+    np.save(os.path.join(temporary, "keys.npy"), np.fromiter(vectors.key2row.keys(), dtype=np.uint64, count=len(vectors.key2row)))
+    np.save(os.path.join(temporary, "rows.npy"), np.fromiter(vectors.key2row.values(), dtype=np.int64, count=len(vectors.key2row)))
+    with open(os.path.join(temporary, "meta.json"), "w", encoding="utf-8") as meta_file:
+        json.dump({"package": package, "name": vectors.name, "shape": list(vectors.shape)}, meta_file)
+    try:
+        os.replace(temporary, path)
+    except OSError:  # Another process exported the same table first.
+        shutil.rmtree(temporary, ignore_errors=True)
+    return path
+
+def attach_vectors(nlp, path):
+    """Replaces the vectors of a pipeline with a read-only mapped table.
+
+    Args:
+        nlp (Language): A pipeline loaded without vectors.
+        path (str): A directory written by export_vectors.
+
+    Returns:
+        Language: nlp.
+
+    """
+
+    with open(os.path.join(path, "meta.json"), encoding="utf-8") as meta_file:
+        meta = json.load(meta_file)
+    data = np.load(os.path.join(path, "data.npy"), mmap_mode="r")
+    vectors = Vectors(strings=nlp.vocab.strings, data=data, name=meta["name"])
+    # All rows of the table are in use, so the dict can be built at once
+    # instead of calling Vectors.add for every key.
+    vectors.key2row = dict(zip(np.load(os.path.join(path, "keys.npy")).tolist(), np.load(os.path.join(path, "rows.npy")).tolist()))
+    nlp.vocab.vectors = vectors
+    return nlp
+
+def load_shared(package, directory=VECTORS_DIR, **options):
+    """Loads a spaCy pipeline with a shared, memory-mapped vector table.
+
+    The table is exported on first use.
+
+    Args:
+        package (str): A spaCy package name.
+        directory (str): The directory of all exported tables.
+        **options: Options for spacy.load, e.g. exclude.
+
+    Returns:
+        Language: The pipeline.
+
+    """
+
+    path = export_vectors(package, directory)
+    options["exclude"] = list(options.get("exclude", [])) + ["vectors"]  # Vocab.from_disk skips the vectors file.
+    return attach_vectors(spacy.load(package, **options), path)
@@ -4,7 +4,8 @@ Uses a given spaCy pipeline to locate and tag named entities in a list of
 sentences. If called, the module can calculate the precision, recall, and
 F1-score of the previous annotation.
 
-Requires the package "spacy" and "time".
+Requires the package "spacy" and "time". The pipelines are only loaded when
+they are first used.
 
 Example:
     example_lang_sent = ["I like London.", "His name is Peter Parker."]
@@ -14,7 +15,8 @@ Example:
 Attributes:
     start_time_all (float): Tracks CPU time across the entire module.
     nlp_de2 (Language): German medium-size pipeline in spaCy. Second out of 
-        four pipelines for German.
+        four pipelines for German. Like all pipelines below, it is loaded
+        from the registry in models.py on first access.
     nlp_de3 (Language): German large pipeline in spaCy. Third out of four 
         pipelines for German.
     nlp_en2 (Language): English medium-sized pipeline in spaCy. Second out of
@@ -28,8 +30,6 @@ Attributes:
     nlp_multi (Language): Multi-language pipeline in spaCy focused on named 
         entity recognition.
     example_lang_sent (list[str]): Example format of to-be-annotated sentences.
-    results (list): List that results from named_entity_recognition_sp are 
-        appended to.
     example_results (list[tuple]): Example of named_entity_recognition_sp
         application.
     example_results_eval (Dict[str, Any]): Example of evaluate_ner_sp 
@@ -39,67 +39,137 @@ Attributes:
 
 """
 
-import spacy
 import time
 
-from spacy.training import Example
-from spacy.scorer import Scorer
+from batching import run_bucketed
+from cache import model_fingerprint, tag_cached
+from checkpoint import RunJournal, resume_evaluation, resume_tagging
+from models import SPACY_PIPELINES, load
+from prefilter import tag_filtered
+from scoring import make_examples, score_examples
 
 start_time_all = time.process_time()
 
-# German
-#nlp_de1 = spacy.load("de_core_news_sm")
-nlp_de2 = spacy.load("de_core_news_md")
-nlp_de3 = spacy.load("de_core_news_lg")
+# The pipelines are loaded from the shared registry on first access, e.g.
+# nlp_de2 is spacy.load("de_core_news_md") without the tagger and parser. See
+# SPACY_PIPELINES in models.py. Small pipelines (e.g. "de_core_news_sm") and
+# transformers (e.g. "en_core_web_trf") can be used with load().
 
-# English
-#nlp_en1 = spacy.load("en_core_web_sm")
-nlp_en2 = spacy.load("en_core_web_md")
-nlp_en3 = spacy.load("en_core_web_lg")
-#nlp_en4 = spacy.load("en_core_web_trf")
+def __getattr__(name):
+    """Loads the pipelines nlp_de2, nlp_de3, etc. on first access."""
 
-# Dutch
-#nlp_nl1 = spacy.load("nl_core_news_sm")
-nlp_nl2 = spacy.load("nl_core_news_md")
-nlp_nl3 = spacy.load("nl_core_news_lg")
-
-# Multi-language
-nlp_multi = spacy.load("xx_ent_wiki_sm")
+    if name in SPACY_PIPELINES:
+        return load(name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 #example_lang_sent = ["I like London.", "His name is Peter Parker."]
 
-results = []
-def named_entity_recognition_sp(lang_sent, nlp_model):
+def tag_sentences_sp(lang_sent, nlp_model, batch_size=1000, n_process=1, with_ids=False, max_tokens=None, cache=False, prefilter=None):
+    """Streams named entity tags for a list of sentences.
+
+    The sentences are processed in batches with Language.pipe instead of one
+    call per sentence. With n_process > 1 the batches are distributed across
+    worker processes, which requires the calling script to be importable
+    (e.g. guarded by if __name__ == "__main__" on Windows/macOS).
+
+    Args:
+        lang_sent (Iterable[str]): The sentences. Can be a list or a generator.
+        nlp_model (Language): An NLP model that matches the language of
+            lang_sent.
+        batch_size (int): Number of sentences per batch.
+        n_process (int): Number of processes. -1 uses all CPU cores.
+        with_ids (bool): Whether lang_sent contains tuples of (sentence id,
+            sentence), e.g. from read_corpus(lang, with_ids=True).
+        max_tokens (int): If set, sentences are batched by length with this
+            token budget (see batching.py) instead of in batches of
+            batch_size, which reduces padding for transformer pipelines.
+            batch_size is then the number of sentences that are sorted into
+            buckets together. Only works with n_process = 1.
+        cache (DiskCache): Cache of the entities found by nlp_model (see
+            cache.py). Only sentences that are not cached are tagged. If
+            None, the default cache is used. If False, nothing is cached.
+        prefilter (Prefilter): If given, only sentences that pass it are
+            tagged, the others get an empty list (see prefilter.py).
+
+    Yields:
+        tuple: One tuple per sentence in input order, in the format
+            ('Sentence.', [[start_char, end_char, 'entity_type']]). Sentences
+            without named entities receive an empty list. If with_ids is True,
+            the sentence id is prepended: (id, 'Sentence.', [[...]]).
+
+    Raises:
+        ValueError: max_tokens was combined with n_process > 1.
+
+    """
+
+    if max_tokens is not None and n_process != 1:
+        raise ValueError("max_tokens only works with n_process=1.")
+    if prefilter is not None:
+        tag = lambda sentences: tag_sentences_sp(sentences, nlp_model, batch_size, n_process, False, max_tokens, cache)
+        yield from tag_filtered(lang_sent, prefilter, tag, batch_size, with_ids)
+        return
+    if cache is not False:
+        tag = lambda sentences: tag_sentences_sp(sentences, nlp_model, batch_size, n_process, False, max_tokens)
+        yield from tag_cached(lang_sent, nlp_model, tag, cache, batch_size, with_ids)
+        return
+    if max_tokens is not None:
+        run_batches = lambda batches: (list(tag_sentences_sp(batch, nlp_model, len(batch), 1, with_ids)) for batch in batches)
+        yield from run_bucketed(lang_sent, run_batches, max_tokens, batch_size, key=(lambda record: record[1]) if with_ids else None)
+        return
+    if with_ids:
+        records = ((sentence, sentence_id) for sentence_id, sentence in lang_sent)
+        for doc, sentence_id in nlp_model.pipe(records, as_tuples=True, batch_size=batch_size, n_process=n_process):
+            yield (sentence_id, doc.text, [[ent.start_char, ent.end_char, ent.label_] for ent in doc.ents])
+        return
+    for doc in nlp_model.pipe(lang_sent, batch_size=batch_size, n_process=n_process):
+        entities = [[ent.start_char, ent.end_char, ent.label_] for ent in doc.ents]
+        yield (doc.text, entities)
+
+def named_entity_recognition_sp(lang_sent, nlp_model, batch_size=1000, n_process=1, with_ids=False, max_tokens=None, checkpoint=None, cache=False, prefilter=None):
     """Locates and tags named entities.
 
     Args:
         lang_sent (list[str]): A list of sentences.
         nlp_model (Language): An NLP model that matches the language of
             lang_sent.
+        batch_size (int): Number of sentences per batch.
+        n_process (int): Number of processes. -1 uses all CPU cores.
+        with_ids (bool): Whether lang_sent contains tuples of (sentence id,
+            sentence).
+        max_tokens (int): If set, sentences are batched by length with this
+            token budget instead of in batches of batch_size.
+        checkpoint (str): Name of a run journal (see checkpoint.py). If
+            given, every batch is committed to the journal, and calling the
+            function again with the same name and pipeline resumes after the
+            last committed batch.
+        cache (DiskCache): Cache of the entities found by nlp_model. If None,
+            the default cache is used. If False, nothing is cached.
+        prefilter (Prefilter): If given, only sentences that pass it are
+            tagged, the others get an empty list (see prefilter.py).
 
     Returns:
         list[tuple]: A list of trained sentences in tuples of the format 
-            [('Sentence.', [[start_char, end_char, 'entity_type']])].
+            [('Sentence.', [[start_char, end_char, 'entity_type']])]. Every
+            sentence appears exactly once, including those without entities.
+            If with_ids is True, the tuples start with the sentence id.
 
     """
 
     try:
-        for sentence in lang_sent:
-            doc = nlp_model(sentence)
-            entities = []
-            for ent in doc.ents:
-                entities.append([ent.start_char, ent.end_char, ent.label_])
-                results.append([sentence, entities])
-        #print(results)
-        result_tuples = [tuple(x) for x in results]
-        return result_tuples
+        if checkpoint:
+            config = {"task": "tag", "model": model_fingerprint(nlp_model), "with_ids": with_ids, "cache": cache is not False,
+                      "prefilter": prefilter and prefilter.digest()}
+            journal = RunJournal(checkpoint, config)
+            tag = lambda sentences: tag_sentences_sp(sentences, nlp_model, batch_size, n_process, with_ids, max_tokens, cache, prefilter)
+            return list(resume_tagging(lang_sent, tag, journal, batch_size))
+        return list(tag_sentences_sp(lang_sent, nlp_model, batch_size, n_process, with_ids, max_tokens, cache, prefilter))
 
     except Exception as e: print(e)
 
 #example_results = named_entity_recognition_sp(example_lang_sent, nlp_en2)
 #print(example_results)
 
-def evaluate_ner_sp(examples, nlp_model):
+def evaluate_ner_sp(examples, nlp_model, cache=None, batch_size=1000, checkpoint=None, snapshot_every=None, tokens=None, prefilter=None):
     """Evaluates accuracy in precision, recall, and F1-score.
 
     The spaCy NLP model evaluates the accuracy of the tags in the 
@@ -108,8 +178,26 @@ def evaluate_ner_sp(examples, nlp_model):
     Args:
         examples (list[tuple]): List of tagged tuples in the format 
             [('Sentence.', [[start_char, end_char, 'ENTITY_TYPE']]), (...)].
+            The tuples may start with the sentence id.
         nlp_model (Language): The NLP model used for evaluation. It must match
             the language of examples.
+        cache (DiskCache): Cache of the predictions of nlp_model. If None,
+            the default cache is used. If False, nothing is cached.
+        batch_size (int): Number of sentences per batch when nlp_model has to
+            make predictions.
+        checkpoint (str): Name of a run journal (see checkpoint.py). If
+            given, the counts are committed after every batch, and calling
+            the function again with the same name and pipeline resumes
+            after the last committed batch.
+        snapshot_every (int): If given, the scores counted so far are printed
+            every snapshot_every sentences, or after every committed batch
+            with a checkpoint.
+        tokens (TokenCache): If given, the reference and predicted Docs are
+            built from the tokens of the cache instead of tokenizing every
+            sentence twice (see tokens.py), and misaligned entities are
+            reported once instead of warned about per sentence.
+        prefilter (Prefilter): If given, nlp_model only makes predictions for
+            sentences that pass it (see prefilter.py).
 
     Returns:
         Dict[str, Any]: The precision, recall, and F1-score in total and per
@@ -121,15 +209,20 @@ def evaluate_ner_sp(examples, nlp_model):
 
     """
 
+    snapshot = (lambda counts, n: print(counts.snapshot())) if snapshot_every else None
     try:
-        scorer = Scorer()
-        examples_list = []
-        for input_, annot in examples:
-            doc = nlp_model.make_doc(str(input_))  # Creates spaCy Doc which contains predictions.
-            example = Example.from_dict(doc, {"entities": annot})  # Example object which is the gold standard.
-            example.predicted = nlp_model(input_)  # NLP model makes predictions on the input.
-            examples_list.append(example)        
-        return scorer.score(examples_list)  # Calculates the score of example_list.
+        if checkpoint:
+            config = {"task": "evaluate", "model": model_fingerprint(nlp_model), "cache": cache is not False, "tokens": tokens is not None,
+                      "prefilter": prefilter and prefilter.digest()}
+            journal = RunJournal(checkpoint, config)
+            make = lambda results: make_examples(results, nlp_model, cache, batch_size, tokens, prefilter)
+            counts = resume_evaluation(examples, make, journal, batch_size, snapshot)
+        else:
+            examples_stream = make_examples(examples, nlp_model, cache, batch_size, tokens, prefilter)
+            counts = score_examples(examples_stream, every=snapshot_every or batch_size, callback=snapshot)  # Counts every example and releases it.
+        if tokens is not None:
+            print(tokens.report())
+        return counts.scores()
 
     except Exception as e: print(e)
 
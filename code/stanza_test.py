@@ -4,7 +4,8 @@ Uses a given Stanza pipeline to locate and tag named entities in a list of
 sentences. If called, the module can calculate the precision, recall, and
 F1-score of the previous annotation, using a spaCy pipeline.
 
-Requires the packages "spacy", "stanza", and "time".
+Requires the packages "spacy", "stanza", "torch", and "time". The pipelines are only
+loaded when they are first used.
 
 Example:
     example_lang_sent = ["I like London.", "His name is Peter Parker."]
@@ -13,7 +14,9 @@ Example:
 
 Attributes:
     start_time_all (float): Tracks CPU time across the entire module.
-    nlp_de (Pipeline): The German Stanza pipeline. Processors can be adjusted.
+    nlp_de (Pipeline): The German Stanza pipeline. Processors can be adjusted
+        in STANZA_OPTIONS in models.py. Like all pipelines below, it is
+        loaded from the registry in models.py on first access.
     nlp_en (Pipeline): The English Stanza pipeline. Processors can be adjusted.
     nlp_nl (Pipeline): The Dutch Stanza pipeline. Processors can be adjusted.
     nlp_de2 (Language): German medium-size pipeline in spaCy. Second out of 
@@ -31,8 +34,6 @@ Attributes:
     nlp_multi (Language): Multi-language pipeline in spaCy focused on named 
         entity recognition.
     example_lang_sent (list[str]): Example format of to-be-annotated sentences.
-    results (list): List that results from named_entity_recognition_sp are 
-        appended to.
     example_results (list[tuple]): Example of named_entity_recognition_sp
         application.
     example_results_eval (Dict[str, Any]): Example of evaluate_ner_sp 
@@ -42,12 +43,21 @@ Attributes:
 
 """
 
-import spacy
+import collections
+import concurrent.futures
+import os
 import stanza
 import time
+import torch
 
-from spacy.training import Example
-from spacy.scorer import Scorer
+from batching import chunks, run_bucketed
+from cache import model_fingerprint, tag_cached
+from checkpoint import RunJournal, resume_evaluation, resume_tagging
+from models import SPACY_PIPELINES, STANZA_PIPELINES, load
+from prefilter import tag_filtered
+from quantize import run_report
+from scoring import make_examples, score_examples
+from tokens import is_pretokenized
 
 start_time_all = time.process_time()
 
@@ -55,63 +65,238 @@ start_time_all = time.process_time()
 #stanza.download('en')  # Only use if English pipeline is not installed yet.
 #stanza.download('nl')  # Only use if Dutch pipeline is not installed yet.
 
-nlp_de = stanza.Pipeline('de', verbose=False, processors='tokenize, ner', use_gpu=True) 
-nlp_en = stanza.Pipeline('en', verbose=False, processors='tokenize, ner', use_gpu=True) 
-nlp_nl = stanza.Pipeline('nl', verbose=False, processors='tokenize, ner', use_gpu=True)
+# The Stanza pipelines (nlp_de, nlp_en, nlp_nl) and the spaCy pipelines used
+# for evaluation (nlp_de2, nlp_de3, etc.) are loaded from the registry in
+# models.py on first access. They are the same objects that spacy_test.py uses.
 
-# spaCy
+def __getattr__(name):
+    """Loads the pipelines nlp_de, nlp_de3, etc. on first access."""
 
-# German
-nlp_de2 = spacy.load("de_core_news_md")
-nlp_de3 = spacy.load("de_core_news_lg")
+    if name in STANZA_PIPELINES or name in SPACY_PIPELINES:
+        return load(name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
-# English
-nlp_en2 = spacy.load("en_core_web_md")
-nlp_en3 = spacy.load("en_core_web_lg")
+#example_lang_sent = ["I like London.", "His name is Peter Parker."]
 
-# Dutch
-nlp_nl2 = spacy.load("nl_core_news_md")
-nlp_nl3 = spacy.load("nl_core_news_lg")
+def tag_chunk_st(chunk, nlp_model, tokens=None):
+    """Tags one chunk of sentences with a single pipeline call.
 
-# Multi-language
-nlp_multi = spacy.load("xx_ent_wiki_sm")
+    Args:
+        chunk (list[str]): The sentences.
+        nlp_model (Pipeline): A Stanza pipeline.
+        tokens (TokenCache): If given, the sentences are tagged as the
+            tokens of the cache (see tokens.py). nlp_model must be loaded
+            with tokenize_pretokenized=True.
 
-#example_lang_sent = ["I like London.", "His name is Peter Parker."]
+    Returns:
+        list[tuple]: One tuple per sentence in the format
+            ('Sentence.', [[start_char, end_char, 'entity_type']]).
+
+    """
+
+    if tokens is not None:
+        inputs = [tokens.stanza_input(d) for d in chunk]
+        out_docs = nlp_model([stanza.Document([], text=text) for text, _ in inputs])
+        return [(str(d), [[positions[ent.start_char], positions[ent.end_char], ent.type] for ent in doc.ents])
+                for d, (_, positions), doc in zip(chunk, inputs, out_docs)]
+    in_docs = [stanza.Document([], text=d) for d in chunk]  # Wrap each sentence in chunk in stanza.Document object.
+    out_docs = nlp_model(in_docs)
+    return [(str(doc.text), [[ent.start_char, ent.end_char, ent.type] for ent in doc.ents]) for doc in out_docs]
+
+_worker_model = None
+
+def _init_worker(lang, options, torch_threads):
+    global _worker_model
+    torch.set_num_threads(torch_threads)
+    _worker_model = load("stanza", lang, **options)
+
+def _tag_chunk_worker(chunk):
+    start_time = time.perf_counter()
+    return tag_chunk_st(chunk, _worker_model), time.perf_counter() - start_time
+
+def tag_sentences_st(lang_sent, nlp_model, chunk_size=1000, n_process=1, torch_threads=None, with_ids=False, verbose=False, max_tokens=None, cache=False, tokens=None, prefilter=None):
+    """Streams named entity tags for a list of sentences in fixed-size chunks.
+
+    Only one chunk of Stanza Documents per process exists at a time, so
+    memory stays flat regardless of the number of sentences. With
+    n_process > 1 the chunks are tagged by a pool of worker processes that
+    load their own copy of the pipeline on the CPU. At most two chunks per
+    worker are pending at any time, and the results are yielded in input
+    order.
+
+    Args:
+        lang_sent (Iterable[str]): The sentences. Can be a list or a generator.
+        nlp_model (Pipeline): A Stanza pipeline that matches the language of
+            lang_sent. With n_process > 1 the workers load it again from its
+            language, processors and the tokenize_pretokenized and quantized
+            options, so the language code (e.g. "de") can be passed instead.
+            Other loading options are not passed on to the workers.
+        chunk_size (int): Number of sentences per pipeline call.
+        n_process (int): Number of worker processes. 1 tags in this process.
+        torch_threads (int): Number of torch intra-op threads per process.
+            Defaults to the CPU count divided by n_process in worker
+            processes and is left unchanged for n_process = 1.
+        with_ids (bool): Whether lang_sent contains tuples of (sentence id,
+            sentence), e.g. from read_corpus(lang, with_ids=True).
+        verbose (bool): Whether to print the throughput of every chunk.
+        max_tokens (int): If set, chunks are built from length buckets with
+            this token budget (see batching.py) instead of chunk_size
+            consecutive sentences. chunk_size is then the number of
+            sentences that are sorted into buckets together.
+        cache (DiskCache): Cache of the entities found by nlp_model (see
+            cache.py). Only sentences that are not cached are tagged. If
+            None, the default cache is used. If False, nothing is cached.
+        tokens (TokenCache): If given, the sentences are tokenized once by
+            the cache and tagged by nlp_model as pretokenized text (see
+            tokens.py). Only works with n_process = 1 and without cache.
+        prefilter (Prefilter): If given, only sentences that pass it are
+            tagged, the others get an empty list (see prefilter.py).
+
+    Yields:
+        tuple: One tuple per sentence in input order, in the format
+            ('Sentence.', [[start_char, end_char, 'entity_type']]). Sentences
+            without named entities receive an empty list. If with_ids is True,
+            the sentence id is prepended: (id, 'Sentence.', [[...]]).
+
+    """
+
+    if tokens is not None and (n_process != 1 or cache is not False or not is_pretokenized(nlp_model)):
+        raise ValueError("tokens needs n_process=1, cache=False and a pipeline loaded with tokenize_pretokenized=True.")
+    if prefilter is not None:
+        tag = lambda sentences: tag_sentences_st(sentences, nlp_model, chunk_size, n_process, torch_threads, False, verbose, max_tokens, cache, tokens)
+        yield from tag_filtered(lang_sent, prefilter, tag, chunk_size, with_ids)
+    elif cache is not False:
+        tag = lambda sentences: tag_sentences_st(sentences, nlp_model, chunk_size, n_process, torch_threads, False, verbose, max_tokens)
+        yield from tag_cached(lang_sent, nlp_model, tag, cache, chunk_size, with_ids)
+    elif max_tokens is None:
+        for results in _run_chunks(chunks(lang_sent, chunk_size), nlp_model, n_process, torch_threads, with_ids, verbose, tokens):
+            yield from results
+    else:
+        run_batches = lambda batches: _run_chunks(batches, nlp_model, n_process, torch_threads, with_ids, verbose, tokens)
+        yield from run_bucketed(lang_sent, run_batches, max_tokens, chunk_size, key=(lambda record: record[1]) if with_ids else None)
+
+def tag_chunks_st(chunk_iter, nlp_model, n_process=1, torch_threads=None):
+    """Tags chunks of sentences whose sizes are chosen by the caller.
+
+    Unlike tag_sentences_st, the chunks can differ in size, e.g. to adjust
+    the chunk size during a run, while the same worker processes are used
+    for the whole run.
+
+    Args:
+        chunk_iter (Iterable[list[str]]): The chunks of sentences. Can be a
+            generator that decides the size of the next chunk when it is
+            requested.
+        nlp_model (Pipeline): A Stanza pipeline or a language code (see
+            tag_sentences_st).
+        n_process (int): Number of worker processes. 1 tags in this process.
+        torch_threads (int): Number of torch intra-op threads per process.
+
+    Yields:
+        list[tuple]: The results of every chunk, in input order.
+
+    """
 
-results = []
-def named_entity_recognition_st(lang_sent, nlp_model):
+    yield from _run_chunks(chunk_iter, nlp_model, n_process, torch_threads, False, False)
+
+def _run_chunks(chunk_iter, nlp_model, n_process, torch_threads, with_ids, verbose, tokens=None):
+    if n_process == 1:
+        if torch_threads is not None:
+            torch.set_num_threads(torch_threads)
+        timed = (_timed_chunk(chunk, nlp_model, with_ids, tokens) for chunk in chunk_iter)
+    else:
+        timed = _tag_parallel(chunk_iter, nlp_model, n_process, torch_threads, with_ids)
+    for i, (chunk, results, seconds) in enumerate(timed):
+        if verbose:
+            print("Chunk {}: {} sentences in {:.2f}s ({:.1f} sentences/s)".format(i, len(results), seconds, len(results) / max(seconds, 1e-9)))
+        if with_ids:
+            yield [(sentence_id,) + result for (sentence_id, _), result in zip(chunk, results)]
+        else:
+            yield results
+
+def _timed_chunk(chunk, nlp_model, with_ids, tokens=None):
+    start_time = time.perf_counter()
+    results = tag_chunk_st([sentence for _, sentence in chunk] if with_ids else chunk, nlp_model, tokens)
+    return chunk, results, time.perf_counter() - start_time
+
+def _tag_parallel(chunks, nlp_model, n_process, torch_threads, with_ids):
+    if isinstance(nlp_model, str):
+        lang, options = nlp_model, {}
+    else:
+        lang, options = nlp_model.lang, {"processors": ",".join(nlp_model.processors)}
+        if is_pretokenized(nlp_model):
+            options["tokenize_pretokenized"] = True
+        if getattr(nlp_model, "quantized", False):
+            options["quantized"] = True  # The workers must use the model that the fingerprint names.
+    options["use_gpu"] = False
+    if torch_threads is None:
+        torch_threads = max(1, (os.cpu_count() or 1) // n_process)
+    pending = collections.deque()
+    with concurrent.futures.ProcessPoolExecutor(n_process, initializer=_init_worker, initargs=(lang, options, torch_threads)) as executor:
+        for chunk in chunks:
+            texts = [sentence for _, sentence in chunk] if with_ids else chunk
+            pending.append((chunk, executor.submit(_tag_chunk_worker, texts)))
+            if len(pending) >= 2 * n_process:
+                chunk, future = pending.popleft()
+                yield (chunk,) + future.result()
+        while pending:
+            chunk, future = pending.popleft()
+            yield (chunk,) + future.result()
+
+def named_entity_recognition_st(lang_sent, nlp_model, chunk_size=1000, n_process=1, torch_threads=None, with_ids=False, verbose=False, max_tokens=None, checkpoint=None, cache=False, tokens=None, prefilter=None):
     """Locates and tags named entities.
 
     Args:
         lang_sent (list[str]): A list of sentences.
         nlp_model (Language): An NLP model that matches the language of
             lang_sent. A Stanza model must be used for tagging.
+        chunk_size (int): Number of sentences per pipeline call.
+        n_process (int): Number of worker processes.
+        torch_threads (int): Number of torch intra-op threads per process.
+        with_ids (bool): Whether lang_sent contains tuples of (sentence id,
+            sentence).
+        verbose (bool): Whether to print the throughput of every chunk.
+        max_tokens (int): If set, sentences are batched by length with this
+            token budget instead of in chunks of chunk_size.
+        checkpoint (str): Name of a run journal (see checkpoint.py). If
+            given, every batch is committed to the journal, and calling the
+            function again with the same name and pipeline resumes after the
+            last committed batch.
+        cache (DiskCache): Cache of the entities found by nlp_model. If None,
+            the default cache is used. If False, nothing is cached.
+        tokens (TokenCache): If given, every sentence is tokenized once and
+            tagged as pretokenized text (see tokens.py).
+        prefilter (Prefilter): If given, only sentences that pass it are
+            tagged, the others get an empty list (see prefilter.py).
 
     Returns:
         list[tuple]: A list of trained sentences in tuples of the format 
-            [('Sentence.', [[start_char, end_char, 'entity_type']])].
+            [('Sentence.', [[start_char, end_char, 'entity_type']])]. Every
+            sentence appears exactly once, including those without entities.
+            If with_ids is True, the tuples start with the sentence id. For
+            a quantized pipeline, the throughput and the saved accuracy
+            change of quantization are printed (see quantize.py).
 
     """
 
     try:
-        in_docs = [stanza.Document([], text=d) for d in lang_sent]  # Wrap each sentence in lang_sent in stanza.Document object.
-        out_docs = nlp_model(in_docs)
-        for sent in out_docs:
-            #print(sent.text)  # Print all sentences.
-            sentences = str(sent.text)
-            entities = []
-            for ent in sent.ents:
-                entities.append([ent.start_char, ent.end_char, ent.type])
-                results.append([sentences, entities])
-            #print(results)
-        result_tuples = [tuple(x) for x in results]
-        return result_tuples
+        start_time = time.perf_counter()
+        if checkpoint:
+            config = {"task": "tag", "model": model_fingerprint(nlp_model), "with_ids": with_ids, "cache": cache is not False,
+                      "tokens": tokens is not None, "prefilter": prefilter and prefilter.digest()}
+            journal = RunJournal(checkpoint, config)
+            tag = lambda sentences: tag_sentences_st(sentences, nlp_model, chunk_size, n_process, torch_threads, with_ids, verbose, max_tokens, cache, tokens, prefilter)
+            results = list(resume_tagging(lang_sent, tag, journal, chunk_size))
+        else:
+            results = list(tag_sentences_st(lang_sent, nlp_model, chunk_size, n_process, torch_threads, with_ids, verbose, max_tokens, cache, tokens, prefilter))
+        if getattr(nlp_model, "quantized", False):
+            print(run_report(nlp_model, len(results), time.perf_counter() - start_time))
+        return results
         
     except Exception as e: print(e)
 
 #example_results = named_entity_recognition_st(example_lang_sent, nlp_en)
 
-def evaluate_ner_st(examples, nlp_model):
+def evaluate_ner_st(examples, nlp_model, cache=None, batch_size=1000, checkpoint=None, snapshot_every=None, tokens=None, prefilter=None):
     """Evaluates accuracy in precision, recall, and F1-score with spaCy model.
 
     The spaCy NLP model evaluates the accuracy of the tags in the 
@@ -120,9 +305,27 @@ def evaluate_ner_st(examples, nlp_model):
     Args:
         examples (list[tuple]): List of tagged tuples in the format 
             [('Sentence.', [[start_char, end_char, 'ENTITY_TYPE']]), (...)].
+            The tuples may start with the sentence id.
         nlp_model (Language): The NLP model used for evaluation. It must match
             the language of examples. A spaCy model must be used for
             evaluation.
+        cache (DiskCache): Cache of the predictions of nlp_model. If None,
+            the default cache is used. If False, nothing is cached.
+        batch_size (int): Number of sentences per batch when nlp_model has to
+            make predictions.
+        checkpoint (str): Name of a run journal (see checkpoint.py). If
+            given, the counts are committed after every batch, and calling
+            the function again with the same name and pipeline resumes
+            after the last committed batch.
+        snapshot_every (int): If given, the scores counted so far are printed
+            every snapshot_every sentences, or after every committed batch
+            with a checkpoint.
+        tokens (TokenCache): If given, the reference and predicted Docs are
+            built from the tokens of the cache instead of tokenizing every
+            sentence twice (see tokens.py), and misaligned entities are
+            reported once instead of warned about per sentence.
+        prefilter (Prefilter): If given, nlp_model only makes predictions for
+            sentences that pass it (see prefilter.py).
 
     Returns:
         Dict[str, Any]: The precision, recall, and F1-score in total and per
@@ -134,15 +337,20 @@ def evaluate_ner_st(examples, nlp_model):
 
     """
     
+    snapshot = (lambda counts, n: print(counts.snapshot())) if snapshot_every else None
     try:
-        scorer = Scorer()
-        examples_list = []
-        for input_, annot in examples:
-            doc = nlp_model.make_doc(str(input_))  # Creates spaCy Doc which contains predictions.
-            example = Example.from_dict(doc, {"entities": annot})  # Example object which is the gold standard.
-            example.predicted = nlp_model(input_)  # NLP model makes predictions on the input.
-            examples_list.append(example)   
-        return scorer.score(examples_list)  # Calculates the score of example_list.
+        if checkpoint:
+            config = {"task": "evaluate", "model": model_fingerprint(nlp_model), "cache": cache is not False, "tokens": tokens is not None,
+                      "prefilter": prefilter and prefilter.digest()}
+            journal = RunJournal(checkpoint, config)
+            make = lambda results: make_examples(results, nlp_model, cache, batch_size, tokens, prefilter)
+            counts = resume_evaluation(examples, make, journal, batch_size, snapshot)
+        else:
+            examples_stream = make_examples(examples, nlp_model, cache, batch_size, tokens, prefilter)
+            counts = score_examples(examples_stream, every=snapshot_every or batch_size, callback=snapshot)  # Counts every example and releases it.
+        if tokens is not None:
+            print(tokens.report())
+        return counts.scores()
 
     except Exception as e: print(e)
 
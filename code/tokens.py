@@ -0,0 +1,178 @@
+"""Tokenizes every sentence once and shares the tokens across a run.
+
+Without it, a sentence is tokenized three times per run: by the Stanza
+tokenize processor while tagging, by make_doc for the reference Doc, and by
+the evaluation pipeline for the predicted Doc. A TokenCache tokenizes each
+sentence once with the tokenizer of the evaluation pipeline and keeps the
+tokens as a compact array of (start_char, end_char) offsets. From it:
+
+    - a Stanza pipeline loaded with tokenize_pretokenized=True tags the
+      tokens joined by spaces, and the entity offsets are mapped back to the
+      sentence,
+    - the reference and the predicted spaCy Docs are built directly from the
+      words and spaces, so the evaluation pipeline skips its tokenizer and
+      the two Docs are trivially aligned.
+
+Tagging results then follow the spaCy tokenization instead of Stanza's, so
+its scores can differ slightly from a run without shared tokens.
+
+Entities whose offsets do not fall on token boundaries are ignored by the
+evaluation like before, but instead of one W030 warning per sentence, they
+are counted and reported once per run.
+
+Requires "warnings", "numpy", "spacy", and "stanza".
+
+Example:
+    tokens = TokenCache(nlp_de3)
+    nlp_de_pretokenized = load("stanza", "de", tokenize_pretokenized=True)
+    ger_st_results = named_entity_recognition_st(read_corpus("de"), nlp_de_pretokenized, tokens=tokens)
+    ger_st_results_eval = evaluate_ner_st(ger_st_results, nlp_de3, tokens=tokens)
+    print(tokens.report())
+
+"""
+
+import warnings
+
+import numpy as np
+from spacy.tokens import Doc
+from spacy.training import Example
+
+class TokenCache:
+    """Tokenizes sentences once with a spaCy tokenizer and keeps the offsets.
+
+    Args:
+        nlp_model (Language): The spaCy pipeline whose tokenizer and
+            vocabulary are used, usually the evaluation pipeline.
+
+    Attributes:
+        entities (int): Number of reference entities seen by example().
+        misaligned_entities (int): Number of those that are not aligned with
+            the tokens and are ignored by the evaluation (W030).
+        misaligned_sentences (int): Number of sentences with misaligned
+            entities.
+
+    """
+
+    def __init__(self, nlp_model):
+        self.tokenizer = nlp_model.tokenizer
+        self.vocab = nlp_model.vocab
+        self.entities = 0
+        self.misaligned_entities = 0
+        self.misaligned_sentences = 0
+        self._offsets = {}  # Sentence -> int32 (start_char, end_char) pairs as bytes.
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def tokenize(self, sentences, batch_size=1000):
+        """Tokenizes the sentences that are not in the cache yet.
+
+        Args:
+            sentences (Iterable[str]): The sentences.
+            batch_size (int): Number of sentences per batch of the tokenizer.
+
+        """
+
+        missing = [sentence for sentence in dict.fromkeys(str(s) for s in sentences) if sentence not in self._offsets]
+        for sentence, doc in zip(missing, self.tokenizer.pipe(missing, batch_size=batch_size)):
+            self._store(sentence, doc)
+
+    def _store(self, sentence, doc):
+        self._offsets[sentence] = np.array([(token.idx, token.idx + len(token)) for token in doc], dtype=np.int32).tobytes()
+
+    def offsets(self, sentence):
+        """Returns the token offsets of a sentence and tokenizes it if needed.
+
+        Args:
+            sentence (str): The sentence.
+
+        Returns:
+            ndarray: One (start_char, end_char) row per token.
+
+        """
+
+        sentence = str(sentence)
+        if sentence not in self._offsets:
+            self._store(sentence, self.tokenizer(sentence))
+        return np.frombuffer(self._offsets[sentence], dtype=np.int32).reshape(-1, 2)
+
+    def doc(self, sentence, vocab=None):
+        """Builds an unannotated Doc from the cached tokens.
+
+        Args:
+            sentence (str): The sentence.
+            vocab (Vocab): The vocabulary. Defaults to the one of the
+                tokenizer's pipeline.
+
+        Returns:
+            Doc: A Doc with the same text and tokens as make_doc(sentence).
+
+        """
+
+        sentence = str(sentence)
+        offsets = self.offsets(sentence)
+        # The tokenizer splits on single spaces, so a token has a trailing
+        # space if the next token does not start where it ends.
+        spaces = np.append(offsets[1:, 0], len(sentence)) > offsets[:, 1]
+        return Doc(vocab or self.vocab, words=[sentence[start:end] for start, end in offsets.tolist()], spaces=spaces.tolist())
+
+    def example(self, sentence, entities, vocab=None):
+        """Builds an Example with the tagging result as reference.
+
+        Misaligned entities are counted instead of warned about.
+
+        Args:
+            sentence (str): The sentence.
+            entities (list): [[start_char, end_char, 'LABEL']] of the tagger.
+            vocab (Vocab): The vocabulary of the evaluation pipeline.
+
+        Returns:
+            Example: The Example. Its predicted Doc still has to be set.
+
+        """
+
+        offsets = self.offsets(sentence)
+        misaligned = sum(1 for start, end, _ in entities if not (np.any(offsets[:, 0] == start) and np.any(offsets[:, 1] == end)))
+        self.entities += len(entities)
+        self.misaligned_entities += misaligned
+        self.misaligned_sentences += misaligned > 0
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", message=r".*\[W030\]")
+            return Example.from_dict(self.doc(sentence, vocab), {"entities": entities})
+
+    def stanza_input(self, sentence):
+        """Prepares a sentence for a pretokenized Stanza pipeline.
+
+        Args:
+            sentence (str): The sentence.
+
+        Returns:
+            tuple: The tokens joined by single spaces (without whitespace
+                tokens), and a dict that maps the character offsets of token
+                starts and ends in that text to offsets in sentence.
+
+        """
+
+        sentence = str(sentence)
+        words, positions, position = [], {}, 0
+        for start, end in self.offsets(sentence).tolist():
+            word = sentence[start:end]
+            if word.isspace():
+                continue
+            positions[position] = start
+            positions[position + len(word)] = end
+            words.append(word)
+            position += len(word) + 1
+        return " ".join(words), positions
+
+    def report(self):
+        """Summarizes the misaligned entities of the run."""
+
+        return "W030: {} of {} entities in {} sentences are not aligned with the tokens and were ignored.".format(
+            self.misaligned_entities, self.entities, self.misaligned_sentences)
+
+def is_pretokenized(nlp_model):
+    """Checks whether a Stanza pipeline was loaded with tokenize_pretokenized=True."""
+
+    tokenizer = nlp_model.processors.get("tokenize")
+    return tokenizer is not None and bool(tokenizer.config.get("pretokenized"))
@@ -0,0 +1,6 @@
+"""Makes the modules in code/ importable, as they are when run from there."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "code"))
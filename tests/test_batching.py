@@ -0,0 +1,48 @@
+import random
+
+from batching import chunks, plan_batches, run_bucketed, token_length
+
+def make_sentences(n, seed=0):
+    rng = random.Random(seed)
+    return ["Sentence {} ".format(i) + " ".join("word" for _ in range(rng.randint(0, 40))) + "." for i in range(n)]
+
+def tag_batches(batches, seen=None):
+    for batch in batches:
+        if seen is not None:
+            seen.append(batch)
+        yield [(sentence, len(batch)) for sentence in batch]
+
+def test_chunks():
+    assert list(chunks(iter(range(7)), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert list(chunks([], 3)) == []
+
+def test_plan_batches_respects_budget_and_buckets():
+    lengths = [token_length(sentence) for sentence in make_sentences(500)]
+    batches = plan_batches(lengths, max_tokens=64, bucket_width=4)
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+    for batch in batches:
+        longest = max(lengths[i] for i in batch)
+        assert len(batch) == 1 or len(batch) * longest <= 64
+        assert len({lengths[i] // 4 for i in batch}) == 1
+
+def test_run_bucketed_preserves_input_order():
+    sentences = make_sentences(2500)
+    seen = []
+    results = list(run_bucketed(sentences, lambda batches: tag_batches(batches, seen), max_tokens=128, window=1000))
+    assert [sentence for sentence, _ in results] == sentences
+    assert [sentence for batch in seen for sentence in batch] != sentences  # The batches were tagged out of order.
+
+def test_run_bucketed_with_records():
+    records = list(enumerate(make_sentences(300)))
+    results = list(run_bucketed(iter(records), tag_batches, max_tokens=256, window=64, key=lambda record: record[1]))
+    assert [record for record, _ in results] == records
+
+def test_run_bucketed_calls_run_batches_once():
+    calls = []
+
+    def run_batches(batches):
+        calls.append(1)
+        return tag_batches(batches)
+
+    list(run_bucketed(make_sentences(1000), run_batches, max_tokens=64, window=100))
+    assert len(calls) == 1
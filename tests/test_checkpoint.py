@@ -0,0 +1,64 @@
+import pytest
+
+from checkpoint import RunJournal, resume_tagging
+
+SENTENCES = ["Sentence {}.".format(i) for i in range(25)]
+
+def tag(sentences):
+    for sentence in sentences:
+        yield (sentence, [[0, 8, "MISC"]])
+
+def killed_after(n):
+    # A tagger whose process dies after n sentences.
+    def tag_until_killed(sentences):
+        for i, result in enumerate(tag(sentences)):
+            if i == n:
+                raise KeyboardInterrupt
+            yield result
+    return tag_until_killed
+
+def test_resume_after_killed_run(tmp_path):
+    journal = RunJournal("run", {"task": "tag"}, str(tmp_path))
+    with pytest.raises(KeyboardInterrupt):
+        list(resume_tagging(SENTENCES, killed_after(17), journal, batch_size=5))
+
+    journal = RunJournal("run", {"task": "tag"}, str(tmp_path))
+    assert journal.position == 15
+    tagged = []
+
+    def tag_remaining(sentences):
+        for result in tag(sentences):
+            tagged.append(result[0])
+            yield result
+
+    results = list(resume_tagging(SENTENCES, tag_remaining, journal, batch_size=5))
+    assert results == list(tag(SENTENCES))
+    assert tagged == SENTENCES[15:]
+
+def test_partly_written_batch_is_dropped(tmp_path):
+    journal = RunJournal("run", {"task": "tag"}, str(tmp_path))
+    list(resume_tagging(SENTENCES[:10], tag, journal, batch_size=5))
+    with open(journal.path, "ab") as journal_file:
+        journal_file.write(b'{"position": 15, "results": [["Sentence 10.", [')
+
+    journal = RunJournal("run", {"task": "tag"}, str(tmp_path))
+    assert journal.position == 10
+    assert list(resume_tagging(SENTENCES, tag, journal, batch_size=5)) == list(tag(SENTENCES))
+    assert [record["position"] for record in journal.records()] == [5, 10, 15, 20, 25]
+
+def test_different_input_is_refused(tmp_path):
+    journal = RunJournal("run", {"task": "tag"}, str(tmp_path))
+    list(resume_tagging(SENTENCES[:10], tag, journal, batch_size=5))
+
+    journal = RunJournal("run", {"task": "tag"}, str(tmp_path))
+    other_slice = SENTENCES[1:]
+    with pytest.raises(ValueError, match="differs from the committed input"):
+        list(resume_tagging(other_slice, tag, journal, batch_size=5))
+
+def test_different_config_gets_another_journal(tmp_path):
+    journal = RunJournal("run", {"task": "tag", "prefilter": None}, str(tmp_path))
+    list(resume_tagging(SENTENCES[:10], tag, journal, batch_size=5))
+
+    other = RunJournal("run", {"task": "tag", "prefilter": "0123456789ab"}, str(tmp_path))
+    assert other.path != journal.path
+    assert other.position == 0
@@ -0,0 +1,45 @@
+import pytest
+
+pytest.importorskip("numpy")  # shards.py imports corpus_index.
+
+from shards import check_shards
+
+JOB = {"lang": "nl", "tagger": "md", "evaluators": ["lg"], "corpus": "nld_sentences.tsv", "corpus_bytes": 1000,
+       "corpus_lines": 100, "n_shards": 4, "models": {}}
+
+def shard(number, start, stop, **job):
+    return {"job": dict(JOB, **job), "shard": number, "lines": [start, stop], "n_sentences": stop - start}
+
+def complete():
+    return [shard(0, 0, 25), shard(1, 25, 50), shard(2, 50, 75), shard(3, 75, 100)]
+
+def test_complete_job_has_no_problems():
+    assert check_shards(complete()) == []
+
+def test_no_shards():
+    assert check_shards([]) == ["No complete shards found."]
+
+def test_missing_shard():
+    infos = complete()
+    del infos[2]
+    problems = check_shards(infos)
+    assert "Missing shards: [2]." in problems
+    assert "Lines 50-75 are not covered by any shard." in problems
+
+def test_missing_last_shard():
+    problems = check_shards(complete()[:3])
+    assert problems == ["Missing shards: [3].", "Lines 75-100 are not covered by any shard."]
+
+def test_duplicate_shard():
+    problems = check_shards(complete() + [shard(1, 25, 50)])
+    assert problems == ["Duplicate shards: [1]."]
+
+def test_overlapping_shards():
+    infos = complete()
+    infos[2] = shard(2, 40, 75)
+    assert check_shards(infos) == ["Shard 2 overlaps lines 40-50."]
+
+def test_shard_of_another_job():
+    infos = complete()
+    infos[3] = shard(3, 75, 100, corpus_bytes=2000)
+    assert check_shards(infos) == ["Shard 3 belongs to another job (differs in corpus_bytes)."]